@@ -0,0 +1,177 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Measures the throughput, per-message latency and peak memory of the
+message path, from PulseBuildMonitor.pulse_message_received through to the
+callbacks, by replaying a recording made with MessageRecorder or, if none
+is given, generated messages.  Each configuration runs in its own process
+so that its peak RSS can be reported.
+
+  python benchmarks/message_path.py [--recording FILE] [--count N]
+                                    [--realtime [--speed X]]
+
+With --realtime, messages are replayed with their recorded timing (sped
+up by --speed), which measures latency at a realistic load rather than
+peak throughput.
+"""
+
+import multiprocessing
+import optparse
+import os
+import resource
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pulsebuildmonitor import (CallbackDispatcher, FactoryBuildMonitor,
+                               PulseBuildMonitor, QueueTransport,
+                               ReplayDriver, read_recording,
+                               synthetic_messages)
+
+
+# name -> PulseBuildMonitor arguments
+FILTER_CONFIGS = [
+    ('everything', dict(trees=None, builds=True, unittests=True, talos=True)),
+    ('one tree', dict(trees=['mozilla-central'], builds=True, unittests=True)),
+    ('tree/platform/buildtype', dict(trees=['mozilla-central'],
+                                     platforms=['linux64'],
+                                     buildtypes=['debug'],
+                                     builds=True, unittests=True)),
+    ('buildtags', dict(trees=None, builds=True,
+                       buildtags=[['nightly'], ['pgo']])),
+    ('typed events', dict(trees=None, builds=True, unittests=True,
+                          talos=True, typed_events=True)),
+]
+
+# name -> FactoryBuildMonitor dispatcher factory
+DISPATCH_CONFIGS = [
+    ('thread per message', lambda: None),
+    ('4 workers', lambda: CallbackDispatcher(workers=4, maxsize=10000)),
+    ('4 workers, ordered', lambda: CallbackDispatcher(workers=4, maxsize=10000,
+                                                      ordered=True)),
+]
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def timed(handler, latencies):
+    def wrapper(data, message):
+        start = time.time()
+        handler(data, message)
+        latencies.append(time.time() - start)
+    return wrapper
+
+
+def bench_filters(messages, kwargs, realtime=False, speed=1.0):
+    monitor = PulseBuildMonitor(label='benchmark', transport=QueueTransport(),
+                                **kwargs)
+    latencies = []
+    driver = ReplayDriver(messages, timed(monitor.pulse_message_received,
+                                          latencies),
+                          realtime=realtime, speed=speed)
+    start = time.time()
+    count = driver.run()
+    return count, time.time() - start, latencies
+
+
+def bench_dispatch(messages, make_dispatcher, realtime=False, speed=1.0):
+    total = sum(1 for t, data in messages
+                if data['_meta']['routing_key'].startswith(('build', 'unittest')))
+    latencies = []
+    lock = threading.Lock()
+    finished = threading.Event()
+
+    def callback(builddata):
+        # latency from the message being received to its callback running
+        latency = time.time() - builddata['received']
+        lock.acquire()
+        try:
+            latencies.append(latency)
+            if len(latencies) == total:
+                finished.set()
+        finally:
+            lock.release()
+
+    dispatcher = make_dispatcher()
+    monitor = FactoryBuildMonitor(buildCallback=callback, testCallback=callback,
+                                  trees=None, label='benchmark',
+                                  dispatcher=dispatcher,
+                                  transport=QueueTransport())
+    if dispatcher:
+        dispatcher.start()
+
+    def handler(data, message):
+        data['payload']['received'] = time.time()
+        monitor.pulse_message_received(data, message)
+
+    start = time.time()
+    count = ReplayDriver(messages, handler, realtime=realtime,
+                         speed=speed).run()
+    finished.wait(60)
+    elapsed = time.time() - start
+    if dispatcher:
+        dispatcher.stop()
+    return count, elapsed, latencies
+
+
+def run_in_child(results, bench, messages, arg, options):
+    count, elapsed, latencies = bench(messages, arg, options.realtime,
+                                      options.speed)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((count, elapsed, percentile(latencies, 0.5),
+                 percentile(latencies, 0.99), peak))
+
+
+def report(name, bench, messages, arg, options):
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=run_in_child,
+                                    args=(results, bench, messages, arg,
+                                          options))
+    child.start()
+    count, elapsed, p50, p99, peak = results.get()
+    child.join()
+    print '%-28s %10.0f %10.1f %10.1f %10.1f' % (
+        name, count / elapsed, p50 * 1e6, p99 * 1e6, peak / 1024.0)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--recording', dest='recording',
+                      help='a recording made with MessageRecorder')
+    parser.add_option('--count', dest='count', type='int', default=100000,
+                      help='the number of messages to replay')
+    parser.add_option('--realtime', dest='realtime', action='store_true',
+                      help='replay messages with their recorded timing')
+    parser.add_option('--speed', dest='speed', type='float', default=1.0,
+                      help='with --realtime, how much faster than recorded '
+                           'to replay')
+    options, args = parser.parse_args()
+
+    if options.recording:
+        messages = list(read_recording(options.recording))[:options.count]
+    else:
+        messages = list(synthetic_messages(options.count))
+
+    header = '%-28s %10s %10s %10s %10s' % ('', 'msgs/s', 'p50 us',
+                                            'p99 us', 'peak MB')
+    print 'filtering (%d messages)' % len(messages)
+    print header
+    for name, kwargs in FILTER_CONFIGS:
+        report(name, bench_filters, messages, kwargs, options)
+    print
+    print 'FactoryBuildMonitor dispatch; latency is receipt to callback'
+    print header
+    for name, make_dispatcher in DISPATCH_CONFIGS:
+        report(name, bench_dispatch, messages, make_dispatcher, options)
+
+
+if __name__ == '__main__':
+    main()
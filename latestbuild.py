@@ -1,41 +1,513 @@
-from collections import defaultdict
+import abc
+import calendar
+from collections import defaultdict, deque
+import gzip
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
+import signal
+import socket
+import SocketServer
+import tempfile
+import threading
 import time
+from cStringIO import StringIO
 from webob import Request, Response, html_escape
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
 
-from pulsebuildmonitor import start_pulse_monitor, createDaemon
+from pulsebuildmonitor import start_pulse_monitor, createDaemon, EventStreamServer, StateJournal, MetricsRegistry, BuildStats
 
-class LatestBuildMonitor(object):
 
-    def __init__(self, port=8034, logger=None):
-        self.builds = defaultdict(lambda: defaultdict(dict))
-        self.port = port
-        self.logger = logger
+class CachedResponse(object):
+    """A response body which is serialized and compressed once, and then
+       served to any number of requests, with ETag and Last-Modified
+       headers and support for conditional requests.
+    """
+
+    def __init__(self, body, content_type='application/json',
+                 last_modified=None, gzip_min_size=1024):
+        self.body = body
+        self.content_type = content_type
+        self.etag = hashlib.md5(body).hexdigest()
+        self.last_modified = int(last_modified or time.time())
+        self.gzipped = None
+        if len(body) >= gzip_min_size:
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode='wb', mtime=self.last_modified)
+            f.write(body)
+            f.close()
+            self.gzipped = buf.getvalue()
+
+    def response(self, req):
+        resp = Response(content_type=self.content_type)
+        resp.etag = self.etag
+        resp.last_modified = self.last_modified
+        resp.vary = ('Accept-Encoding',)
+        if self.etag in req.if_none_match or \
+                (not req.if_none_match and req.if_modified_since and
+                 calendar.timegm(req.if_modified_since.utctimetuple()) >=
+                 self.last_modified):
+            resp.status_int = 304
+            return resp
+        # without an Accept-Encoding header the client may not understand
+        # gzip, although webob treats it as accepting any encoding
+        if self.gzipped and 'Accept-Encoding' in req.headers and \
+                req.accept_encoding.best_match(['gzip', 'identity']) == 'gzip':
+            resp.content_encoding = 'gzip'
+            resp.body = self.gzipped
+        else:
+            resp.body = self.body
+        return resp
+
+
+class BuildIndex(object):
+    """The most recent builds for each tree, platform and buildtype, with
+       the fields in RECORD_FIELDS, and indexes from each tree, platform and
+       buildtype to the keys which have it.
+    """
+
+    RECORD_FIELDS = ('buildurl', 'revision', 'builddate', 'testsurl')
+    KEY_FIELDS = ('tree', 'platform', 'buildtype')
+
+    def __init__(self, history=10):
+        self.history = history
+        # (tree, platform, buildtype) -> deque of records, newest first
+        self.records = {}
+        self.keysBy = dict((field, defaultdict(set))
+                           for field in self.KEY_FIELDS)
+
+    def add(self, builddata):
+        key = tuple(builddata[field] for field in self.KEY_FIELDS)
+        record = dict((field, builddata.get(field))
+                      for field in self.RECORD_FIELDS)
+        if key not in self.records:
+            self.records[key] = deque(maxlen=self.history)
+            for field, value in zip(self.KEY_FIELDS, key):
+                self.keysBy[field][value].add(key)
+        self.records[key].appendleft(record)
+
+    def get_state(self):
+        """Returns the index as a JSON-serializable list."""
+        return [list(key) + [list(records)]
+                for key, records in self.records.iteritems()]
+
+    def set_state(self, state):
+        for tree, platform, buildtype, records in state:
+            key = {'tree': tree, 'platform': platform, 'buildtype': buildtype}
+            for record in reversed(records):
+                record.update(key)
+                self.add(record)
+
+    def keys(self, tree=None, platform=None, buildtype=None):
+        """Returns the keys matching the given values; None matches any."""
+        keys = None
+        for field, value in zip(self.KEY_FIELDS, (tree, platform, buildtype)):
+            if value is None:
+                continue
+            matching = self.keysBy[field].get(value, frozenset())
+            keys = set(matching) if keys is None else keys & matching
+            if not keys:
+                break
+        if keys is None:
+            keys = self.records.keys()
+        return keys
+
+    def query(self, tree=None, platform=None, buildtype=None, history=None):
+        """Returns {tree: {platform: {buildtype: record}}} for the matching
+           keys.  If 'history' is given, each record is replaced by a list
+           of up to that many records, newest first.
+        """
+        result = {}
+        for key in self.keys(tree, platform, buildtype):
+            records = self.records[key]
+            if history:
+                value = list(records)[:history]
+            else:
+                value = records[0]
+            result.setdefault(key[0], {}).setdefault(key[1], {})[key[2]] = value
+        return result
+
+
+class QuietHandler(WSGIRequestHandler):
+    """Custom WSGIRequestHandler class that doesn't do any logging.
+    """
+    def log_request(*args, **kw):
+        pass
+    def log_error(*args, **kw):
+        pass
+    def log_message(*args, **kw):
+        pass
+
+
+class PreforkWSGIServer(SocketServer.ThreadingMixIn, WSGIServer):
+    """A WSGIServer which accepts connections on a listening socket it
+       shares with other processes, and handles each on a new thread, so
+       that a slow client doesn't hold up the others.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, sock, app):
+        self.listener = sock
+        WSGIServer.__init__(self, sock.getsockname(), QuietHandler)
+        self.set_app(app)
+
+    def server_bind(self):
+        self.socket.close()
+        self.socket = self.listener
+        self.server_address = self.socket.getsockname()
+        host, port = self.server_address[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+
+    def server_activate(self):
+        # the socket is already listening
+        pass
+
+
+class BuildApp(object):
+    """The WSGI application which serves the latest builds from 'index',
+       a BuildIndex, and 'snapshot', the CachedResponse of the legacy
+       {tree: {platform: {buildtype: buildurl}}} document.
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    # the number of distinct queries whose responses are cached
+    QUERY_CACHE_SIZE = 1000
+
+    def refresh(self):
+        """Called before each request; subclasses may update the index."""
+        pass
+
+    @abc.abstractmethod
+    def metrics_body(self):
+        """Returns the text served from /metrics."""
+
+    @abc.abstractmethod
+    def stats_body(self):
+        """Returns the JSON served from /stats."""
 
     def __call__(self, environ, start_response):
+        self.refresh()
         req = Request(environ)
         if req.url.find('README') > -1:
           readme = os.path.join(os.path.dirname(__file__), 'README.html')
           resp = Response(content_type='text/html')
           resp.body = open(readme, 'r').read()
+        elif req.path_info.rstrip('/') == '/metrics':
+          resp = Response(body=self.metrics_body())
+          resp.headers['Content-Type'] = 'text/plain; version=0.0.4'
+          resp.cache_control = 'no-cache'
+        elif req.path_info.rstrip('/') == '/stats':
+          resp = Response(body=self.stats_body(),
+                          content_type='application/json')
+          resp.cache_control = 'no-cache'
+        elif req.path_info.strip('/') or req.GET:
+          resp = self.query_response(req)
         else:
-          resp = Response(content_type='application/json')
-          resp.status_int = 200
-          resp.body = json.dumps(self.builds)
+          resp = self.snapshot.response(req)
         return resp(environ, start_response)
 
+    def query_response(self, req):
+        """Answer /tree[/platform[/buildtype]] and ?tree=&platform=
+           &buildtype=&history= requests from the index.
+        """
+        path = tuple(x for x in req.path_info.split('/') if x)
+        params = dict((field, req.GET.get(field))
+                      for field in BuildIndex.KEY_FIELDS + ('history',))
+        cacheKey = (path, tuple(sorted(params.items())))
+        cached = self.queryCache.get(cacheKey)
+        if cached:
+            return cached.response(req)
+
+        if len(path) > len(BuildIndex.KEY_FIELDS):
+            return Response(status=404)
+        for field, value in zip(BuildIndex.KEY_FIELDS, path):
+            params[field] = value
+        try:
+            history = int(params.pop('history') or 0)
+        except ValueError:
+            return Response(status=400)
+
+        self.lock.acquire()
+        try:
+            result = self.index.query(history=history, **params)
+            # the cache which belongs to this index; a rebuild replaces
+            # both, and the result mustn't go into the new one
+            cache = self.queryCache
+        finally:
+            self.lock.release()
+
+        # a path names what the client wants; return just that part, and
+        # a 404 if we haven't seen it
+        for value in path:
+            if value not in result:
+                return Response(status=404)
+            result = result[value]
+
+        cached = CachedResponse(json.dumps(result))
+        if len(cache) >= self.QUERY_CACHE_SIZE:
+            cache.clear()
+        cache[cacheKey] = cached
+        return cached.response(req)
+
+
+class SnapshotApp(BuildApp):
+    """Serves the snapshot which a LatestBuildMonitor publishes to 'path'
+       for its HTTP worker processes, reloading it whenever it is
+       replaced.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index = BuildIndex()
+        self.snapshot = CachedResponse('{}')
+        self.queryCache = {}
+        self.lock = threading.RLock()
+        self.loaded = None
+
+    def version(self, st):
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def refresh(self):
+        try:
+            if self.version(os.stat(self.path)) == self.loaded:
+                return
+        except OSError:
+            return
+        self.lock.acquire()
+        try:
+            # the file may be replaced again while we read it, so the
+            # version is taken from the file we opened
+            f = open(self.path, 'rb')
+            try:
+                version = self.version(os.fstat(f.fileno()))
+                if version == self.loaded:
+                    return
+                header = json.loads(f.readline())
+                body = f.readline()[:-1]
+                state = json.loads(f.readline())
+            finally:
+                f.close()
+            index = BuildIndex(header['history'])
+            index.set_state(state)
+            self.index = index
+            self.snapshot = CachedResponse(body,
+                                           last_modified=header['time'])
+            self.queryCache = {}
+            self.loaded = version
+        finally:
+            self.lock.release()
+
+    def read_published(self, suffix, default):
+        try:
+            f = open(self.path + suffix, 'rb')
+        except IOError:
+            return default
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def metrics_body(self):
+        return self.read_published('.metrics', '')
+
+    def stats_body(self):
+        return self.read_published('.stats', '{}')
+
+
+def serve_snapshot(sock, path):
+    """Run in each HTTP worker process: serve the snapshot at 'path' on
+       the listening socket 'sock' until terminated.
+    """
+    # workers are forked with the parent's signal handlers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    PreforkWSGIServer(sock, SnapshotApp(path)).serve_forever()
+
+
+class LatestBuildMonitor(BuildApp):
+
+    # how often the metrics and stats are published for HTTP workers, in
+    # seconds
+    METRICS_INTERVAL = 5.0
+
+    def __init__(self, port=8034, logger=None, debounce=1.0, history=10,
+                 stream_port=None, statedir=None, http_workers=0,
+                 snapshot_path=None):
+        self.builds = defaultdict(lambda: defaultdict(dict))
+        self.index = BuildIndex(history)
+        self.queryCache = {}
+        self.port = port
+        # if set, requests are served by this many worker processes, from
+        # a snapshot which is published to 'snapshot_path' whenever the
+        # builds change
+        self.http_workers = http_workers
+        self.snapshot_path = snapshot_path
+        if http_workers and not snapshot_path:
+            self.snapshot_path = os.path.join(statedir or tempfile.mkdtemp(),
+                                              'latest.snapshot')
+        self.httpWorkers = []
+        # builds are pushed to /events and /poll clients on this port
+        self.stream_port = stream_port or port + 1
+        self.stream = None
+        # the builds are journaled to this directory, and reloaded from it
+        # on startup
+        self.journal = None
+        if statedir:
+            self.journal = StateJournal(statedir, logger=logger)
+        self.logger = logger
+        # the serialized form of self.builds is rebuilt at most once every
+        # 'debounce' seconds, rather than on every request
+        self.debounce = debounce
+        self.lock = threading.RLock()
+        self.dirty = False
+        self.lastRebuild = 0
+        self.rebuildTimer = None
+        self.snapshot = CachedResponse(json.dumps(self.builds))
+        # shared with the pulse monitor, and served from /metrics
+        self.metrics = MetricsRegistry()
+        self.buildCount = self.metrics.counter(
+            'latestbuild_builds_total', 'Builds recorded')
+        self.metrics.gauge('latestbuild_builds_indexed',
+                           'Tree, platform and buildtype combinations known',
+                           function=lambda: len(self.index.records))
+        self.metrics.counter('latestbuild_slow_stream_clients_total',
+                             'Stream clients dropped for reading too slowly',
+                             function=lambda: self.stream and
+                                              self.stream.slow_clients or 0)
+        # rolling build and test rates, lags and gaps, served from /stats
+        self.stats = BuildStats()
+        if self.journal:
+            self.load_state()
+
+    def load_state(self):
+        state, records = self.journal.load()
+        self.lock.acquire()
+        try:
+            if state:
+                self.index.set_state(state)
+                for key in self.index.records:
+                    self.record_legacy(key, self.index.records[key][0])
+            for builddata in records:
+                self.record_build(builddata)
+            self.changed()
+        finally:
+            self.lock.release()
+        if self.logger:
+            self.logger.info('loaded %d builds and %d journaled builds' %
+                             (len(state or ()), len(records)))
+
+    def rebuild_snapshot(self):
+        """Serialize self.builds and replace the snapshot that requests
+           are served from.
+        """
+        self.lock.acquire()
+        try:
+            self.rebuildTimer = None
+            if not self.dirty:
+                return
+            self.dirty = False
+            self.lastRebuild = time.time()
+            # swapped in under the lock, so that an older snapshot can't
+            # replace a newer one
+            self.snapshot = CachedResponse(json.dumps(self.builds))
+            self.queryCache = {}
+            if self.http_workers:
+                self.publish_snapshot()
+        finally:
+            self.lock.release()
+
+    def publish_snapshot(self):
+        """Write the snapshot and the index to snapshot_path for the HTTP
+           workers, replacing the file atomically so that they never see
+           part of one; self.lock must be held.  The file holds three
+           lines: a JSON header, the snapshot's body, and the index state.
+        """
+        header = {'time': self.snapshot.last_modified,
+                  'history': self.index.history}
+        state = json.dumps(self.index.get_state())
+        self.write_atomically(self.snapshot_path, '%s\n%s\n%s\n' %
+                              (json.dumps(header), self.snapshot.body, state))
+
+    def write_atomically(self, path, data):
+        tmp = path + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+
+    def publish_metrics(self):
+        while True:
+            try:
+                self.write_atomically(self.snapshot_path + '.metrics',
+                                      self.metrics.render())
+                self.write_atomically(self.snapshot_path + '.stats',
+                                      self.stats_body())
+            except (IOError, OSError), e:
+                if self.logger:
+                    self.logger.exception(e)
+            time.sleep(self.METRICS_INTERVAL)
+
+    def metrics_body(self):
+        return self.metrics.render()
+
+    def stats_body(self):
+        return json.dumps(self.stats.snapshot())
+
+    def changed(self):
+        """Called, with self.lock held, whenever self.builds changes."""
+        self.dirty = True
+        wait = self.lastRebuild + self.debounce - time.time()
+        if wait <= 0:
+            self.rebuild_snapshot()
+        elif not self.rebuildTimer:
+            self.rebuildTimer = threading.Timer(wait, self.rebuild_snapshot)
+            self.rebuildTimer.daemon = True
+            self.rebuildTimer.start()
+
     def buildCallback(self, builddata):
         #print '========================================================='
         #print 'buildCallback'
         #print json.dumps(builddata, indent=2)
         #print '========================================================='
-        self.builds[builddata['tree']][builddata['platform']].update({builddata['buildtype']:  builddata['buildurl']})
+        record = dict((field, builddata.get(field)) for field in
+                      BuildIndex.KEY_FIELDS + BuildIndex.RECORD_FIELDS)
+        self.buildCount.inc()
+        self.lock.acquire()
+        try:
+            self.record_build(record)
+            if self.journal:
+                self.journal.append(record)
+                if self.journal.needs_compaction:
+                    self.journal.compact(self.index.get_state())
+            self.changed()
+        finally:
+            self.lock.release()
+        if self.stream:
+            record['kind'] = 'build'
+            self.stream.publish(record)
         if not builddata['buildurl']:
           if self.logger:
             self.logger.error('no buildurl:\n%s' % json.dumps(builddata, indent=2))
 
+    def record_legacy(self, key, record):
+        tree, platform, buildtype = key
+        self.builds[tree][platform].update({buildtype: record['buildurl']})
+
+    def record_build(self, record):
+        """Add a build to self.builds and the index; self.lock must be held.
+        """
+        self.record_legacy(tuple(record[field] for field in BuildIndex.KEY_FIELDS),
+                           record)
+        self.index.add(record)
+
     def testCallback(self, builddata):
         if False:
             print '========================================================='
@@ -47,29 +519,97 @@ class LatestBuildMonitor(object):
         key = data['_meta']['routing_key']
 
     def start(self):
+        if self.http_workers:
+            # the workers are forked before any of our threads start
+            sock = self.listen()
+            self.lock.acquire()
+            try:
+                self.publish_snapshot()
+            finally:
+                self.lock.release()
+            for i in xrange(self.http_workers):
+                self.httpWorkers.append(self.start_http_worker(sock))
+
         monitor = start_pulse_monitor(buildCallback=self.buildCallback,
                                       testCallback=self.testCallback,
                                       pulseCallback=self.pulseCallback,
-                                      trees=None)
-
-        from wsgiref.simple_server import make_server, WSGIRequestHandler
+                                      trees=None,
+                                      talos=True,
+                                      metrics=self.metrics,
+                                      sinks=[self.stats])
 
-        class QuietHandler(WSGIRequestHandler):
-          """Custom WSGIRequestHandler class that doesn't do any logging.
-          """
-          def log_request(*args, **kw):
-            pass
-          def log_error(*args, **kw):
-            pass
-          def log_message(*args, **kw):
-            pass
+        self.stream = EventStreamServer('127.0.0.1', self.stream_port)
+        self.stream.start()
 
-        httpd = make_server('127.0.0.1', self.port, self, handler_class=QuietHandler)
         if self.logger:
           self.logger.info('Serving on http://127.0.0.1:%s' % self.port)
+          self.logger.info('Streaming on http://127.0.0.1:%s' % self.stream_port)
         else:
           print 'Serving on http://127.0.0.1:%s' % self.port
-        httpd.serve_forever()
+          print 'Streaming on http://127.0.0.1:%s' % self.stream_port
+
+        def terminate(signum, frame):
+            raise SystemExit(0)
+        signal.signal(signal.SIGTERM, terminate)
+
+        try:
+            if self.http_workers:
+                self.supervise_http_workers(sock)
+            else:
+                httpd = make_server('127.0.0.1', self.port, self,
+                                    handler_class=QuietHandler)
+                httpd.serve_forever()
+        finally:
+            # write out the builds journaled since the last sync
+            if self.journal:
+                self.journal.close()
+
+    def listen(self):
+        """Returns a socket listening on our port, for the HTTP workers to
+           share.  It is non-blocking, so that the workers which don't
+           win a connection go back to waiting for the next one.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('127.0.0.1', self.port))
+        sock.listen(128)
+        sock.setblocking(0)
+        return sock
+
+    def start_http_worker(self, sock):
+        worker = multiprocessing.Process(target=serve_snapshot,
+                                         args=(sock, self.snapshot_path),
+                                         name='latestbuild-http')
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def supervise_http_workers(self, sock, interval=1.0):
+        """Restart HTTP workers which exit, and publish our metrics and
+           stats for them, until we receive SIGTERM or SIGINT; the workers are then
+           terminated.
+        """
+        publisher = threading.Thread(target=self.publish_metrics)
+        publisher.daemon = True
+        publisher.start()
+        try:
+            while True:
+                time.sleep(interval)
+                for i, worker in enumerate(self.httpWorkers):
+                    if worker.is_alive():
+                        continue
+                    worker.join()
+                    if self.logger:
+                        self.logger.error('HTTP worker %d exited with '
+                                          'status %s; restarting' %
+                                          (worker.pid, worker.exitcode))
+                    self.httpWorkers[i] = self.start_http_worker(sock)
+        finally:
+            for worker in self.httpWorkers:
+                if worker.is_alive():
+                    worker.terminate()
+            for worker in self.httpWorkers:
+                worker.join()
 
 
 def main():
@@ -78,6 +618,18 @@ def main():
     parser.add_option('-p', '--port', default='8034',
                     dest='port', type='int',
                     help='Port to serve on')
+    parser.add_option('--stream-port', dest='stream_port', type='int',
+                    help='Port to stream build events on (default: port + 1)')
+    parser.add_option('--statedir', dest='statedir',
+                    help='directory in which to persist the latest builds')
+    parser.add_option('--http-workers', dest='http_workers', type='int',
+                    default=0,
+                    help='number of processes to serve HTTP requests with '
+                         '(default: serve them from the pulse process)')
+    parser.add_option('--snapshot', dest='snapshot_path',
+                    help='file through which builds are published to the '
+                         'HTTP workers (default: in the statedir, or a '
+                         'temporary directory)')
     parser.add_option('--pidfile', dest='pidfile',
                     help='path to file for logging pid')
     parser.add_option('--logfile', dest='logfile',
@@ -86,6 +638,12 @@ def main():
                     help='run as daemon')
     options, args = parser.parse_args()
 
+    # the daemon's working directory is /
+    if options.statedir:
+        options.statedir = os.path.abspath(options.statedir)
+    if options.snapshot_path:
+        options.snapshot_path = os.path.abspath(options.snapshot_path)
+
     if options.daemon:
         createDaemon(options.pidfile, options.logfile)
 
@@ -101,7 +659,11 @@ def main():
         fp.write("%d\n" % os.getpid())
         fp.close()
 
-    monitor = LatestBuildMonitor(logger=logger)
+    monitor = LatestBuildMonitor(port=options.port, logger=logger,
+                                 stream_port=options.stream_port,
+                                 statedir=options.statedir,
+                                 http_workers=options.http_workers,
+                                 snapshot_path=options.snapshot_path)
     monitor.start()
 
 
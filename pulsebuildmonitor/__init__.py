@@ -37,6 +37,24 @@
 
 from pulsebuildmonitor import *
 from factory import *
+from dispatcher import *
+from acks import *
+from filters import *
+from hub import *
+from asyncmonitor import *
+from events import *
+from stream import *
+from journal import *
+from replay import *
 from daemon import *
-
-
+from metrics import *
+from coalesce import *
+from batching import *
+from supervisor import *
+from transports import *
+from lazy import *
+from shedding import *
+from archive import *
+from aggregate import *
+from forward import *
+from stats import *
@@ -0,0 +1,233 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+from collections import deque
+import threading
+import time
+
+
+IMMEDIATE = 'immediate'
+BATCH = 'batch'
+AFTER_CALLBACK = 'after-callback'
+
+ACK_MODES = (IMMEDIATE, BATCH, AFTER_CALLBACK)
+
+
+class PendingAck(object):
+    """Tracks the outstanding work for one received message.  The message
+       is settled once every holder has called release(); it is acked if
+       they all succeeded and requeued otherwise.
+    """
+
+    def __init__(self, acknowledger, message):
+        self.acknowledger = acknowledger
+        self.message = message
+        self.holders = 1
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def hold(self):
+        """Register one more piece of work that must finish before the
+           message is settled, and return the function it should call,
+           with True or False, when it does.
+        """
+        self.lock.acquire()
+        try:
+            self.holders += 1
+        finally:
+            self.lock.release()
+        return self.release
+
+    def release(self, success=True):
+        self.lock.acquire()
+        try:
+            if not success:
+                self.failed = True
+            self.holders -= 1
+            if self.holders:
+                return
+        finally:
+            self.lock.release()
+        self.acknowledger.settle(self, not self.failed)
+
+
+class MessageAcknowledger(object):
+    """Decides when received messages are acknowledged.
+
+       mode           - 'immediate' acks each message as soon as it is
+                        received, before any processing (the default).
+                        'batch' also considers messages handled on receipt,
+                        but sends one multiple-ack for up to 'batch_size'
+                        messages.  'after-callback' acks a message only
+                        once every callback it was passed to has returned
+                        without raising, and requeues it otherwise; this
+                        gives at-least-once delivery on a durable queue.
+       prefetch       - if set, the maximum number of unacknowledged
+                        messages the broker will deliver to us.  The
+                        monitor's transport applies it before it starts
+                        consuming, through bind().
+       batch_size     - the number of settled messages to accumulate
+                        before acking them, in the 'batch' and
+                        'after-callback' modes
+       batch_interval - the maximum number of seconds a settled message
+                        waits to be acked
+
+       The channel may only be used by the thread consuming from it, so
+       messages settled on other threads are queued, and acked or
+       requeued by drain(), which the transport calls on the consumer
+       thread whenever a message is received and while it waits for one.
+    """
+
+    def __init__(self, mode=IMMEDIATE, prefetch=None, batch_size=100,
+                 batch_interval=1.0):
+        if mode not in ACK_MODES:
+            raise ValueError('unknown ack mode: %s' % mode)
+        self.mode = mode
+        self.prefetch = prefetch
+        self.prefetchChanged = False
+        self.applyPrefetch = None
+        self.max_batch_size = max(1, batch_size)
+        self.batch_size = self.batch_size_for(prefetch)
+        self.batch_interval = batch_interval
+        self.lock = threading.Lock()
+        self.channel = None
+        # [message, settled] pairs in delivery order, for messages we've
+        # received but not yet acknowledged; only used by the consumer
+        # thread
+        self.outstanding = deque()
+        self.entries = {}
+        self.settled = 0
+        self.lastFlush = time.time()
+        # (message, success) for each message settled since the last
+        # drain(), appended by any thread
+        self.settledQueue = deque()
+
+    @property
+    def waits_for_callbacks(self):
+        return self.mode == AFTER_CALLBACK
+
+    def batch_size_for(self, prefetch):
+        # the broker stops delivering once 'prefetch' messages are
+        # unacked, so a larger batch would never fill
+        if prefetch:
+            return min(self.max_batch_size, prefetch)
+        return self.max_batch_size
+
+    def bind(self, apply_prefetch):
+        """Called by the monitor with its transport's set_prefetch(),
+           which is called with the prefetch limit now, if there is one,
+           and on the consumer thread whenever it changes.
+        """
+        self.applyPrefetch = apply_prefetch
+        if self.prefetch:
+            apply_prefetch(self.prefetch)
+
+    def received(self, message):
+        """Called by the consumer thread for each message, before it is
+           processed.  Returns a PendingAck for the message.
+        """
+        pending = PendingAck(self, message)
+        if self.mode == IMMEDIATE:
+            message.ack()
+            if self.prefetchChanged:
+                self.drain()
+            return pending
+
+        channel = getattr(message, 'channel', None)
+        if channel is not self.channel:
+            # a new connection; anything still unacked on the old channel
+            # will be redelivered by the broker
+            self.channel = channel
+            self.outstanding.clear()
+            self.entries.clear()
+            self.settled = 0
+        entry = [message, False]
+        self.outstanding.append(entry)
+        self.entries[id(message)] = entry
+        if self.mode == BATCH:
+            self.mark_settled(message)
+        self.drain()
+        return pending
+
+    def set_prefetch(self, prefetch):
+        """Change the prefetch limit, on any thread.  The next drain()
+           passes it to the transport.
+        """
+        self.lock.acquire()
+        try:
+            if prefetch != self.prefetch:
+                self.prefetch = prefetch
+                self.prefetchChanged = True
+        finally:
+            self.lock.release()
+
+    def settle(self, pending, success):
+        """Called, on any thread, once all the work for a message has
+           finished.
+        """
+        if self.mode == AFTER_CALLBACK:
+            self.settledQueue.append((pending.message, success))
+
+    def drain(self):
+        """Called on the consumer thread to pass any change of prefetch to
+           the transport, requeue the messages whose callbacks failed, and
+           ack the settled messages once 'batch_size' are waiting or
+           'batch_interval' has passed.
+        """
+        if self.prefetchChanged:
+            self.lock.acquire()
+            try:
+                prefetch = self.prefetch
+                self.prefetchChanged = False
+            finally:
+                self.lock.release()
+            self.batch_size = self.batch_size_for(prefetch)
+            if self.applyPrefetch:
+                self.applyPrefetch(prefetch)
+
+        settledQueue = self.settledQueue
+        while settledQueue:
+            message, success = settledQueue.popleft()
+            if id(message) not in self.entries:
+                # received on a channel which has since been replaced
+                continue
+            if not success:
+                message.requeue()
+            self.mark_settled(message)
+
+        if self.settled and \
+                (self.settled >= self.batch_size or
+                 time.time() - self.lastFlush >= self.batch_interval):
+            self.flush()
+
+    def mark_settled(self, message):
+        entry = self.entries.get(id(message))
+        if entry and not entry[1]:
+            entry[1] = True
+            self.settled += 1
+
+    def flush(self):
+        """Acknowledge every settled message that precedes the first
+           unsettled one.  Called on the consumer thread.
+        """
+        self.lastFlush = time.time()
+        acked = []
+        while self.outstanding and self.outstanding[0][1]:
+            message = self.outstanding.popleft()[0]
+            del self.entries[id(message)]
+            acked.append(message)
+            self.settled -= 1
+        # requeued messages have already been settled with the broker
+        acked = [m for m in acked if not getattr(m, 'acknowledged', False)]
+        if not acked:
+            return
+        last = acked[-1]
+        if getattr(last, 'delivery_tag', None) is not None and \
+                self.channel is not None:
+            # this acks every earlier message on the channel as well
+            self.channel.basic_ack(last.delivery_tag, multiple=True)
+        else:
+            for message in acked:
+                message.ack()
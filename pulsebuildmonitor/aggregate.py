@@ -0,0 +1,165 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class RevisionSummary(object):
+    """What has been seen for one revision on one tree: the number of
+       build events for each (platform, buildtype), the number of test
+       events for each (platform, buildtype, test), and the number of
+       unittest and talos events.
+    """
+
+    __slots__ = ('tree', 'revision', 'builds', 'tests', 'unittests', 'talos',
+                 'first_seen', 'last_seen')
+
+    def __init__(self, tree, revision, now):
+        self.tree = tree
+        self.revision = revision
+        self.builds = {}
+        self.tests = {}
+        self.unittests = 0
+        self.talos = 0
+        self.first_seen = now
+        self.last_seen = now
+
+    def as_dict(self):
+        """Return the summary in a form which can be serialized as JSON."""
+        return {'tree': self.tree,
+                'revision': self.revision,
+                'builds': [{'platform': platform, 'buildtype': buildtype,
+                            'count': count}
+                           for (platform, buildtype), count
+                           in sorted(self.builds.iteritems())],
+                'tests': [{'platform': platform, 'buildtype': buildtype,
+                           'test': test, 'count': count}
+                          for (platform, buildtype, test), count
+                          in sorted(self.tests.iteritems())],
+                'unittests': self.unittests,
+                'talos': self.talos,
+                'first_seen': self.first_seen,
+                'last_seen': self.last_seen}
+
+
+class RevisionAggregator(object):
+    """A sink which groups build and test events by tree and revision as
+       they arrive, so that the status of a push is always up to date
+       rather than regrouped from every event when it is needed.
+
+       For each event, callback(delta) is called with a dict describing
+       the change to its revision's summary:
+
+         tree, revision - the revision
+         kind           - 'build', 'unittest' or 'talos'
+         platform, buildtype, test - the event's build or test; test is
+                          None for builds
+         count          - the number of events seen for this build or test
+         new            - True if this build or test hadn't been seen
+         builds, tests  - the number of distinct builds and tests seen
+         unittests, talos - the number of unittest and talos events
+
+       The callback is called on the monitor thread, or submitted to
+       'dispatcher', a CallbackDispatcher, if one is given.  The
+       'maxsize' revisions updated most recently are kept, and those not
+       updated for 'max_age' seconds are forgotten.
+    """
+
+    def __init__(self, callback=None, maxsize=1000, max_age=86400,
+                 dispatcher=None):
+        self.callback = callback
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.dispatcher = dispatcher
+        # (tree, revision) -> RevisionSummary, least recently updated first
+        self.revisions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, kind, event):
+        revision = event.get('revision')
+        if revision is None:
+            return
+        tree = event.get('tree')
+        platform = event.get('platform')
+        buildtype = event.get('buildtype')
+        now = time.time()
+
+        self.lock.acquire()
+        try:
+            key = (tree, revision)
+            summary = self.revisions.pop(key, None)
+            if summary is None:
+                summary = RevisionSummary(tree, revision, now)
+            self.revisions[key] = summary
+            summary.last_seen = now
+
+            if kind == 'build':
+                test = None
+                counts, item = summary.builds, (platform, buildtype)
+            else:
+                test = event.get('test')
+                counts, item = summary.tests, (platform, buildtype, test)
+                if kind == 'talos':
+                    summary.talos += 1
+                else:
+                    summary.unittests += 1
+            count = counts[item] = counts.get(item, 0) + 1
+
+            delta = {'tree': tree, 'revision': revision, 'kind': kind,
+                     'platform': platform, 'buildtype': buildtype,
+                     'test': test, 'count': count, 'new': count == 1,
+                     'builds': len(summary.builds),
+                     'tests': len(summary.tests),
+                     'unittests': summary.unittests, 'talos': summary.talos}
+            self.evict(now)
+        finally:
+            self.lock.release()
+
+        if self.callback:
+            if self.dispatcher:
+                self.dispatcher.submit(self.callback, delta)
+            else:
+                self.callback(delta)
+
+    def evict(self, now):
+        """Forget the revisions beyond maxsize or older than max_age; lock
+           must be held.
+        """
+        while len(self.revisions) > self.maxsize:
+            self.revisions.popitem(last=False)
+        if self.max_age:
+            while self.revisions:
+                key = next(iter(self.revisions))
+                if now - self.revisions[key].last_seen < self.max_age:
+                    break
+                del self.revisions[key]
+
+    def summary(self, tree, revision):
+        """Returns the summary of 'revision' on 'tree' as a dict, or None
+           if it hasn't been seen or has been forgotten.
+        """
+        self.lock.acquire()
+        try:
+            summary = self.revisions.get((tree, revision))
+            return summary and summary.as_dict()
+        finally:
+            self.lock.release()
+
+    def summaries(self, tree=None):
+        """Returns the summaries of the revisions we know of, on 'tree' if
+           given, most recently updated first.
+        """
+        self.lock.acquire()
+        try:
+            return [summary.as_dict()
+                    for summary in reversed(self.revisions.values())
+                    if tree is None or summary.tree == tree]
+        finally:
+            self.lock.release()
+
+    def close(self):
+        pass
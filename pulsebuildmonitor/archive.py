@@ -0,0 +1,604 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import abc
+from array import array
+import bisect
+import glob
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+try:
+    import json
+except:
+    import simplejson as json
+
+
+# the payload fields which are indexed by value; builddate is indexed as a
+# range
+INDEXED_FIELDS = ('revision', 'tree', 'platform', 'buildtype')
+
+# index files hold arrays of native unsigned 32-bit ints
+_UINT = 'I'
+assert(array(_UINT).itemsize == 4)
+
+_INDEX_MAGIC = 0x50424d41
+_INDEX_VERSION = 1
+_INDEX_HEADER = 8
+
+# each block in a data file is its compressed length and number of
+# records, followed by the records, one JSON [kind, payload] per line
+_BLOCK_HEADER = struct.Struct('<II')
+
+
+def value_hash(value):
+    """The key under which a field's value is indexed.  Different values
+       may share a key, so records found through the index are checked
+       against the query.
+    """
+    if value is None:
+        value = ''
+    elif not isinstance(value, basestring):
+        value = str(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return zlib.crc32(value) & 0xffffffff
+
+
+def index_date(builddate):
+    """Returns 'builddate' if it can be indexed, or None."""
+    if isinstance(builddate, (int, long)) and 0 <= builddate < 2 ** 32:
+        return builddate
+    return None
+
+
+class MappedArray(object):
+    """A read-only sequence of 'count' unsigned ints at 'offset' in a
+       buffer, such as an mmap; it can be searched with the bisect module
+       without copying it.
+    """
+
+    __slots__ = ('buf', 'offset', 'count')
+
+    def __init__(self, buf, offset, count):
+        self.buf = buf
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return struct.unpack_from(_UINT, self.buf, self.offset + 4 * i)[0]
+
+    def slice(self, start, stop):
+        values = array(_UINT)
+        values.fromstring(self.buf[self.offset + 4 * start:
+                                   self.offset + 4 * stop])
+        return values
+
+
+class Segment(object):
+    """One data file of the archive, and its indexes."""
+
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, number, path):
+        self.number = number
+        self.path = path
+        self.count = 0
+        self.mindate = None
+        self.maxdate = None
+
+    @abc.abstractmethod
+    def lookup(self, field, value):
+        """Returns the ids of the records whose 'field' may be 'value'."""
+
+    @abc.abstractmethod
+    def lookup_dates(self, since, until):
+        """Returns the ids of the records with since <= builddate < until."""
+
+    def block_for(self, id):
+        """Returns the number of the block holding record 'id', and the
+           id of its first record.
+        """
+        b = bisect.bisect_right(self.blockFirst, id) - 1
+        return b, self.blockFirst[b]
+
+    @abc.abstractmethod
+    def read_block(self, b):
+        """Returns the lines of block 'b', one JSON record each."""
+
+    def candidates(self, criteria, since, until):
+        """Returns the sorted ids of the records which may match, or None
+           if every record may.
+        """
+        if since is not None or until is not None:
+            if self.mindate is None:
+                return []
+            if (since is not None and self.maxdate < since) or \
+                    (until is not None and self.mindate >= until):
+                return []
+        lists = [self.lookup(field, value)
+                 for field, value in criteria.iteritems()]
+        if since is not None or until is not None:
+            lists.append(self.lookup_dates(since, until))
+        if not lists:
+            return None
+        lists.sort(key=len)
+        ids = set(lists[0])
+        for other in lists[1:]:
+            if not ids:
+                break
+            # a much longer list would cost more to load than checking the
+            # records it would eliminate
+            if len(other) > 16 * len(ids):
+                break
+            ids.intersection_update(other)
+        return sorted(ids)
+
+    def read(self, ids):
+        """Yields (kind, payload) for the records 'ids', in order, or for
+           every record if 'ids' is None.
+        """
+        if ids is None:
+            ids = xrange(self.count)
+        block = None
+        for id in ids:
+            b, first = self.block_for(id)
+            if b != block:
+                records = self.read_block(b)
+                block = b
+            yield json.loads(records[id - first])
+
+
+class SealedSegment(Segment):
+    """A complete segment, whose data and index files are memory-mapped,
+       so that only the parts a query touches are read.
+    """
+
+    def __init__(self, number, path):
+        Segment.__init__(self, number, path)
+        self.data = self.map(path + '.dat')
+        self.index = self.map(path + '.idx')
+        header = MappedArray(self.index, 0, _INDEX_HEADER)
+        if len(self.index) < 4 * _INDEX_HEADER or \
+                header[0] != _INDEX_MAGIC or header[1] != _INDEX_VERSION:
+            raise ValueError('bad index: %s.idx' % path)
+        self.count, nblocks, ndates, mindate, maxdate = \
+            [header[i] for i in xrange(2, 7)]
+        if ndates:
+            self.mindate, self.maxdate = mindate, maxdate
+
+        offset = 4 * _INDEX_HEADER
+        self.blockFirst = MappedArray(self.index, offset, nblocks)
+        offset += 4 * nblocks
+        self.blockOffset = MappedArray(self.index, offset, nblocks)
+        offset += 4 * nblocks
+        self.keys = {}
+        for field in INDEXED_FIELDS:
+            self.keys[field] = (MappedArray(self.index, offset, self.count),
+                                MappedArray(self.index,
+                                            offset + 4 * self.count,
+                                            self.count))
+            offset += 8 * self.count
+        self.dates = (MappedArray(self.index, offset, ndates),
+                      MappedArray(self.index, offset + 4 * ndates, ndates))
+        if len(self.index) < offset + 8 * ndates:
+            raise ValueError('truncated index: %s.idx' % path)
+
+    def map(self, path):
+        f = open(path, 'rb')
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+    def lookup(self, field, value):
+        keys, ids = self.keys[field]
+        key = value_hash(value)
+        return ids.slice(bisect.bisect_left(keys, key),
+                         bisect.bisect_right(keys, key))
+
+    def lookup_dates(self, since, until):
+        dates, ids = self.dates
+        start = 0 if since is None else bisect.bisect_left(dates, since)
+        stop = len(dates) if until is None else \
+            bisect.bisect_left(dates, until)
+        return ids.slice(start, stop)
+
+    def read_block(self, b):
+        offset = self.blockOffset[b]
+        length, count = _BLOCK_HEADER.unpack_from(self.data, offset)
+        start = offset + _BLOCK_HEADER.size
+        return zlib.decompress(self.data[start:start + length]).split('\n')
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+class ActiveSegment(Segment):
+    """The segment being appended to.  Its indexes are kept in memory
+       until it is sealed.
+    """
+
+    def __init__(self, number, path):
+        Segment.__init__(self, number, path)
+        self.size = 0
+        self.blockFirst = []
+        self.blockOffset = []
+        self.keys = dict((field, {}) for field in INDEXED_FIELDS)
+        # (builddate, id), kept sorted
+        self.dates = []
+        self.recover()
+        self.file = open(path + '.dat', 'ab+')
+
+    def recover(self):
+        """Index the records already in the data file, if there is one,
+           dropping a block torn by a crash.
+        """
+        try:
+            f = open(self.path + '.dat', 'rb+')
+        except IOError:
+            return
+        try:
+            while True:
+                header = f.read(_BLOCK_HEADER.size)
+                if len(header) < _BLOCK_HEADER.size:
+                    break
+                length, count = _BLOCK_HEADER.unpack(header)
+                try:
+                    lines = zlib.decompress(f.read(length)).split('\n')
+                except zlib.error:
+                    break
+                if len(lines) != count:
+                    break
+                entries = []
+                for line in lines:
+                    kind, payload = json.loads(line)
+                    entries.append(self.entry(payload))
+                self.index_block(self.size, entries)
+                self.size += _BLOCK_HEADER.size + length
+            f.truncate(self.size)
+        finally:
+            f.close()
+
+    @staticmethod
+    def entry(payload):
+        """The index keys of a payload: its field hashes and builddate."""
+        return ([value_hash(payload.get(field)) for field in INDEXED_FIELDS],
+                index_date(payload.get('builddate')))
+
+    def index_block(self, offset, entries):
+        self.blockFirst.append(self.count)
+        self.blockOffset.append(offset)
+        for hashes, builddate in entries:
+            id = self.count
+            for field, key in zip(INDEXED_FIELDS, hashes):
+                ids = self.keys[field].get(key)
+                if ids is None:
+                    ids = self.keys[field][key] = array(_UINT)
+                ids.append(id)
+            if builddate is not None:
+                bisect.insort(self.dates, (builddate, id))
+                if self.mindate is None or builddate < self.mindate:
+                    self.mindate = builddate
+                if self.maxdate is None or builddate > self.maxdate:
+                    self.maxdate = builddate
+            self.count += 1
+
+    def append(self, lines, entries):
+        """Write a block of records."""
+        data = zlib.compress('\n'.join(lines))
+        # queries move the file position
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(_BLOCK_HEADER.pack(len(data), len(lines)) + data)
+        self.file.flush()
+        offset = self.size
+        self.size += _BLOCK_HEADER.size + len(data)
+        self.index_block(offset, entries)
+
+    def lookup(self, field, value):
+        return self.keys[field].get(value_hash(value), ())
+
+    def lookup_dates(self, since, until):
+        start = 0 if since is None else \
+            bisect.bisect_left(self.dates, (since,))
+        stop = len(self.dates) if until is None else \
+            bisect.bisect_left(self.dates, (until,))
+        return [id for builddate, id in self.dates[start:stop]]
+
+    def read_block(self, b):
+        self.file.seek(self.blockOffset[b])
+        length, count = _BLOCK_HEADER.unpack(
+            self.file.read(_BLOCK_HEADER.size))
+        return zlib.decompress(self.file.read(length)).split('\n')
+
+    def seal(self):
+        """Write the segment's index file, and return it as a
+           SealedSegment.
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+        ndates = len(self.dates)
+        values = array(_UINT, [_INDEX_MAGIC, _INDEX_VERSION, self.count,
+                               len(self.blockFirst), ndates,
+                               self.mindate or 0, self.maxdate or 0, 0])
+        values.extend(self.blockFirst)
+        values.extend(self.blockOffset)
+        for field in INDEXED_FIELDS:
+            pairs = sorted((key, id) for key, ids in
+                           self.keys[field].iteritems() for id in ids)
+            values.extend(key for key, id in pairs)
+            values.extend(id for key, id in pairs)
+        values.extend(builddate for builddate, id in self.dates)
+        values.extend(id for builddate, id in self.dates)
+
+        tmp = self.path + '.idx.tmp'
+        f = open(tmp, 'wb')
+        try:
+            values.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp, self.path + '.idx')
+        return SealedSegment(self.number, self.path)
+
+    def close(self):
+        self.file.close()
+
+
+class EventArchive(object):
+    """A sink which keeps every event on disk, indexed so that they can be
+       queried by revision, tree, platform, buildtype and builddate.
+
+       Events are appended to numbered segments in 'directory', each
+       holding up to 'segment_size' events in blocks of up to 'block_size'
+       zlib-compressed records:
+
+         events.N.dat  - the blocks
+         events.N.idx  - written once the segment is full: sorted arrays
+                         mapping hashes of the indexed fields, and
+                         builddates, to records
+
+       Index and data files are memory-mapped when queried, so a query
+       reads only the index entries and blocks it needs.  Events are
+       written by a background thread at most 'flush_interval' seconds
+       after they are added, and become visible to queries then.  If
+       'max_segments' is set, the oldest segments are deleted to keep no
+       more than that number.
+    """
+
+    SEGMENT = 'events.%d'
+
+    def __init__(self, directory, segment_size=65536, block_size=128,
+                 flush_interval=2.0, max_segments=None, logger=None):
+        assert(segment_size > 0 and block_size > 0)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self.max_segments = max_segments
+        self.logger = logger
+        self.lock = threading.RLock()
+        self.cond = threading.Condition()
+        self.pending = []
+        self.writer = None
+        self.closed = False
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.sealed = []
+        self.active = None
+        self.open_segments()
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, self.SEGMENT % number)
+
+    def open_segments(self):
+        numbers = []
+        for name in glob.glob(os.path.join(self.directory, 'events.*.dat')):
+            m = re.search(r'events\.(\d+)\.dat$', name)
+            if m:
+                numbers.append(int(m.group(1)))
+        numbers.sort()
+        for number in numbers:
+            path = self.segment_path(number)
+            try:
+                self.sealed.append(SealedSegment(number, path))
+                continue
+            except (IOError, ValueError, mmap.error):
+                pass
+            # not sealed, or written on a machine of another byte order
+            segment = ActiveSegment(number, path)
+            if number == numbers[-1] and segment.count < self.segment_size:
+                self.active = segment
+            elif segment.count:
+                self.sealed.append(segment.seal())
+            else:
+                segment.close()
+                os.remove(path + '.dat')
+        if self.active is None:
+            self.new_segment()
+
+    def new_segment(self):
+        number = self.active.number + 1 if self.active else \
+            (self.sealed[-1].number + 1 if self.sealed else 0)
+        self.active = ActiveSegment(number, self.segment_path(number))
+
+    def add(self, kind, event):
+        """Archive a build or test event, a payload dict or BuildEvent or
+           TestEvent, delivered as 'kind' ('build', 'unittest' or 'talos').
+        """
+        if hasattr(event, 'as_dict'):
+            event = event.as_dict()
+        # serialized now, since a callback may change the event
+        line = json.dumps([kind, event], separators=(',', ':'))
+        entry = ActiveSegment.entry(event)
+        self.cond.acquire()
+        try:
+            if self.closed:
+                raise ValueError('archive is closed')
+            self.pending.append((line, entry))
+            if not self.writer:
+                self.writer = threading.Thread(target=self.write_pending)
+                self.writer.daemon = True
+                self.writer.start()
+            if len(self.pending) >= self.block_size:
+                self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def write_pending(self):
+        while True:
+            self.cond.acquire()
+            try:
+                if len(self.pending) < self.block_size and not self.closed:
+                    self.cond.wait(self.flush_interval)
+                closed = self.closed
+            finally:
+                self.cond.release()
+            try:
+                self.flush()
+            except Exception, inst:
+                if self.logger:
+                    self.logger.exception(inst)
+            if closed:
+                return
+
+    def write(self, pending):
+        """Append records to the active segment, sealing it when full."""
+        while pending:
+            self.lock.acquire()
+            try:
+                n = min(self.block_size,
+                        self.segment_size - self.active.count)
+                block, pending = pending[:n], pending[n:]
+                self.active.append([line for line, entry in block],
+                                   [entry for line, entry in block])
+                if self.active.count >= self.segment_size:
+                    self.sealed.append(self.active.seal())
+                    self.new_segment()
+                    self.expire()
+            finally:
+                self.lock.release()
+
+    def expire(self):
+        """Delete the oldest segments beyond max_segments; lock must be
+           held.
+        """
+        if not self.max_segments:
+            return
+        while self.sealed and len(self.sealed) + 1 > self.max_segments:
+            # not closed: a query may still be reading it, and its
+            # mappings remain valid once the files are removed
+            segment = self.sealed.pop(0)
+            for ext in ('.idx', '.dat'):
+                os.remove(segment.path + ext)
+
+    def flush(self):
+        """Write the events added so far, so that queries will find them."""
+        # held while the events are written, so that events taken by the
+        # writer thread and by a caller of flush() are written in order
+        self.lock.acquire()
+        try:
+            self.cond.acquire()
+            try:
+                pending, self.pending = self.pending, []
+            finally:
+                self.cond.release()
+            self.write(pending)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """Write the pending events and stop the writer thread."""
+        self.cond.acquire()
+        try:
+            self.closed = True
+            self.cond.notify()
+            writer, self.writer = self.writer, None
+        finally:
+            self.cond.release()
+        if writer:
+            writer.join()
+        self.flush()
+        self.lock.acquire()
+        try:
+            for segment in self.sealed + [self.active]:
+                segment.close()
+        finally:
+            self.lock.release()
+
+    def total(self):
+        """The number of events written to the archive."""
+        self.lock.acquire()
+        try:
+            return sum(segment.count for segment in self.sealed) + \
+                self.active.count
+        finally:
+            self.lock.release()
+
+    def query(self, kind=None, revision=None, tree=None, platform=None,
+              buildtype=None, since=None, until=None, limit=None):
+        """Returns a list of (kind, payload) for the archived events which
+           match every argument given, oldest first.  'since' and 'until'
+           select events with since <= builddate < until; events without
+           a builddate are then excluded.  At most 'limit' events are
+           returned if it is given.
+        """
+        criteria = {}
+        for field, value in (('revision', revision), ('tree', tree),
+                             ('platform', platform),
+                             ('buildtype', buildtype)):
+            if value is not None:
+                criteria[field] = value
+
+        def matches(record):
+            recordKind, payload = record
+            if kind is not None and recordKind != kind:
+                return False
+            for field, value in criteria.iteritems():
+                if payload.get(field) != value:
+                    return False
+            if since is not None or until is not None:
+                builddate = index_date(payload.get('builddate'))
+                if builddate is None or \
+                        (since is not None and builddate < since) or \
+                        (until is not None and builddate >= until):
+                    return False
+            return True
+
+        self.lock.acquire()
+        try:
+            segments = self.sealed[:]
+        finally:
+            self.lock.release()
+
+        results = []
+        for segment in segments + [None]:
+            if segment is None:
+                # the active segment changes as events are written
+                self.lock.acquire()
+                segment = self.active
+            try:
+                ids = segment.candidates(criteria, since, until)
+                for record in segment.read(ids):
+                    if matches(record):
+                        results.append(tuple(record))
+                        if limit is not None and len(results) >= limit:
+                            return results
+            finally:
+                if segment is self.active:
+                    self.lock.release()
+        return results
@@ -0,0 +1,303 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+from collections import deque, namedtuple
+import Queue
+import threading
+import traceback
+
+# trollius, imported when the first monitor is created, so that
+# importing the package doesn't import it
+asyncio = None
+
+from factory import random_label
+from lazy import decoded
+from pulsebuildmonitor import PulseBuildMonitor
+
+
+# An event delivered by AsyncPulseBuildMonitor.events(); 'kind' is one of
+# 'build', 'test' or 'pulse' and 'data' is what the corresponding callback
+# would have been passed.
+MonitorEvent = namedtuple('MonitorEvent', 'kind data')
+
+# placed on a stream's queue to end it
+_CLOSED = object()
+
+
+def load_asyncio():
+    global asyncio
+    if asyncio is None:
+        import trollius
+        asyncio = trollius
+    return asyncio
+
+
+def ensure_future(coro_or_future, loop):
+    # trollius before 2.0 calls it async()
+    ensure = getattr(asyncio, 'ensure_future', None) or \
+        getattr(asyncio, 'async')
+    return ensure(coro_or_future, loop=loop)
+
+
+class EventStream(object):
+    """The events of an AsyncPulseBuildMonitor, returned by its events()
+       method.  Coroutines on the monitor's loop read them with get():
+
+         event = yield From(stream.get())
+
+       which returns None once the stream is closed.  The stream can also
+       be iterated over by a thread, which blocks until each event
+       arrives, and stops once the stream is closed:
+
+         for event in stream:
+           ...
+    """
+
+    def __init__(self, monitor, kinds):
+        self.monitor = monitor
+        self.kinds = frozenset(kinds)
+        # (event, release) pairs, which may be taken by any thread
+        self.queue = Queue.Queue()
+        # the futures returned by get() which are waiting for an event;
+        # only used on the loop
+        self.waiters = deque()
+        self.closed = False
+
+    def put(self, event, release):
+        """Called on the loop with each event."""
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                release(True)
+                waiter.set_result(event)
+                return
+        self.queue.put((event, release))
+
+    def take(self, item):
+        if item is _CLOSED:
+            # leave it for any other reader
+            self.queue.put(_CLOSED)
+            return None
+        event, release = item
+        release(True)
+        return event
+
+    def get(self):
+        """Returns a future which completes with the next event, or None
+           once the stream is closed.  Must be called on the loop.
+        """
+        future = asyncio.Future(loop=self.monitor.loop)
+        try:
+            item = self.queue.get_nowait()
+        except Queue.Empty:
+            if self.closed:
+                future.set_result(None)
+            else:
+                self.waiters.append(future)
+            return future
+        future.set_result(self.take(item))
+        return future
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        event = self.take(self.queue.get())
+        if event is None:
+            raise StopIteration
+        return event
+
+    def close(self):
+        """End the stream, discarding any events not yet received.  May be
+           called from any thread.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.monitor.remove_stream(self)
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if item is not _CLOSED:
+                item[1](True)
+        self.queue.put(_CLOSED)
+        if self.monitor.loop is not None:
+            self.monitor.loop.call_soon_threadsafe(self.wake_waiters)
+
+    def wake_waiters(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+class AsyncPulseBuildMonitor(PulseBuildMonitor):
+    """A monitor which delivers its messages to a trollius event loop.
+
+       buildCallback, testCallback and pulseCallback may be coroutines
+       (decorated with @trollius.coroutine); they are run as tasks on the
+       loop, at most 'concurrency' at a time.  Events can also be read
+       from the EventStreams returned by monitor.events().  At most
+       'max_pending' events may be waiting for a callback or a consumer;
+       once that many are, the pulse listener stops taking messages until
+       some finish.
+
+       'builds' and 'unittests' default to whether buildCallback and
+       testCallback are given; set them to True to receive those events
+       only through events().  The other keyword arguments are passed to
+       PulseBuildMonitor and filter the messages in the same way.
+    """
+
+    def __init__(self, buildCallback=None, testCallback=None,
+                 pulseCallback=None, loop=None, concurrency=10,
+                 max_pending=1000, label=None, builds=None, unittests=None,
+                 **kwargs):
+        try:
+            load_asyncio()
+        except ImportError:
+            raise ImportError('AsyncPulseBuildMonitor requires trollius; '
+                              'install pulsebuildmonitor[async]')
+        self.callbacks = {'build': buildCallback,
+                          'test': testCallback,
+                          'pulse': pulseCallback}
+        self.loop = loop
+        self.concurrency = concurrency
+        self.running = 0
+        self.waiting = deque()
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.streams = ()
+        self.listener = None
+
+        if builds is None:
+            builds = buildCallback is not None
+        if unittests is None:
+            unittests = testCallback is not None
+
+        PulseBuildMonitor.__init__(self,
+                                   label=label or random_label(),
+                                   builds=builds,
+                                   unittests=unittests,
+                                   **kwargs)
+
+    def start(self):
+        """Start listening on a thread of the loop's default executor.
+           Returns a future which completes if the listener ever exits.
+        """
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        self.listener = self.loop.run_in_executor(None, self.listen)
+        return self.listener
+
+    def events(self, kinds=('build', 'test')):
+        """Return an EventStream of the events of the given kinds."""
+        stream = EventStream(self, kinds)
+        self.streams = self.streams + (stream,)
+        return stream
+
+    def remove_stream(self, stream):
+        self.streams = tuple(s for s in self.streams if s is not stream)
+
+    def close(self):
+        """Close every stream returned by events()."""
+        for stream in self.streams:
+            stream.close()
+
+    def wants(self, kind):
+        if self.callbacks[kind]:
+            return True
+        for stream in self.streams:
+            if kind in stream.kinds:
+                return True
+        return False
+
+    def deliver(self, kind, data):
+        """Called on the listener thread; hands an event to the loop."""
+        done = self.defer_ack()
+        self.slots.acquire()
+        self.loop.call_soon_threadsafe(self.publish,
+                                       MonitorEvent(kind, data), done)
+
+    def publish(self, event, done):
+        """Called on the loop; passes the event to its callback and to
+           every interested stream.
+        """
+        callback = self.callbacks[event.kind]
+        streams = [s for s in self.streams if event.kind in s.kinds]
+        state = {'holders': len(streams) + (callback is not None),
+                 'failed': False}
+        # streams may be read, and so release the event, on other threads
+        lock = threading.Lock()
+
+        def release(success):
+            lock.acquire()
+            try:
+                if not success:
+                    state['failed'] = True
+                state['holders'] -= 1
+                if state['holders']:
+                    return
+            finally:
+                lock.release()
+            self.slots.release()
+            if done:
+                done(not state['failed'])
+
+        if not state['holders']:
+            state['holders'] = 1
+            release(True)
+            return
+        for stream in streams:
+            stream.put(event, release)
+        if callback:
+            if self.running < self.concurrency:
+                self.run(callback, event.data, release)
+            else:
+                self.waiting.append((callback, event.data, release))
+
+    def run(self, callback, data, release):
+        self.running += 1
+        try:
+            result = callback(data)
+        except Exception, inst:
+            self.report(inst)
+            self.finished(release, False)
+            return
+        if not (asyncio.iscoroutine(result) or
+                isinstance(result, asyncio.Future)):
+            self.finished(release, True)
+            return
+
+        def completed(task):
+            failed = not task.cancelled() and task.exception() is not None
+            if failed:
+                self.report(task.exception())
+            self.finished(release, not failed)
+
+        ensure_future(result, loop=self.loop).add_done_callback(completed)
+
+    def finished(self, release, success):
+        self.running -= 1
+        release(success)
+        if self.waiting and self.running < self.concurrency:
+            self.run(*self.waiting.popleft())
+
+    def report(self, inst):
+        if self.logger:
+            self.logger.error('callback raised %r' % inst)
+        traceback.print_exception(type(inst), inst, None)
+
+    def on_pulse_message(self, data):
+        if self.wants('pulse'):
+            self.deliver('pulse', decoded(data))
+
+    def on_build_complete(self, builddata):
+        if self.wants('build'):
+            self.deliver('build', builddata)
+
+    def on_test_complete(self, builddata):
+        if self.wants('test'):
+            self.deliver('test', builddata)
@@ -0,0 +1,146 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import threading
+import time
+import traceback
+
+
+def release_all(releases):
+    """Returns a function which passes its argument to each of the
+       functions in 'releases', or None if there are none.
+    """
+    releases = [release for release in releases if release]
+    if not releases:
+        return None
+    def done(success):
+        for release in releases:
+            release(success)
+    return done
+
+
+class EventBatcher(object):
+    """Collects the events for each callback into lists, so that the
+       callback can handle many events in one call.  A callback's list is
+       sent once it holds 'size' events, or 'interval' seconds after its
+       first event arrived, whichever comes first.
+
+       Each event is added with a release function (or None), called with
+       True or False once the callback has handled the list containing
+       it, and optionally a lane; events in different lanes are batched
+       separately.  Lists are sent by send(callback, events, releases,
+       lane), on the batcher's thread if the interval expired.
+    """
+
+    def __init__(self, size=100, interval=1.0):
+        assert(size > 0)
+        self.size = size
+        self.interval = interval
+        self.batches = {}
+        self.cond = threading.Condition()
+        self.send = None
+        self.thread = None
+        self.stopping = False
+
+    def start(self, send):
+        self.cond.acquire()
+        try:
+            if self.thread:
+                return
+            self.send = send
+            self.stopping = False
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+        finally:
+            self.cond.release()
+
+    def key(self, callback, lane):
+        # bound methods hash their instance, which may not be hashable
+        if getattr(callback, '__self__', None) is not None:
+            return (id(callback.__self__), callback.__name__, lane)
+        return (callback, lane)
+
+    def add(self, callback, event, release=None, lane=None):
+        key = self.key(callback, lane)
+        full = None
+        self.cond.acquire()
+        try:
+            batch = self.batches.get(key)
+            if batch is None:
+                batch = self.batches[key] = [time.time() + self.interval,
+                                             callback, [], [], lane]
+                self.cond.notify()
+            batch[2].append(event)
+            batch[3].append(release)
+            if len(batch[2]) >= self.size:
+                full = self.batches.pop(key)
+        finally:
+            self.cond.release()
+        if full:
+            self.send_batch(full)
+
+    def send_batch(self, batch):
+        deadline, callback, events, releases, lane = batch
+        try:
+            self.send(callback, events, releases, lane)
+        except Exception:
+            traceback.print_exc()
+
+    def due(self, now):
+        """Remove and return the batches whose interval has expired; cond
+           must be held.
+        """
+        due = [key for key, batch in self.batches.iteritems()
+               if batch[0] <= now]
+        return [self.batches.pop(key) for key in due]
+
+    def run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while True:
+                    if self.stopping:
+                        return
+                    now = time.time()
+                    due = self.due(now)
+                    if due:
+                        break
+                    if self.batches:
+                        self.cond.wait(min(batch[0] for batch in
+                                           self.batches.itervalues()) - now)
+                    else:
+                        self.cond.wait()
+            finally:
+                self.cond.release()
+            for batch in due:
+                self.send_batch(batch)
+
+    def flush(self):
+        """Send every batch now."""
+        self.cond.acquire()
+        try:
+            batches = self.batches.values()
+            self.batches = {}
+        finally:
+            self.cond.release()
+        for batch in batches:
+            self.send_batch(batch)
+
+    def stop(self, flush=True):
+        """Stop the batcher's thread, sending the pending batches first if
+           'flush' is True.
+        """
+        self.cond.acquire()
+        try:
+            self.stopping = True
+            self.cond.notify()
+            thread, self.thread = self.thread, None
+        finally:
+            self.cond.release()
+        if thread:
+            thread.join()
+        if flush:
+            self.flush()
@@ -0,0 +1,177 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+from collections import deque, OrderedDict
+import threading
+import time
+import traceback
+
+
+# the payload fields which identify an event, for both builds and tests;
+# builds have no 'test', which is then None
+DEFAULT_FIELDS = ('tree', 'platform', 'buildtype', 'revision', 'product',
+                  'test')
+
+
+def event_key(kind, payload, fields):
+    return (kind,) + tuple(payload.get(field) for field in fields)
+
+
+class EventDeduplicator(object):
+    """Remembers the events delivered recently, so that copies arriving
+       within 'ttl' seconds of the first can be dropped.  Two events are
+       copies if they are of the same kind and their 'fields' are equal.
+       At most 'maxsize' events are remembered; those least recently seen
+       are forgotten first.
+    """
+
+    def __init__(self, fields=DEFAULT_FIELDS, ttl=600, maxsize=10000):
+        self.fields = tuple(fields)
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+
+    def is_duplicate(self, kind, payload):
+        """Returns True if an event like this one was seen within the last
+           'ttl' seconds, and otherwise remembers it.
+        """
+        key = event_key(kind, payload, self.fields)
+        now = time.time()
+        self.lock.acquire()
+        try:
+            first = self.seen.pop(key, None)
+            if first is not None and now - first < self.ttl:
+                self.seen[key] = first
+                return True
+            self.seen[key] = now
+            if len(self.seen) > self.maxsize:
+                self.seen.popitem(last=False)
+            return False
+        finally:
+            self.lock.release()
+
+
+class EventCoalescer(object):
+    """Holds each event for 'window' seconds, during which a later event
+       with the same key replaces it, and then delivers whichever is the
+       latest.  Keys are made from 'fields' as for EventDeduplicator.
+       At most 'maxsize' events are held; beyond that the oldest is
+       delivered early.
+
+       Events are added with an opaque token.  When an event is replaced,
+       its token is passed to on_superseded(token); held events are
+       delivered, on the coalescer's thread, by deliver(kind, builddata,
+       token).
+    """
+
+    def __init__(self, fields=DEFAULT_FIELDS, window=10.0, maxsize=10000):
+        self.fields = tuple(fields)
+        self.window = window
+        self.maxsize = maxsize
+        self.held = {}
+        self.order = deque()
+        self.cond = threading.Condition()
+        self.deliver = None
+        self.on_superseded = None
+        self.thread = None
+        self.stopping = False
+
+    def start(self, deliver, on_superseded=None):
+        self.cond.acquire()
+        try:
+            if self.thread:
+                return
+            self.deliver = deliver
+            self.on_superseded = on_superseded
+            self.stopping = False
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+        finally:
+            self.cond.release()
+
+    def add(self, kind, payload, builddata, token=None):
+        """Hold an event.  Returns True if it replaced an earlier one."""
+        key = event_key(kind, payload, self.fields)
+        superseded = None
+        overflow = None
+        self.cond.acquire()
+        try:
+            entry = self.held.get(key)
+            if entry is not None:
+                superseded = entry[2]
+                entry[1:] = [builddata, token]
+            else:
+                self.held[key] = [kind, builddata, token]
+                self.order.append((time.time() + self.window, key))
+                if len(self.held) > self.maxsize:
+                    overflow = self.pop_oldest()
+                self.cond.notify()
+        finally:
+            self.cond.release()
+
+        if overflow:
+            self.deliver_entry(overflow)
+        if entry is not None and self.on_superseded:
+            self.on_superseded(superseded)
+        return entry is not None
+
+    def pop_oldest(self):
+        """Remove and return the oldest held entry; cond must be held."""
+        deadline, key = self.order.popleft()
+        return self.held.pop(key)
+
+    def deliver_entry(self, entry):
+        kind, builddata, token = entry
+        try:
+            self.deliver(kind, builddata, token)
+        except Exception:
+            traceback.print_exc()
+
+    def run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while not self.stopping and (not self.order or
+                                             self.order[0][0] > time.time()):
+                    if self.order:
+                        self.cond.wait(self.order[0][0] - time.time())
+                    else:
+                        self.cond.wait()
+                if self.stopping:
+                    return
+                entry = self.pop_oldest()
+            finally:
+                self.cond.release()
+            self.deliver_entry(entry)
+
+    def flush(self):
+        """Deliver every held event now, oldest first."""
+        while True:
+            self.cond.acquire()
+            try:
+                if not self.order:
+                    return
+                entry = self.pop_oldest()
+            finally:
+                self.cond.release()
+            self.deliver_entry(entry)
+
+    def stop(self, flush=True):
+        """Stop the coalescer's thread, delivering the held events first
+           if 'flush' is True.
+        """
+        self.cond.acquire()
+        try:
+            self.stopping = True
+            self.cond.notify()
+            thread, self.thread = self.thread, None
+        finally:
+            self.cond.release()
+        if thread:
+            thread.join()
+        if flush:
+            self.flush()
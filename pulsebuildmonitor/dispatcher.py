@@ -0,0 +1,425 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+from collections import deque
+import multiprocessing
+import threading
+import traceback
+
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+# sentinel placed on a queue to tell a worker thread to exit
+_STOP = object()
+
+
+def run_callback(callback, args, done=None, profiler=None):
+    """Call callback(*args), then report whether it succeeded by calling
+       done(True) or done(False), if 'done' was given.  If 'profiler' is
+       given, the call is made through profiler.runcall().
+    """
+    try:
+        if profiler:
+            profiler.runcall(callback, *args)
+        else:
+            callback(*args)
+    except:
+        if done:
+            done(False)
+        raise
+    if done:
+        done(True)
+
+
+class CallbackQueue(object):
+    """A bounded FIFO of pending callback invocations.  What happens when
+       the queue is full is determined by 'policy', one of BLOCK,
+       DROP_OLDEST or DROP_NEWEST; 'on_drop', if given, is called with
+       each item that is discarded.
+    """
+
+    def __init__(self, maxsize=1000, policy=BLOCK, on_drop=None):
+        if policy not in POLICIES:
+            raise ValueError('unknown queue policy: %s' % policy)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.on_drop = on_drop
+        self.dropped = 0
+        self.items = deque()
+        self.cond = threading.Condition()
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item, force=False):
+        """Add an item to the queue.  Returns False if the item (or, for
+           DROP_OLDEST, an older item) had to be discarded.  If 'force'
+           is True the item is added even if the queue is full.
+        """
+        dropped = None
+        self.cond.acquire()
+        try:
+            if not force and self.maxsize > 0:
+                if self.policy == BLOCK:
+                    while len(self.items) >= self.maxsize:
+                        self.cond.wait()
+                elif len(self.items) >= self.maxsize:
+                    self.dropped += 1
+                    if self.policy == DROP_NEWEST:
+                        dropped = item
+                    else:
+                        dropped = self.items.popleft()
+            if dropped is not item:
+                self.items.append(item)
+                self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+        if dropped is None:
+            return True
+        if self.on_drop:
+            self.on_drop(dropped)
+        return False
+
+    def get(self):
+        """Remove and return the oldest item, waiting until one is
+           available.
+        """
+        self.cond.acquire()
+        try:
+            while not self.items:
+                self.cond.wait()
+            item = self.items.popleft()
+            self.cond.notify_all()
+            return item
+        finally:
+            self.cond.release()
+
+
+class CallbackDispatcher(object):
+    """Executes monitor callbacks on a fixed number of worker threads fed
+       by bounded queues, instead of starting a new thread per message.
+
+       workers   - the number of worker threads
+       maxsize   - the maximum number of pending callbacks; what happens
+                   when this is exceeded is decided by 'policy'
+       policy    - one of 'block' (the default; the pulse listener waits
+                   until there is room), 'drop-oldest' or 'drop-newest'
+       processes - if True, the worker threads hand each callback to a
+                   multiprocessing.Pool of the same size.  The callbacks
+                   and their arguments must then be picklable, which rules
+                   out bound methods.
+       ordered   - if True, every invocation of a given callback is run by
+                   the same worker, so each callback sees its messages in
+                   the order they were received
+       logger    - a logging.logger instance used to report exceptions
+                   raised by callbacks
+    """
+
+    def __init__(self, workers=4, maxsize=1000, policy=BLOCK,
+                 processes=False, ordered=False, logger=None):
+        assert(workers > 0)
+        self.workers = workers
+        self.maxsize = maxsize
+        self.policy = policy
+        self.processes = processes
+        self.ordered = ordered
+        self.logger = logger
+
+        if self.ordered:
+            # one queue per worker, sharing the overall bound between them
+            queuesize = maxsize and max(1, maxsize // workers)
+            self.queues = [CallbackQueue(queuesize, policy, self.discard)
+                           for i in xrange(workers)]
+        else:
+            self.queues = [CallbackQueue(maxsize, policy, self.discard)]
+        self.assignments = {}
+        self.assignLock = threading.Lock()
+        self.threads = []
+        self.pool = None
+
+    @property
+    def dropped(self):
+        """The number of callbacks discarded because a queue was full."""
+        return sum(queue.dropped for queue in self.queues)
+
+    def qsize(self):
+        """The number of callbacks waiting for a worker."""
+        return sum(len(queue) for queue in self.queues)
+
+    def start(self):
+        if self.threads:
+            return
+        if self.processes:
+            self.pool = multiprocessing.Pool(self.workers)
+        for i in xrange(self.workers):
+            queue = self.queues[i % len(self.queues)]
+            thread = threading.Thread(target=self.worker, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, wait=True):
+        """Stop the worker threads once the callbacks already queued have
+           been run.
+        """
+        for i, thread in enumerate(self.threads):
+            self.queues[i % len(self.queues)].put(_STOP, force=True)
+        if wait:
+            for thread in self.threads:
+                thread.join()
+        self.threads = []
+        if self.pool:
+            self.pool.close()
+            if wait:
+                self.pool.join()
+            self.pool = None
+
+    def queue_for(self, callback):
+        if not self.ordered:
+            return self.queues[0]
+        # bound methods hash their instance, which may not be hashable
+        key = callback
+        if getattr(callback, '__self__', None) is not None:
+            key = (id(callback.__self__), callback.__name__)
+        self.assignLock.acquire()
+        try:
+            if key not in self.assignments:
+                self.assignments[key] = \
+                    len(self.assignments) % len(self.queues)
+            return self.queues[self.assignments[key]]
+        finally:
+            self.assignLock.release()
+
+    def submit(self, callback, *args, **kwargs):
+        """Queue callback(*args) for execution on a worker.  Returns False
+           if a callback was dropped because the queue was full.  If the
+           'done' keyword argument is given, it is called with True or
+           False once the callback has run.  Dropped callbacks count as
+           successful, so their messages are not redelivered.  The
+           'profiler' keyword argument is passed to run_callback().
+        """
+        return self.queue_for(callback).put((callback, args,
+                                             kwargs.get('done'),
+                                             kwargs.get('profiler')))
+
+    def discard(self, item):
+        callback, args, done, profiler = item
+        if done:
+            done(True)
+
+    def run(self, callback, args):
+        if self.pool:
+            self.pool.apply(callback, args)
+        else:
+            callback(*args)
+
+    def worker(self, queue):
+        while True:
+            item = queue.get()
+            if item is _STOP:
+                return
+            callback, args, done, profiler = item
+            try:
+                run_callback(self.run, (callback, args), done, profiler)
+            except Exception, inst:
+                if self.logger:
+                    self.logger.exception(inst)
+                traceback.print_exc()
+
+
+class Lane(object):
+    """One of a PriorityDispatcher's queues.
+
+       weight      - the lane's share of the workers when several lanes
+                     have callbacks waiting
+       concurrency - the most callbacks from this lane that may run at
+                     once, or None for no limit
+       maxsize     - the most callbacks that may wait in this lane; what
+                     happens beyond that is decided by 'policy', as for
+                     CallbackDispatcher
+    """
+
+    def __init__(self, weight=1, concurrency=None, maxsize=1000,
+                 policy=BLOCK):
+        if policy not in POLICIES:
+            raise ValueError('unknown queue policy: %s' % policy)
+        assert(weight > 0)
+        self.weight = weight
+        self.concurrency = concurrency
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = deque()
+        self.running = 0
+        self.credit = 0
+        self.dropped = 0
+
+    def ready(self):
+        return bool(self.items) and (self.concurrency is None or
+                                     self.running < self.concurrency)
+
+    def full(self):
+        return self.maxsize > 0 and len(self.items) >= self.maxsize
+
+
+def default_lanes():
+    """Lanes which keep builds moving during floods of test results."""
+    return {'build': Lane(weight=10),
+            'unittest': Lane(weight=3, policy=DROP_OLDEST),
+            'talos': Lane(weight=1, policy=DROP_OLDEST),
+            'pulse': Lane(weight=1, policy=DROP_OLDEST)}
+
+
+class PriorityDispatcher(object):
+    """Executes monitor callbacks on a fixed number of worker threads,
+       like CallbackDispatcher, but from separate lanes, so that a flood
+       of one kind of message can't hold up the others.  FactoryBuildMonitor
+       submits build events to the 'build' lane, test events to 'unittest'
+       or 'talos', and pulse messages to 'pulse'.
+
+       Whenever a worker is free, it takes the oldest callback from one of
+       the lanes which have callbacks waiting and are below their
+       concurrency limit, choosing between lanes in proportion to their
+       weights (by smooth weighted round-robin).
+
+       lanes        - a dict of lane name to Lane; by default, those from
+                      default_lanes()
+       workers      - the number of worker threads
+       default_lane - the lane for callbacks submitted without a lane, or
+                      with one we don't have
+       logger       - a logging.logger instance used to report exceptions
+                      raised by callbacks
+    """
+
+    def __init__(self, lanes=None, workers=4, default_lane='unittest',
+                 logger=None):
+        assert(workers > 0)
+        self.lanes = lanes or default_lanes()
+        assert(default_lane in self.lanes)
+        self.workers = workers
+        self.default_lane = default_lane
+        self.logger = logger
+        self.cond = threading.Condition()
+        self.threads = []
+        self.stopping = False
+
+    @property
+    def dropped(self):
+        """The number of callbacks discarded because a lane was full."""
+        return sum(lane.dropped for lane in self.lanes.itervalues())
+
+    def qsize(self, lane=None):
+        """The number of callbacks waiting in 'lane', or in every lane."""
+        if lane is not None:
+            return len(self.lanes[lane].items)
+        return sum(len(l.items) for l in self.lanes.itervalues())
+
+    def start(self):
+        if self.threads:
+            return
+        self.stopping = False
+        for i in xrange(self.workers):
+            thread = threading.Thread(target=self.worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, wait=True):
+        """Stop the worker threads once the callbacks already queued have
+           been run.
+        """
+        self.cond.acquire()
+        try:
+            self.stopping = True
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+        self.threads = []
+
+    def submit(self, callback, *args, **kwargs):
+        """Queue callback(*args) in the lane named by the 'lane' keyword
+           argument.  Otherwise the same as CallbackDispatcher.submit().
+        """
+        lane = self.lanes.get(kwargs.get('lane')) or \
+            self.lanes[self.default_lane]
+        item = (callback, args, kwargs.get('done'), kwargs.get('profiler'))
+        dropped = None
+        self.cond.acquire()
+        try:
+            if lane.full():
+                if lane.policy == BLOCK:
+                    while lane.full():
+                        self.cond.wait()
+                else:
+                    lane.dropped += 1
+                    if lane.policy == DROP_NEWEST:
+                        dropped = item
+                    else:
+                        dropped = lane.items.popleft()
+            if dropped is not item:
+                lane.items.append(item)
+                self.cond.notify()
+        finally:
+            self.cond.release()
+
+        if dropped is None:
+            return True
+        self.discard(dropped)
+        return False
+
+    def discard(self, item):
+        callback, args, done, profiler = item
+        if done:
+            done(True)
+
+    def next_lane(self):
+        """Choose the lane to run a callback from; cond must be held."""
+        ready = [lane for lane in self.lanes.itervalues() if lane.ready()]
+        if not ready:
+            return None
+        total = 0
+        for lane in ready:
+            lane.credit += lane.weight
+            total += lane.weight
+        chosen = max(ready, key=lambda lane: lane.credit)
+        chosen.credit -= total
+        return chosen
+
+    def worker(self):
+        while True:
+            self.cond.acquire()
+            try:
+                lane = self.next_lane()
+                while lane is None:
+                    if self.stopping and not self.qsize():
+                        return
+                    self.cond.wait()
+                    lane = self.next_lane()
+                item = lane.items.popleft()
+                lane.running += 1
+                # a blocked submit() may now have room
+                self.cond.notify_all()
+            finally:
+                self.cond.release()
+
+            callback, args, done, profiler = item
+            try:
+                run_callback(callback, args, done, profiler)
+            except Exception, inst:
+                if self.logger:
+                    self.logger.exception(inst)
+                traceback.print_exc()
+            finally:
+                self.cond.acquire()
+                lane.running -= 1
+                self.cond.notify_all()
+                self.cond.release()
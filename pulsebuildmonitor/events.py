@@ -0,0 +1,116 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+# Values of low-cardinality fields, shared between all events.  The
+# builtin intern() only accepts byte strings, while decoded JSON gives us
+# unicode, so we keep our own table.  New values should be rare, so the
+# table is simply emptied if it fills, in case a field has more values
+# than we expect.
+INTERN_TABLE_SIZE = 10000
+
+_interned = {}
+
+
+def intern_value(value):
+    if value is None:
+        return None
+    try:
+        return _interned[value]
+    except KeyError:
+        pass
+    if len(_interned) >= INTERN_TABLE_SIZE:
+        _interned.clear()
+    return _interned.setdefault(value, value)
+
+
+class Event(object):
+    """Base class for compact build and test records.  The attributes are
+       the payload fields documented in README.txt; for compatibility with
+       callbacks written for payload dicts, events also support
+       event['field'] and event.get('field').
+       Payload fields not listed in 'fields' are kept in the 'extra' dict.
+    """
+
+    __slots__ = ()
+
+    fields = ()
+    # fields whose few distinct values are shared between events
+    interned = frozenset(['tree', 'platform', 'buildtype', 'os', 'product',
+                          'test'])
+
+    def __init__(self, **kwargs):
+        for field in self.fields:
+            value = kwargs.pop(field, None)
+            if field in self.interned:
+                value = intern_value(value)
+            setattr(self, field, value)
+        self.extra = kwargs or None
+
+    @classmethod
+    def from_payload(cls, payload):
+        kwargs = dict((str(k), v) for k, v in payload.iteritems())
+        if kwargs.get('tags') is not None:
+            kwargs['tags'] = tuple(intern_value(tag) for tag in kwargs['tags'])
+        return cls(**kwargs)
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            return getattr(self, key)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.fields or bool(self.extra and key in self.extra)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def as_dict(self):
+        """Return the event as a payload dict."""
+        data = dict((field, getattr(self, field)) for field in self.fields)
+        if data.get('tags') is not None:
+            data['tags'] = list(data['tags'])
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def __reduce__(self):
+        return (_rebuild, (self.__class__, self.as_dict()))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.as_dict() == other.as_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(
+            '%s=%r' % (field, getattr(self, field)) for field in self.fields))
+
+
+def _rebuild(cls, data):
+    return cls.from_payload(data)
+
+
+class BuildEvent(Event):
+    """A finished build; passed to buildCallback."""
+
+    fields = ('buildtype', 'product', 'revision', 'builddate', 'buildername',
+              'timestamp', 'tree', 'platform', 'buildurl', 'testsurl', 'key',
+              'release', 'tags')
+    __slots__ = fields + ('extra',)
+
+
+class TestEvent(Event):
+    """A finished unittest or talos run; passed to testCallback."""
+
+    fields = ('buildtype', 'product', 'revision', 'builddate', 'buildername',
+              'timestamp', 'talos', 'tree', 'buildnumber', 'os', 'platform',
+              'buildurl', 'logurl', 'key', 'release', 'test')
+    __slots__ = fields + ('extra',)
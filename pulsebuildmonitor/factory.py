@@ -3,22 +3,38 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
+import functools
 import logging
 import random
 import socket
 import string
 import threading
+import time
 
+from batching import release_all
+from dispatcher import run_callback
+from lazy import decoded
 from pulsebuildmonitor import PulseBuildMonitor
 
 
+def random_label():
+    """Generate a random pulse consumer label."""
+    return '%s_%s' % (
+        ''.join(random.choice(string.letters) for i in xrange(12)),
+        socket.gethostname())
+
+
 class FactoryBuildMonitor(PulseBuildMonitor):
 
     def __init__(self, buildCallback=None, testCallback=None,
                  pulseCallback=None, tests=None, products=None,
                  platforms=None, trees=None, label=None, mobile=False,
                  logger=None, buildtypes=None, talos=False,
-                 buildTags=None, buildtags=None):
+                 buildTags=None, buildtags=None, dispatcher=None,
+                 durable=False, acknowledger=None, typed_events=False,
+                 metrics=None, profiler=None, deduplicator=None,
+                 coalescer=None, batcher=None, shard=None, transport=None,
+                 fields=None, shedder=None, sinks=None):
         self.platforms = platforms
         self.trees = trees
         self.mobile = mobile
@@ -32,12 +48,13 @@ class FactoryBuildMonitor(PulseBuildMonitor):
         self.tests = tests
         self.talos = talos
         self.products = products
+        self.dispatcher = dispatcher
+        self.profiler = profiler
+        self.batcher = batcher
+        self.shedder = shedder
 
         if not self.label:
-            # generate a random label
-            self.label = '%s_%s' % (
-                ''.join(random.choice(string.letters) for i in xrange(12)),
-                socket.gethostname())
+            self.label = random_label()
 
         if isinstance(logger, basestring):
             # if 'logger' is a string, create a logging handler for it
@@ -60,36 +77,189 @@ class FactoryBuildMonitor(PulseBuildMonitor):
                                    buildtags=self.buildtags,
                                    products=self.products,
                                    builds=buildCallback is not None,
-                                   unittests=testCallback is not None)
+                                   unittests=testCallback is not None,
+                                   durable=durable,
+                                   acknowledger=acknowledger,
+                                   typed_events=typed_events,
+                                   metrics=metrics,
+                                   deduplicator=deduplicator,
+                                   coalescer=coalescer,
+                                   shard=shard,
+                                   transport=transport,
+                                   fields=fields,
+                                   sinks=sinks)
+        self.setup_callback_metrics()
+
+    def setup_callback_metrics(self):
+        self.inFlight = self.metrics.gauge(
+            'pulsebuildmonitor_callbacks_in_flight',
+            'Callbacks dispatched which have not yet finished')
+        self.callbackTime = self.metrics.histogram(
+            'pulsebuildmonitor_callback_seconds',
+            'Time from dispatching a callback until it finished')
+        if self.dispatcher:
+            self.metrics.gauge('pulsebuildmonitor_dispatcher_queued',
+                               'Callbacks waiting for a dispatcher worker',
+                               function=self.dispatcher.qsize)
+            self.metrics.counter('pulsebuildmonitor_dispatcher_dropped_total',
+                                 'Callbacks dropped because the dispatcher '
+                                 'queue was full',
+                                 function=lambda: self.dispatcher.dropped)
+            for lane in getattr(self.dispatcher, 'lanes', ()):
+                self.metrics.gauge('pulsebuildmonitor_lane_queued',
+                                   'Callbacks waiting in each lane of a '
+                                   'PriorityDispatcher',
+                                   function=functools.partial(
+                                       self.dispatcher.qsize, lane),
+                                   lane=lane)
+        if self.shedder:
+            self.normalPrefetch = self.acknowledger.prefetch
+            self.shedder.bind(self.metrics, self.overload_changed)
+
+    def overload_changed(self, overloaded):
+        """Called by our shedder when we become overloaded or recover."""
+        if self.logger:
+            if overloaded:
+                self.logger.warning('callbacks are falling behind; '
+                                    'shedding load')
+            else:
+                self.logger.info('callbacks have caught up')
+        prefetch = self.shedder.overload_prefetch
+        if prefetch:
+            self.acknowledger.set_prefetch(prefetch if overloaded
+                                           else self.normalPrefetch)
 
     def join(self):
         assert(self.monitorThread)
         self.monitorThread.join()
 
     def start(self):
+        if self.dispatcher:
+            self.dispatcher.start()
+        if self.batcher:
+            self.batcher.start(self.send_batch)
         self.monitorThread = threading.Thread(target=self.listen)
         self.monitorThread.daemon = True
         self.monitorThread.start()
 
-    def start_callback_thread(self, callback, *args):
-        callback(*args)
+    def stop(self):
+        """Deliver the events held for coalescing or batching, close our
+           sinks, and wait for the dispatcher to run the callbacks already
+           queued.  Messages received after this are still passed to the
+           callbacks, but aren't batched.
+        """
+        if self.coalescer:
+            self.coalescer.stop()
+        self.close_sinks()
+        if self.batcher:
+            batcher, self.batcher = self.batcher, None
+            batcher.stop()
+        if self.dispatcher:
+            self.dispatcher.stop()
 
-    def on_pulse_message(self, data):
-        if self.pulseCallback:
-            callbackThread = threading.Thread(target=self.start_callback_thread, args=(self.pulseCallback, data))
-            callbackThread.daemon = True
-            callbackThread.start()
+    def start_callback_thread(self, callback, *args, **kwargs):
+        run_callback(callback, args, kwargs.get('done'),
+                     kwargs.get('profiler'))
 
-    def on_build_complete(self, builddata):
-        callbackThread = threading.Thread(target=self.start_callback_thread, args=(self.buildCallback, builddata))
-        callbackThread.daemon = True
-        callbackThread.start()
+    def track(self, done):
+        """Returns a function to be called with True or False when a
+           callback finishes, which updates the callback metrics and then
+           calls 'done', if given.
+        """
+        started = time.time()
+        self.inFlight.inc()
+        def finished(success):
+            self.inFlight.dec()
+            if self.shedder:
+                self.shedder.release()
+            self.callbackTime.observe(time.time() - started)
+            if done:
+                done(success)
+        return finished
 
-    def on_test_complete(self, builddata):
-        callbackThread = threading.Thread(target=self.start_callback_thread, args=(self.testCallback, builddata))
+    def dispatch(self, callback, *args, **kwargs):
+        """Run a callback off the monitor thread, either on the dispatcher's
+           worker pool or, if there is no dispatcher, on a new thread.
+           The message being processed isn't acknowledged until the
+           callback has finished, if our acknowledger waits for callbacks.
+           If we have a profiler, a sample of the callbacks are profiled.
+           The 'lane' keyword argument is passed to the dispatcher, and
+           says which of a PriorityDispatcher's lanes the callback joins.
+        """
+        self.submit(callback, args, self.defer_ack(), kwargs.get('lane'))
+
+    def submit(self, callback, args, done=None, lane=None):
+        """Run callback(*args) as dispatch() does, calling done(True) or
+           done(False) once it has finished.  If we have a shedder, this
+           waits until it allows another callback to be pending.
+        """
+        if self.shedder:
+            self.shedder.acquire()
+        done = self.track(done)
+        profiler = None
+        if self.profiler and self.profiler.sample():
+            profiler = self.profiler
+        if self.dispatcher:
+            self.dispatcher.submit(callback, *args, done=done,
+                                   profiler=profiler, lane=lane)
+            return
+        callbackThread = threading.Thread(target=self.start_callback_thread,
+                                          args=(callback,) + args,
+                                          kwargs={'done': done,
+                                                  'profiler': profiler})
         callbackThread.daemon = True
         callbackThread.start()
 
+    def on_pulse_message(self, data):
+        if self.pulseCallback and \
+                (not self.shedder or self.shedder.accept_pulse()):
+            self.dispatch(self.pulseCallback, decoded(data), lane='pulse')
+
+    def dispatch_event(self, callback, builddata, lane):
+        """Dispatch a build or test event, or add it to our batcher's list
+           for the callback and lane ('build', 'unittest' or 'talos').
+           Our shedder, if any, may drop the event or, if events aren't
+           batched, replace one still waiting for a worker with it.
+        """
+        shedder = self.shedder
+        if shedder:
+            if not shedder.accept_event(lane):
+                return
+            if shedder.keep_latest and not self.batcher:
+                slot = shedder.hold_latest(callback, builddata, lane,
+                                           self.defer_ack())
+                if slot is not None:
+                    self.submit(shedder.run_latest, (callback, slot),
+                                shedder.slot_done(slot), lane)
+                return
+        batcher = self.batcher
+        if batcher:
+            batcher.add(callback, builddata, self.defer_ack(), lane)
+        else:
+            self.dispatch(callback, builddata, lane=lane)
+
+    def send_batch(self, callback, events, releases, lane):
+        """Called by our batcher to pass a list of events to a callback;
+           their messages are settled once it has finished.
+        """
+        self.submit(callback, (events,), release_all(releases), lane)
+
+    def notify_complete(self, kind, builddata, targets=None):
+        """Pass an event to our sinks, then to on_build_complete or
+           on_test_complete, with its kind as the lane.
+        """
+        self.send_to_sinks(kind, builddata)
+        if kind == 'build':
+            self.on_build_complete(builddata)
+        else:
+            self.on_test_complete(builddata, kind)
+
+    def on_build_complete(self, builddata):
+        self.dispatch_event(self.buildCallback, builddata, 'build')
+
+    def on_test_complete(self, builddata, kind='unittest'):
+        self.dispatch_event(self.testCallback, builddata, kind)
+
 def start_pulse_monitor(buildCallback=None, testCallback=None, pulseCallback=None, **kwargs):
 
     monitor = FactoryBuildMonitor(buildCallback=buildCallback,
@@ -0,0 +1,198 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+from collections import namedtuple
+import re
+
+
+unittestsRe = re.compile(r'(unittest|talos).(.*?)\.(.*?)\.(.*?)\.(.*?)\.(.*?)\.(.*?)\.(.*)')
+buildsRe = re.compile(r'build.(.*?)\.(.*?)\.(.*?)\.(.*)')
+
+# The fields of a parsed routing key.  'kind' is one of 'build', 'unittest'
+# or 'talos'; fields which don't appear in a given kind of key are None.
+RoutingKey = namedtuple('RoutingKey', 'kind tree platform os buildtype '
+                                      'test product builder extra')
+
+# The number of distinct routing keys whose parse results are remembered.
+# Routing keys repeat heavily, so the cache is simply emptied when it fills.
+KEY_CACHE_SIZE = 20000
+
+_keyCache = {}
+
+
+def key_category(key):
+    """Returns 'build' or 'test' depending on the routing key's prefix, or
+       None if the key is not a build, unittest or talos key.  This is
+       cheap enough to be used before deciding whether to parse the key.
+    """
+    if key.startswith('build'):
+        return 'build'
+    if key.startswith('unittest') or key.startswith('talos'):
+        return 'test'
+    return None
+
+
+def parse_routing_key(key):
+    """Parse a routing key into a RoutingKey, or return None if it can't be
+       parsed.  Results are memoized, so the regexes are run once per
+       distinct key.
+    """
+    try:
+        return _keyCache[key]
+    except KeyError:
+        pass
+
+    parsed = None
+    if key.startswith('build'):
+        m = buildsRe.match(key)
+        if m:
+            parsed = RoutingKey('build', m.group(1), m.group(2), None,
+                                m.group(3), None, None, None, m.group(4))
+    else:
+        m = unittestsRe.match(key)
+        if m:
+            kind = 'talos' if 'talos' in m.group(1) else 'unittest'
+            parsed = RoutingKey(kind, m.group(2), m.group(3), m.group(4),
+                                m.group(5), m.group(6), m.group(7),
+                                m.group(8), None)
+
+    if len(_keyCache) >= KEY_CACHE_SIZE:
+        _keyCache.clear()
+    _keyCache[key] = parsed
+    return parsed
+
+
+def _frozen(values):
+    """Convert a filter list (or a single string) to a frozenset; an empty
+       or missing filter becomes None, meaning 'match everything'.
+    """
+    if not values:
+        return None
+    if isinstance(values, basestring):
+        values = [values]
+    return frozenset(values)
+
+
+class TagMatcher(object):
+    """Matches a build's tags against a 'buildtags' filter using bitmasks.
+
+       The filter is either a list of strings, all of which must be present,
+       or a list of lists of strings, where all strings of at least one of
+       the inner lists must be present.
+    """
+
+    def __init__(self, buildtags):
+        if isinstance(buildtags[0], basestring):
+            taglists = [buildtags]
+        elif isinstance(buildtags[0], (list, tuple)):
+            taglists = buildtags
+        else:
+            raise Exception('buildtags must be a list of strings or a list of lists')
+
+        self.bits = {}
+        self.masks = []
+        for taglist in taglists:
+            mask = 0
+            for tag in taglist:
+                if tag not in self.bits:
+                    self.bits[tag] = 1 << len(self.bits)
+                mask |= self.bits[tag]
+            self.masks.append(mask)
+
+    def match(self, tags):
+        bits = self.bits
+        present = 0
+        for tag in tags or ():
+            present |= bits.get(tag, 0)
+        for mask in self.masks:
+            if present & mask == mask:
+                return True
+        return False
+
+
+class MessageFilter(object):
+    """A set of filters, compiled once, that decides whether a message is
+       of interest.  The arguments have the same meaning as the
+       corresponding PulseBuildMonitor arguments.
+    """
+
+    def __init__(self, trees=None, platforms=None, buildtypes=None,
+                 tests=None, products=None, buildtags=None, builds=False,
+                 unittests=False, talos=False):
+        self.trees = _frozen(trees)
+        self.platforms = _frozen(platforms)
+        self.buildtypes = _frozen(buildtypes)
+        self.tests = _frozen(tests)
+        self.products = _frozen(products)
+        self.tags = TagMatcher(buildtags) if buildtags else None
+
+        kinds = set()
+        if builds:
+            kinds.add('build')
+        if unittests:
+            kinds.add('unittest')
+        if talos:
+            kinds.add('talos')
+        self.kinds = frozenset(kinds)
+
+        categories = set()
+        if builds:
+            categories.add('build')
+        if unittests or talos:
+            categories.add('test')
+        self.categories = frozenset(categories)
+
+    def wants_category(self, category):
+        """Returns True if messages in the given key_category() might be
+           accepted by this filter.
+        """
+        return category in self.categories
+
+    def reject_reason(self, rk):
+        """Returns the name of the first filter which rejects the parsed
+           routing key, or None if the key passes all of them.
+        """
+        if rk.kind not in self.kinds:
+            return rk.kind
+        if self.trees is not None and rk.tree not in self.trees:
+            return 'tree'
+        if self.platforms is not None and rk.platform not in self.platforms:
+            return 'platform'
+        if self.buildtypes is not None and rk.buildtype not in self.buildtypes:
+            return 'buildtype'
+        if rk.kind != 'build':
+            if self.tests is not None and rk.test not in self.tests:
+                return 'test'
+            if self.products is not None and rk.product not in self.products:
+                return 'product'
+        return None
+
+    def accepts_key(self, rk):
+        """Returns True if the parsed routing key passes every filter that
+           can be decided from the key alone.
+        """
+        return self.reject_reason(rk) is None
+
+    def payload_reject_reason(self, rk, payload):
+        """Returns the name of the first filter which can't be decided from
+           the routing key (products and buildtags for builds) and rejects
+           the payload, or None if it passes them.
+        """
+        if rk.kind != 'build':
+            return None
+        if self.products is not None and payload['product'] not in self.products:
+            return 'product'
+        if self.tags is not None and not self.tags.match(payload['tags']):
+            return 'buildtag'
+        return None
+
+    def accepts_payload(self, rk, payload):
+        """Returns True if the payload passes the filters which can't be
+           decided from the routing key.
+        """
+        return self.payload_reject_reason(rk, payload) is None
+
+    def accepts(self, rk, payload):
+        return self.accepts_key(rk) and self.accepts_payload(rk, payload)
@@ -0,0 +1,446 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import httplib
+import os
+import Queue
+import random
+import re
+import socket
+import threading
+import time
+import urlparse
+try:
+    import json
+except:
+    import simplejson as json
+
+from metrics import MetricsRegistry
+
+
+class Spool(object):
+    """Events which couldn't be delivered to a destination, kept on disk,
+       one JSON document per line, until it can take them.  New events
+       are appended to 'path'; to replay them the file is first moved to
+       path + '.replay', which is then read from the start, so events in
+       a replay interrupted by a restart are delivered again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.replaying = path + '.replay'
+        self.offset = 0
+        self.lock = threading.Lock()
+
+    def append(self, lines):
+        self.lock.acquire()
+        try:
+            f = open(self.path, 'ab')
+            try:
+                f.write(''.join(line + '\n' for line in lines))
+            finally:
+                f.close()
+        finally:
+            self.lock.release()
+
+    def pending(self):
+        return os.path.exists(self.replaying) or \
+            (os.path.exists(self.path) and os.path.getsize(self.path) > 0)
+
+    def read(self, count):
+        """Returns (lines, offset): up to 'count' spooled lines, and the
+           offset to commit() once they have been delivered.
+        """
+        if not os.path.exists(self.replaying):
+            self.lock.acquire()
+            try:
+                if not os.path.exists(self.path):
+                    return [], 0
+                os.rename(self.path, self.replaying)
+                self.offset = 0
+            finally:
+                self.lock.release()
+        f = open(self.replaying, 'rb')
+        try:
+            f.seek(self.offset)
+            lines = []
+            offset = self.offset
+            while len(lines) < count:
+                line = f.readline()
+                if not line.endswith('\n'):
+                    break
+                offset += len(line)
+                if line.strip():
+                    lines.append(line[:-1])
+        finally:
+            f.close()
+        if not lines:
+            os.remove(self.replaying)
+        return lines, offset
+
+    def commit(self, offset):
+        """Record that the lines before 'offset' have been delivered.  The
+           replay file is removed once all of its lines have been, so that
+           they aren't delivered again after a restart.
+        """
+        self.offset = offset
+        if os.path.exists(self.replaying) and \
+                offset >= os.path.getsize(self.replaying):
+            os.remove(self.replaying)
+
+
+class Destination(object):
+    """An HTTP endpoint to which a WebhookForwarder POSTs events.
+
+       url            - the http or https URL to POST to
+       name           - names the destination in metrics and its spool
+                        file; derived from the URL by default
+       kinds, trees, platforms, buildtypes, tests, products
+                      - if given, only events whose kind ('build',
+                        'unittest' or 'talos') or payload field is one of
+                        these values are forwarded
+       predicate      - if given, a function called with (kind, payload)
+                        which returns whether to forward an event
+       batch_size     - if more than 1, events are POSTed as a JSON list
+                        of up to this many, collected for at most
+                        'batch_interval' seconds; otherwise each is POSTed
+                        on its own
+       connections    - the number of persistent connections, each used
+                        by its own thread, over which events are sent
+       max_queue      - the number of events which may wait to be sent;
+                        beyond this they are spooled, or dropped if there
+                        is no spool
+       timeout        - the socket timeout, in seconds
+       retries        - the number of times a failed request is retried,
+                        waiting 'backoff' seconds at first and doubling
+                        each time up to 'max_backoff', before its events
+                        are spooled
+       headers        - additional request headers
+
+       Each request body is an object {"kind": ..., "payload": ...}, or a
+       list of them.  A 2xx response means the events were delivered; a
+       429 or 5xx, or a connection error, is retried; any other response
+       means they were refused, and they are dropped.
+    """
+
+    FIELDS = ('tree', 'platform', 'buildtype', 'test', 'product')
+
+    def __init__(self, url, name=None, kinds=None, trees=None,
+                 platforms=None, buildtypes=None, tests=None, products=None,
+                 predicate=None, batch_size=1, batch_interval=1.0,
+                 connections=1, max_queue=10000, timeout=10.0, retries=5,
+                 backoff=1.0, max_backoff=60.0, headers=None):
+        parsed = urlparse.urlsplit(url)
+        if parsed.scheme not in ('http', 'https'):
+            raise ValueError('unsupported URL: %s' % url)
+        self.url = url
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.path = parsed.path or '/'
+        if parsed.query:
+            self.path += '?' + parsed.query
+        self.name = name or re.sub(r'[^\w.-]+', '_',
+                                   parsed.netloc + parsed.path).strip('_')
+        self.kinds = kinds and frozenset(kinds)
+        self.match = []
+        for field, values in zip(self.FIELDS, (trees, platforms, buildtypes,
+                                               tests, products)):
+            if values:
+                self.match.append((field, frozenset(values)))
+        self.predicate = predicate
+        self.batch_size = max(1, batch_size)
+        self.batch_interval = batch_interval
+        self.connections = max(1, connections)
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.headers = {'Content-Type': 'application/json'}
+        self.headers.update(headers or {})
+
+    def wants(self, kind, payload):
+        if self.kinds and kind not in self.kinds:
+            return False
+        for field, values in self.match:
+            if payload.get(field) not in values:
+                return False
+        return self.predicate is None or self.predicate(kind, payload)
+
+    def connect(self):
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.host, self.port,
+                                           timeout=self.timeout)
+        return httplib.HTTPConnection(self.host, self.port,
+                                      timeout=self.timeout)
+
+
+class DestinationSender(object):
+    """The queue, spool and sending threads of one Destination, so that
+       a slow or failing destination holds up only its own events.
+    """
+
+    # how often idle threads check for spooled events, in seconds
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, destination, spool_dir, metrics, logger):
+        self.destination = destination
+        self.logger = logger
+        self.queue = Queue.Queue(destination.max_queue)
+        self.spool = None
+        if spool_dir:
+            self.spool = Spool(os.path.join(spool_dir,
+                                            destination.name + '.spool'))
+        self.stopping = threading.Event()
+        self.threads = []
+        labels = {'destination': destination.name}
+        self.sentCount = metrics.counter(
+            'pulsebuildmonitor_forwarded_total',
+            'Events delivered to a webhook destination', **labels)
+        self.retryCount = metrics.counter(
+            'pulsebuildmonitor_forward_retries_total',
+            'Failed webhook requests which were retried', **labels)
+        self.spoolCount = metrics.counter(
+            'pulsebuildmonitor_forward_spooled_total',
+            'Events written to a webhook destination\'s spool', **labels)
+        self.dropCount = metrics.counter(
+            'pulsebuildmonitor_forward_dropped_total',
+            'Events refused by, or not queued for, a webhook destination',
+            **labels)
+        metrics.gauge('pulsebuildmonitor_forward_queued',
+                      'Events waiting to be sent to a webhook destination',
+                      function=self.queue.qsize, **labels)
+
+    def log(self, message):
+        if self.logger:
+            self.logger.warning('%s: %s' % (self.destination.name, message))
+
+    def start(self):
+        for i in xrange(self.destination.connections):
+            thread = threading.Thread(target=self.run, args=(i == 0,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, line):
+        try:
+            self.queue.put_nowait(line)
+        except Queue.Full:
+            self.save([line])
+
+    def save(self, lines):
+        """Spool events which couldn't be sent, or drop them if there is
+           no spool.
+        """
+        if self.spool:
+            try:
+                self.spool.append(lines)
+                self.spoolCount.inc(len(lines))
+                return
+            except (IOError, OSError), e:
+                self.log('could not spool events: %s' % e)
+        self.dropCount.inc(len(lines))
+
+    def next_batch(self, block=True):
+        """Returns up to batch_size queued events, waiting at most
+           batch_interval for a batch to fill once it has begun.  If
+           'block' is False, returns at once when the queue is empty.
+        """
+        try:
+            batch = [self.queue.get(block, self.POLL_INTERVAL)]
+        except Queue.Empty:
+            return []
+        deadline = time.time() + self.destination.batch_interval
+        while len(batch) < self.destination.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except Queue.Empty:
+                pass
+            remaining = deadline - time.time()
+            if remaining <= 0 or self.stopping.is_set():
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except Queue.Empty:
+                break
+        return batch
+
+    def run(self, replays):
+        """Send events until stopped and the queue is empty.  While any
+           events are spooled, new ones are spooled behind them, so that
+           the destination receives them in order once it recovers.  Only
+           the first thread replays the spool, while the destination is
+           accepting events, or max_backoff seconds after it last failed.
+        """
+        connection = [None]
+        retryAt = 0
+        while True:
+            # while there are spooled events to send, don't wait for new
+            # ones
+            batch = self.next_batch(not (replays and self.can_replay(retryAt)))
+            if batch:
+                if self.spool and self.spool.pending():
+                    self.save(batch)
+                elif self.deliver(connection, batch):
+                    retryAt = 0
+                else:
+                    self.save(batch)
+                    retryAt = time.time() + self.destination.max_backoff
+            elif self.stopping.is_set():
+                break
+            if replays and self.can_replay(retryAt):
+                if self.replay(connection):
+                    retryAt = 0
+                else:
+                    retryAt = time.time() + self.destination.max_backoff
+        if connection[0]:
+            connection[0].close()
+
+    def can_replay(self, retryAt):
+        return self.spool is not None and not self.stopping.is_set() and \
+            time.time() >= retryAt and self.spool.pending()
+
+    def replay(self, connection):
+        """Send a batch of spooled events; returns False if they couldn't
+           be sent.
+        """
+        try:
+            lines, offset = self.spool.read(self.destination.batch_size)
+        except (IOError, OSError), e:
+            self.log('could not read spool: %s' % e)
+            return False
+        if lines and not self.deliver(connection, lines):
+            return False
+        try:
+            self.spool.commit(offset)
+        except (IOError, OSError), e:
+            self.log('could not update spool: %s' % e)
+        return True
+
+    def deliver(self, connection, lines):
+        """POST events, retrying with exponential backoff.  Returns False
+           if they should be spooled.
+        """
+        destination = self.destination
+        if destination.batch_size > 1:
+            body = '[%s]' % ','.join(lines)
+        else:
+            body = lines[0]
+        delay = destination.backoff
+        for attempt in xrange(destination.retries + 1):
+            if attempt:
+                self.retryCount.inc()
+                # with jitter, so that many forwarders don't retry in step
+                if self.stopping.wait(delay * random.uniform(0.5, 1.0)) \
+                        or self.stopping.is_set():
+                    return False
+                delay = min(delay * 2, destination.max_backoff)
+            status = self.post(connection, body)
+            if status is None or status == 429 or status >= 500:
+                continue
+            if 200 <= status < 300:
+                self.sentCount.inc(len(lines))
+            else:
+                self.log('HTTP %d; dropping %d events' % (status, len(lines)))
+                self.dropCount.inc(len(lines))
+            return True
+        return False
+
+    def post(self, connection, body):
+        """Returns the response status, or None if the request failed.
+           connection[0] is reused between requests, and replaced after an
+           error.
+        """
+        destination = self.destination
+        try:
+            if connection[0] is None:
+                connection[0] = destination.connect()
+            connection[0].request('POST', destination.path, body,
+                                  destination.headers)
+            response = connection[0].getresponse()
+            # read the whole response, so that the connection can be reused
+            response.read()
+            if response.getheader('connection', '').lower() == 'close':
+                connection[0].close()
+                connection[0] = None
+            return response.status
+        except (httplib.HTTPException, socket.error), e:
+            self.log('request failed: %s' % e)
+            if connection[0]:
+                connection[0].close()
+            connection[0] = None
+            return None
+
+    def stop(self):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+class WebhookForwarder(object):
+    """A sink which POSTs build and test events to HTTP destinations,
+       each a Destination, which decides which events it receives.  Each
+       destination has its own queue and threads, so one which is slow or
+       down doesn't delay the others, and events it can't take are kept in
+       'spool_dir', if given, and sent once it recovers.
+
+       Delivery is at-least-once for spooled events.  Metrics for each
+       destination are added to 'metrics', which should be the monitor's
+       MetricsRegistry if they are to be served with its own.
+    """
+
+    def __init__(self, destinations, spool_dir=None, metrics=None,
+                 logger=None):
+        self.metrics = metrics or MetricsRegistry()
+        if spool_dir and not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+        names = [destination.name for destination in destinations]
+        if len(set(names)) != len(names):
+            raise ValueError('destination names must be unique')
+        self.senders = [DestinationSender(destination, spool_dir,
+                                          self.metrics, logger)
+                        for destination in destinations]
+        self.started = False
+        self.lock = threading.Lock()
+        # events spooled by an earlier run are sent without waiting for
+        # new ones
+        if [sender for sender in self.senders
+            if sender.spool and sender.spool.pending()]:
+            self.start()
+
+    def start(self):
+        self.lock.acquire()
+        try:
+            if not self.started:
+                for sender in self.senders:
+                    sender.start()
+                self.started = True
+        finally:
+            self.lock.release()
+
+    def add(self, kind, event):
+        if hasattr(event, 'as_dict'):
+            event = event.as_dict()
+        line = None
+        for sender in self.senders:
+            if sender.destination.wants(kind, event):
+                if line is None:
+                    # serialized once for every destination, and now,
+                    # since a callback may change the event
+                    line = json.dumps({'kind': kind, 'payload': event})
+                    self.start()
+                sender.put(line)
+
+    def close(self):
+        """Send the queued events, spooling those which can't be sent,
+           and stop the threads.
+        """
+        for sender in self.senders:
+            sender.stopping.set()
+        for sender in self.senders:
+            sender.stop()
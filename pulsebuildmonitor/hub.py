@@ -0,0 +1,143 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import threading
+
+from factory import FactoryBuildMonitor, random_label
+from filters import MessageFilter
+from lazy import decoded
+from pulsebuildmonitor import PulseBuildMonitor
+
+
+class Subscription(object):
+    """A set of filters and the callbacks to notify about the messages
+       which pass them.  The arguments have the same meaning as those of
+       start_pulse_monitor.
+    """
+
+    def __init__(self, buildCallback=None, testCallback=None,
+                 pulseCallback=None, trees=None, platforms=None,
+                 buildtypes=None, tests=None, products=None,
+                 buildtags=None, talos=False):
+        self.buildCallback = buildCallback
+        self.testCallback = testCallback
+        self.pulseCallback = pulseCallback
+        self.filter = MessageFilter(trees=trees,
+                                    platforms=platforms,
+                                    buildtypes=buildtypes,
+                                    tests=tests,
+                                    products=products,
+                                    buildtags=buildtags,
+                                    builds=buildCallback is not None,
+                                    unittests=testCallback is not None,
+                                    talos=talos and testCallback is not None)
+
+
+class PulseHub(FactoryBuildMonitor):
+    """A monitor which owns a single pulse consumer and delivers each
+       message, decoded and parsed once, to any number of subscriptions.
+       Subscriptions may be added and removed while the hub is running.
+
+       builds, unittests and talos determine which pulse topics the hub's
+       consumer is bound to; subscriptions can only receive messages from
+       these topics.  Callbacks are run using 'dispatcher', or on a new
+       thread per call if it is None, as with FactoryBuildMonitor.
+    """
+
+    def __init__(self, label=None, durable=False, logger=None,
+                 builds=True, unittests=True, talos=True, dispatcher=None,
+                 acknowledger=None, typed_events=False, metrics=None,
+                 profiler=None, batcher=None, transport=None, shedder=None,
+                 deduplicator=None, coalescer=None, sinks=None):
+        self.label = label or random_label()
+        self.dispatcher = dispatcher
+        self.profiler = profiler
+        self.batcher = batcher
+        self.shedder = shedder
+        self.monitorThread = None
+        self.pulseCallback = None
+        self.subscriptions = ()
+        self.subscriptionLock = threading.Lock()
+
+        PulseBuildMonitor.__init__(self,
+                                   label=self.label,
+                                   trees=None,
+                                   durable=durable,
+                                   logger=logger,
+                                   builds=builds,
+                                   unittests=unittests,
+                                   talos=talos,
+                                   acknowledger=acknowledger,
+                                   typed_events=typed_events,
+                                   metrics=metrics,
+                                   deduplicator=deduplicator,
+                                   coalescer=coalescer,
+                                   transport=transport,
+                                   sinks=sinks)
+        self.setup_callback_metrics()
+
+    def subscribe(self, subscription=None, **kwargs):
+        """Add a Subscription, or create one from the keyword arguments,
+           and return it.
+        """
+        if subscription is None:
+            subscription = Subscription(**kwargs)
+        self.subscriptionLock.acquire()
+        try:
+            # replace rather than mutate, so the monitor thread can iterate
+            # over the tuple without holding the lock
+            self.subscriptions = self.subscriptions + (subscription,)
+        finally:
+            self.subscriptionLock.release()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptionLock.acquire()
+        try:
+            self.subscriptions = tuple(s for s in self.subscriptions
+                                       if s is not subscription)
+        finally:
+            self.subscriptionLock.release()
+
+    def on_pulse_message(self, data):
+        for subscription in self.subscriptions:
+            if subscription.pulseCallback and \
+                    (not self.shedder or self.shedder.accept_pulse()):
+                data = decoded(data)
+                self.dispatch(subscription.pulseCallback, data, lane='pulse')
+
+    def on_message(self, rk, payload):
+        """Find the subscriptions whose filters accept the message, and
+           pass its event through deduplication and coalescing, as for
+           any monitor, to notify_complete.
+        """
+        if self.rejected(self.filter, rk, payload):
+            return
+        subscriptions = [subscription
+                         for subscription in self.subscriptions
+                         if subscription.filter.accepts(rk, payload)]
+        if not subscriptions and not self.sinks:
+            return
+        if self.is_duplicate(rk, payload):
+            return
+
+        builddata = self.make_builddata(rk, payload)
+        if self.coalescer:
+            self.coalesce(rk, payload, builddata, subscriptions)
+        else:
+            self.notify_complete(rk.kind, builddata, subscriptions)
+
+    def notify_complete(self, kind, builddata, targets=None):
+        """Pass an event to our sinks, then to the callbacks of the
+           subscriptions in 'targets'.
+        """
+        self.send_to_sinks(kind, builddata)
+        for subscription in targets or ():
+            if kind == 'build':
+                self.dispatch_event(subscription.buildCallback, builddata,
+                                    kind)
+            else:
+                self.dispatch_event(subscription.testCallback, builddata,
+                                    kind)
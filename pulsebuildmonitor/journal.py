@@ -0,0 +1,209 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import glob
+import os
+import re
+import threading
+import time
+try:
+    import json
+except:
+    import simplejson as json
+
+
+class StateJournal(object):
+    """Crash-safe persistence for state which changes one record at a time.
+
+       Records are appended to a journal file by a background thread,
+       which writes and fsyncs whatever has accumulated at most once every
+       'sync_interval' seconds, so append() never waits for the disk.
+       compact() replaces the journal with a snapshot of the whole state.
+       The directory holds:
+
+         snapshot.json    - {"generation": N, "state": ...}, replaced
+                            atomically
+         journal.N.log    - the records appended since snapshot N, one JSON
+                            document per line
+
+       A record torn by a crash is ignored when the journal is loaded.
+    """
+
+    SNAPSHOT = 'snapshot.json'
+    JOURNAL = 'journal.%d.log'
+
+    def __init__(self, directory, sync_interval=1.0, compact_every=10000,
+                 logger=None):
+        self.directory = directory
+        self.sync_interval = sync_interval
+        self.compact_every = compact_every
+        self.logger = logger
+        self.generation = 0
+        self.records = 0
+        self.pending = []
+        self.cond = threading.Condition()
+        self.journal = None
+        self.writer = None
+        self.closed = False
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def load(self):
+        """Returns (state, records): the last snapshot's state, or None,
+           and the records appended since it, oldest first.  Must be
+           called before append().
+        """
+        state = None
+        try:
+            f = open(self.path(self.SNAPSHOT))
+            try:
+                snapshot = json.load(f)
+            finally:
+                f.close()
+            self.generation = snapshot['generation']
+            state = snapshot['state']
+        except IOError:
+            pass
+
+        records = []
+        journal = self.path(self.JOURNAL % self.generation)
+        if os.path.exists(journal):
+            f = open(journal, 'rb+')
+            try:
+                good = 0
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break
+                    good += len(line)
+                # drop a torn final record, so new ones follow a full line
+                f.truncate(good)
+            finally:
+                f.close()
+        self.records = len(records)
+
+        # journals from before the snapshot are no longer needed
+        for name in glob.glob(self.path('journal.*.log')):
+            m = re.search(r'journal\.(\d+)\.log$', name)
+            if m and int(m.group(1)) != self.generation:
+                os.remove(name)
+        return state, records
+
+    def start(self):
+        if self.writer:
+            return
+        self.journal = open(self.path(self.JOURNAL % self.generation), 'ab')
+        self.writer = threading.Thread(target=self.write_pending)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def append(self, record):
+        """Queue a JSON-serializable record to be written."""
+        self.start()
+        self.cond.acquire()
+        try:
+            self.pending.append(json.dumps(record) + '\n')
+            self.records += 1
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    @property
+    def needs_compaction(self):
+        return self.records >= self.compact_every
+
+    def compact(self, state):
+        """Replace the journal with a snapshot of 'state', which must
+           include the effect of every record appended so far.  To
+           guarantee that, callers should hold the lock which serializes
+           their calls to append().
+        """
+        self.start()
+        self.cond.acquire()
+        try:
+            # serialized now, since the caller may change it once we return
+            self.pending.append(('snapshot', json.dumps(state)))
+            self.records = 0
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def close(self):
+        """Write everything pending and stop the writer thread."""
+        self.cond.acquire()
+        try:
+            self.closed = True
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        if self.writer:
+            self.writer.join()
+            self.writer = None
+
+    def write_pending(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                batch, self.pending = self.pending, []
+                closed = self.closed
+            finally:
+                self.cond.release()
+
+            try:
+                self.write_batch(batch)
+            except Exception, inst:
+                if self.logger:
+                    self.logger.exception(inst)
+            if closed:
+                self.journal.close()
+                return
+            # let records accumulate, so each fsync covers many of them
+            time.sleep(self.sync_interval)
+
+    def write_batch(self, batch):
+        lines = []
+        for item in batch:
+            if isinstance(item, tuple):
+                self.journal.write(''.join(lines))
+                lines = []
+                self.write_snapshot(item[1])
+            else:
+                lines.append(item)
+        if lines:
+            self.journal.write(''.join(lines))
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def write_snapshot(self, serialized):
+        generation = self.generation + 1
+        tmp = self.path(self.SNAPSHOT + '.tmp')
+        f = open(tmp, 'wb')
+        try:
+            f.write('{"generation": %d, "state": %s}' % (generation, serialized))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp, self.path(self.SNAPSHOT))
+        # make the rename itself durable
+        dirfd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+        old = self.journal.name
+        self.journal.close()
+        self.generation = generation
+        self.journal = open(self.path(self.JOURNAL % generation), 'ab')
+        os.remove(old)
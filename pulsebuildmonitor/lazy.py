@@ -0,0 +1,103 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import re
+try:
+    import json
+except:
+    import simplejson as json
+
+
+# routing keys never contain quotes or escapes, so the key can be found
+# in a message's JSON without decoding the rest of it
+_routingKeyRe = re.compile(r'"routing_key"\s*:\s*"([^"\\]+)"')
+
+
+def decode_line(line):
+    """Decode one line of a stream of messages.  Lines are either pulse
+       messages, or entries written by MessageRecorder, which hold the
+       message in 'data'.
+    """
+    entry = json.loads(line)
+    if '_meta' not in entry and 'data' in entry:
+        return entry['data']
+    return entry
+
+
+class LazyPayload(object):
+    """Stands in for the payload of a LazyPulseData, decoding the message
+       the first time one of its fields is read.
+    """
+
+    __slots__ = ('message',)
+
+    def __init__(self, message):
+        self.message = message
+
+    def decode(self):
+        return self.message.decode()['payload']
+
+    def __getitem__(self, key):
+        return self.decode()[key]
+
+    def __contains__(self, key):
+        return key in self.decode()
+
+    def get(self, key, default=None):
+        return self.decode().get(key, default)
+
+    def __iter__(self):
+        return iter(self.decode())
+
+    def iteritems(self):
+        return self.decode().iteritems()
+
+
+class LazyPulseData(object):
+    """A pulse message kept as its JSON text.  data['_meta']['routing_key']
+       is found without decoding the message, and data['payload'] returns
+       a LazyPayload, so a message rejected on its routing key is never
+       decoded.  decode() returns the message as a dict.
+    """
+
+    __slots__ = ('body', 'routing_key', 'decoded')
+
+    def __init__(self, body, routing_key=None):
+        self.body = body
+        self.decoded = None
+        if routing_key is None:
+            m = _routingKeyRe.search(body)
+            if m:
+                routing_key = m.group(1)
+            else:
+                routing_key = self.decode()['_meta']['routing_key']
+        self.routing_key = routing_key
+
+    def decode(self):
+        if self.decoded is None:
+            self.decoded = decode_line(self.body)
+        return self.decoded
+
+    def __getitem__(self, key):
+        if key == '_meta' and self.decoded is None:
+            return {'routing_key': self.routing_key}
+        if key == 'payload':
+            return LazyPayload(self)
+        return self.decode()[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+def decoded(data):
+    """Returns 'data', a message or payload, as a dict, decoding it if it
+       is a LazyPulseData or LazyPayload.
+    """
+    if isinstance(data, (LazyPulseData, LazyPayload)):
+        return data.decode()
+    return data
@@ -0,0 +1,220 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import bisect
+import cProfile
+import pstats
+import random
+import threading
+
+
+# upper bounds, in seconds, of the default histogram buckets
+DEFAULT_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01,
+                   0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+
+def _format_labels(labels, extra=()):
+    items = sorted(labels) + list(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                         .replace('"', '\\"'))
+                             for name, value in items)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return '%d' % value
+    return repr(value)
+
+
+class Counter(object):
+    """A monotonically increasing count.  inc() doesn't lock; counters
+       updated from several threads may rarely lose an increment, which is
+       an acceptable price for keeping the message path cheap.
+       If 'function' is given, the value is whatever it returns when the
+       metrics are read, for counts kept elsewhere.
+    """
+
+    type = 'counter'
+
+    def __init__(self, labels, function=None):
+        self.labels = labels
+        self.function = function
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name):
+        value = self.function() if self.function else self.value
+        return [(name, self.labels, (), value)]
+
+
+class Gauge(Counter):
+    """A value which can go up and down."""
+
+    type = 'gauge'
+
+    def __init__(self, labels, function=None):
+        Counter.__init__(self, labels, function)
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        self.lock.acquire()
+        self.value += amount
+        self.lock.release()
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(object):
+    """Counts observations in cumulative buckets, and their sum."""
+
+    type = 'histogram'
+
+    def __init__(self, labels, buckets=DEFAULT_BUCKETS):
+        self.labels = labels
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        self.lock.acquire()
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+        self.lock.release()
+
+    def samples(self, name):
+        samples = []
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            samples.append((name + '_bucket', self.labels,
+                            (('le', _format_value(float(bound))),), total))
+        samples.append((name + '_sum', self.labels, (), self.sum))
+        samples.append((name + '_count', self.labels, (), self.count))
+        return samples
+
+
+class MetricsRegistry(object):
+    """A set of named metrics, each of which may have several label sets.
+       Asking for the same name and labels again returns the same metric.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.help = {}
+        self.types = {}
+        self.lock = threading.Lock()
+
+    def get(self, cls, name, help, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            self.lock.acquire()
+            try:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    if self.types.setdefault(name, cls.type) != cls.type:
+                        raise ValueError('%s is already a %s' %
+                                         (name, self.types[name]))
+                    self.help.setdefault(name, help)
+                    metric = cls(key[1], **kwargs)
+                    self.metrics[key] = metric
+            finally:
+                self.lock.release()
+        return metric
+
+    def counter(self, name, help='', function=None, **labels):
+        return self.get(Counter, name, help, labels, function=function)
+
+    def gauge(self, name, help='', function=None, **labels):
+        return self.get(Gauge, name, help, labels, function=function)
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS, **labels):
+        return self.get(Histogram, name, help, labels, buckets=buckets)
+
+    def collect(self):
+        """Returns [(name, type, help, [(sample name, labels, extra labels,
+           value)])] for every metric name, sorted by name.
+        """
+        byname = {}
+        for (name, labels), metric in self.metrics.items():
+            byname.setdefault(name, []).extend(metric.samples(name))
+        return [(name, self.types[name], self.help[name], byname[name])
+                for name in sorted(byname)]
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, type, help, samples in self.collect():
+            if help:
+                lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, type))
+            for sample, labels, extra, value in samples:
+                lines.append('%s%s %s' % (sample, _format_labels(labels, extra),
+                                          _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """Returns {sample name: [(labels dict, value)]}."""
+        result = {}
+        for name, type, help, samples in self.collect():
+            for sample, labels, extra, value in samples:
+                result.setdefault(sample, []).append(
+                    (dict(labels + extra), value))
+        return result
+
+
+class CallbackProfiler(object):
+    """Runs a random sample of callbacks under cProfile and accumulates
+       the results, so that the cost of callbacks in production can be
+       examined without profiling every call.
+    """
+
+    def __init__(self, sample_rate=0.01):
+        self.sample_rate = sample_rate
+        self.stats = None
+        self.samples = 0
+        self.lock = threading.Lock()
+
+    def sample(self):
+        """Returns True if the next callback should be profiled."""
+        return random.random() < self.sample_rate
+
+    def runcall(self, callback, *args):
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(callback, *args)
+        finally:
+            self.lock.acquire()
+            try:
+                self.samples += 1
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+            finally:
+                self.lock.release()
+
+    def dump(self, path):
+        """Write the accumulated profile to 'path', for use with pstats."""
+        self.lock.acquire()
+        try:
+            if self.stats:
+                self.stats.dump_stats(path)
+        finally:
+            self.lock.release()
@@ -8,14 +8,21 @@ import datetime
 import httplib
 import os
 import re
+import threading
 import time
 import traceback
 try:
   import json
 except:
   import simplejson as json
-from dateutil.parser import parse
-from mozillapulse import consumers
+
+from acks import MessageAcknowledger
+from events import BuildEvent, TestEvent
+from filters import MessageFilter, key_category, parse_routing_key
+import filters
+from lazy import decoded
+from metrics import MetricsRegistry
+from transports import PulseTransport
 
 
 class BadPulseMessageError(Exception):
@@ -28,14 +35,16 @@ class BadPulseMessageError(Exception):
 
 class PulseBuildMonitor(object):
 
-  unittestsRe = re.compile(r'(unittest|talos).(.*?)\.(.*?)\.(.*?)\.(.*?)\.(.*?)\.(.*?)\.(.*)')
-  buildsRe = re.compile(r'build.(.*?)\.(.*?)\.(.*?)\.(.*)')
+  unittestsRe = filters.unittestsRe
+  buildsRe = filters.buildsRe
 
   def __init__(self, label=None, trees='mozilla-central',
                durable=False, platforms=None, tests=None,
                buildtypes=None, products=None, buildtags=None,
                logger=None, talos=False, builds=False,
-               unittests=False):
+               unittests=False, acknowledger=None, typed_events=False,
+               metrics=None, deduplicator=None, coalescer=None, shard=None,
+               transport=None, fields=None, sinks=None):
     self.label = label
     self.trees = trees
     self.platforms = platforms
@@ -48,13 +57,21 @@ class PulseBuildMonitor(object):
     self.builds = builds
     self.buildtags = buildtags
     self.unittests = unittests
+    self.acknowledger = acknowledger or MessageAcknowledger()
+    self.typed_events = typed_events
+    # the PendingAck of the message being processed by each thread
+    self.ackContext = threading.local()
+    self.deduplicator = deduplicator
+    self.coalescer = coalescer
+    self.shard = shard
+    self.fields = fields and tuple(fields)
+    self.sinks = list(sinks or ())
+    self.metrics = metrics or MetricsRegistry()
 
     assert(self.talos or self.builds or self.unittests)
 
-    # setup the pulse consumer
-    if not self.label:
-      raise Exception('label not defined')
-    self.pulse = consumers.NormalizedBuildConsumer(applabel=self.label)
+    # setup the pulse consumer, unless we were given another transport
+    self.pulse = transport or PulseTransport(self.label)
     topics = []
     if self.talos:
         topics.append("talos.#")
@@ -64,11 +81,56 @@ class PulseBuildMonitor(object):
         topics.append("unittest.#")
     self.pulse.configure(topic=topics,
                          callback=self.pulse_message_received,
-                         durable=self.durable)
+                         durable=self.durable,
+                         idle=self.acknowledger.drain)
+    # the transport sets the prefetch limit before it starts consuming,
+    # and again whenever the acknowledger's limit changes
+    self.acknowledger.bind(self.pulse.set_prefetch)
 
     if isinstance(self.trees, basestring):
       self.trees = [self.trees]
 
+    # compile the filters once, rather than checking lists per message
+    self.filter = MessageFilter(trees=self.trees,
+                                platforms=self.platforms,
+                                buildtypes=self.buildtypes,
+                                tests=self.tests,
+                                products=self.products,
+                                buildtags=self.buildtags,
+                                builds=self.builds,
+                                unittests=self.unittests,
+                                talos=self.talos)
+
+    # the metrics updated for every message are looked up once, here
+    self.messageCount = self.metrics.counter(
+        'pulsebuildmonitor_messages_total', 'Pulse messages received')
+    self.badMessageCount = self.metrics.counter(
+        'pulsebuildmonitor_bad_messages_total',
+        'Messages whose routing key could not be parsed')
+    self.errorCount = self.metrics.counter(
+        'pulsebuildmonitor_errors_total',
+        'Messages whose processing raised an exception')
+    self.deliveredCount = {}
+    for kind in ('build', 'unittest', 'talos'):
+      self.deliveredCount[kind] = self.metrics.counter(
+          'pulsebuildmonitor_delivered_total',
+          'Messages which passed the filters', kind=kind)
+    self.filteredCount = {}
+    for reason in ('build', 'unittest', 'talos', 'tree', 'platform',
+                   'buildtype', 'test', 'product', 'buildtag', 'shard'):
+      self.filteredCount[reason] = self.metrics.counter(
+          'pulsebuildmonitor_filtered_total',
+          'Messages rejected by a filter', reason=reason)
+    self.messageTime = self.metrics.histogram(
+        'pulsebuildmonitor_message_seconds',
+        'Time spent handling each message on the listener thread')
+    self.duplicateCount = self.metrics.counter(
+        'pulsebuildmonitor_duplicates_total',
+        'Events dropped as copies of one delivered recently')
+    self.supersededCount = self.metrics.counter(
+        'pulsebuildmonitor_superseded_total',
+        'Events replaced by a later one while being coalesced')
+
   def purge_pulse_queue(self):
     """Purge any messages from the queue.  This has no effect if you're not
        using a durable queue.
@@ -81,11 +143,18 @@ class PulseBuildMonitor(object):
        seconds since epoch
     """
 
+    from dateutil.parser import parse
     date = parse(string)
     return (date, int(time.mktime(date.timetuple())))
 
+  def close_sinks(self):
+    """Close our sinks, so that they write any events they are holding."""
+    for sink in self.sinks:
+      sink.close()
+
   def listen(self):
-    """Start listening for pulse messages.  This call never returns.
+    """Start listening for pulse messages.  This call doesn't return,
+       unless the transport is closed.
     """
     self.pulse.listen()
 
@@ -115,96 +184,190 @@ class PulseBuildMonitor(object):
 
   onPulseMessage = on_pulse_message
 
+  def on_message(self, rk, payload):
+    """Called for every message whose routing key could be parsed and is of
+       a category we're interested in; 'rk' is the parsed RoutingKey.
+       Applies our filters and calls on_build_complete or on_test_complete.
+    """
+    if self.rejected(self.filter, rk, payload):
+      return
+    if self.is_duplicate(rk, payload):
+      return
+
+    builddata = self.make_builddata(rk, payload)
+    if self.coalescer:
+      self.coalesce(rk, payload, builddata)
+    else:
+      self.notify_complete(rk.kind, builddata)
+
+  def notify_complete(self, kind, builddata, targets=None):
+    """Pass an event to our sinks, then to on_build_complete or
+       on_test_complete.  'targets' is whatever a subclass which delivers
+       events to several places (PulseHub) passed to coalesce() to say
+       where this one goes.
+    """
+    self.send_to_sinks(kind, builddata)
+    if kind == 'build':
+      self.on_build_complete(builddata)
+    else:
+      self.on_test_complete(builddata)
+
+  def send_to_sinks(self, kind, builddata):
+    for sink in self.sinks:
+      try:
+        sink.add(kind, builddata)
+      except Exception, inst:
+        # one failing sink shouldn't stop the callbacks, or the others
+        self.errorCount.inc()
+        if self.logger:
+          self.logger.exception(inst)
+        traceback.print_exc()
+
+  def is_duplicate(self, rk, payload):
+    """Returns True if our deduplicator has seen this event recently."""
+    if self.deduplicator and self.deduplicator.is_duplicate(rk.kind, payload):
+      self.duplicateCount.inc()
+      return True
+    return False
+
+  def coalesce(self, rk, payload, builddata, targets=None):
+    """Hand an event to our coalescer.  If the acknowledger waits for
+       callbacks, the message stays unacknowledged until the event has
+       been delivered, or replaced by a later one.
+    """
+    self.coalescer.start(self.deliver_coalesced, self.release_superseded)
+    pending = getattr(self.ackContext, 'pending', None)
+    token = (pending, self.defer_ack(), targets)
+    if self.coalescer.add(rk.kind, payload, builddata, token):
+      self.supersededCount.inc()
+
+  def deliver_coalesced(self, kind, builddata, token):
+    """Called on the coalescer's thread to deliver a held event."""
+    pending, release, targets = token
+    self.ackContext.pending = pending
+    succeeded = False
+    try:
+      self.notify_complete(kind, builddata, targets)
+      succeeded = True
+    except Exception, inst:
+      self.errorCount.inc()
+      if self.logger:
+        self.logger.exception(inst)
+      traceback.print_exc()
+    finally:
+      self.ackContext.pending = None
+      if release:
+        release(succeeded)
+
+  def release_superseded(self, token):
+    pending, release, targets = token
+    if release:
+      release(True)
+
+  def rejected(self, filter, rk, payload):
+    """Returns True if 'filter' rejects the message, counting the
+       rejection against the filter responsible, or counting the message
+       as delivered if it is accepted.
+    """
+    reason = (filter.reject_reason(rk) or
+              filter.payload_reject_reason(rk, payload))
+    if reason is None and self.shard and not self.shard.owns(payload):
+      reason = 'shard'
+    if reason is None:
+      self.deliveredCount[rk.kind].inc()
+      return False
+    self.filteredCount[reason].inc()
+    return True
+
+  def make_builddata(self, rk, payload):
+    """Returns what on_build_complete or on_test_complete should be passed
+       for a message: the payload dict, or a BuildEvent or TestEvent if
+       typed_events is set.  If we were given 'fields', only those are
+       kept.
+    """
+    payload = decoded(payload)
+    if self.fields:
+      payload = dict((field, payload.get(field)) for field in self.fields)
+    if not self.typed_events:
+      return payload
+    if rk.kind == 'build':
+      return BuildEvent.from_payload(payload)
+    return TestEvent.from_payload(payload)
+
+  def parse_key(self, key):
+    """Parse a routing key.  Returns None if the key belongs to a category
+       of messages (builds or tests) that we don't want, and raises
+       BadPulseMessageError if it can't be parsed.
+    """
+    category = key_category(key)
+    if category is None:
+      raise BadPulseMessageError(key)
+    if not self.filter.wants_category(category):
+      # counted against the kind of message, as reject_reason() would
+      if category == 'build':
+        self.filteredCount['build'].inc()
+      elif key.startswith('talos'):
+        self.filteredCount['talos'].inc()
+      else:
+        self.filteredCount['unittest'].inc()
+      return None
+
+    rk = parse_routing_key(key)
+    if rk is None:
+      raise BadPulseMessageError(key)
+    return rk
+
+  def defer_ack(self):
+    """Called while a message is being processed by code which hands it off
+       to another thread.  Returns a function which must be called with
+       True or False once that work has finished, or None if our
+       acknowledger doesn't wait for callbacks.
+    """
+    pending = getattr(self.ackContext, 'pending', None)
+    if pending is None or not self.acknowledger.waits_for_callbacks:
+      return None
+    return pending.hold()
+
   def pulse_message_received(self, data, message):
     """Called whenever our pulse consumer receives a message.
     """
 
-    # acknowledge the message, to remove it from the queue
-    message.ack()
-
-    # we determine if this message is of interest to us by examining
-    # the routing_key
-    key = data['_meta']['routing_key']
+    # acknowledge the message, to remove it from the queue, or arrange
+    # for it to be acknowledged once it has been processed
+    pending = self.acknowledger.received(message)
+    self.ackContext.pending = pending
+    succeeded = False
+    started = time.time()
+    self.messageCount.inc()
 
     try:
+      # we determine if this message is of interest to us by examining
+      # the routing_key
+      key = data['_meta']['routing_key']
+
       self.on_pulse_message(data)
 
-      if key.startswith('unittest') or key.startswith('talos'):
-        if self.unittests or self.talos:
-          m = self.unittestsRe.match(key)
-          if not m:
-            raise BadPulseMessageError(key)
-          talos = 'talos' in m.group(1)
-          tree = m.group(2)
-          platform = m.group(3)
-          os = m.group(4)
-          buildtype = m.group(5)
-          test = m.group(6)
-          product = m.group(7)
-          builder = m.group(8)
-
-          if (talos and not self.talos) or (not talos and not self.unittests):
-            return
-
-          if self.trees and tree not in self.trees:
-            return
-          if self.platforms and platform not in self.platforms:
-            return
-          if self.buildtypes and buildtype not in self.buildtypes:
-            return
-          if self.tests and test not in self.tests:
-            return
-          if self.products and product not in self.products:
-            return
-
-          self.on_test_complete(data['payload'])
-
-      elif key.startswith('build'):
-        if self.builds:
-          m = self.buildsRe.match(key)
-          if not m:
-            raise BadPulseMessageError(key)
-          tree = m.group(1)
-          platform = m.group(2)
-          buildtype = m.group(3)
-          extra = m.group(4)
-
-          if self.trees and tree not in self.trees:
-            return
-          if self.platforms and platform not in self.platforms:
-            return
-          if self.buildtypes and buildtype not in self.buildtypes:
-            return
-          if self.products and data['payload']['product'] not in self.products:
-            return
-          if self.buildtags:
-            if isinstance(self.buildtags[0], basestring):
-              # a list of tags which must all be present
-              tags = [x for x in self.buildtags if x in data['payload']['tags']]
-              if len(tags) != len(self.buildtags):
-                return
-            elif isinstance(self.buildtags[0], list):
-              # a nested list of tags, any one of which must all be present
-              tagsMatch = False
-              for taglist in self.buildtags:
-                tags = [x for x in taglist if x in data['payload']['tags']]
-                if len(tags) == len(self.buildtags):
-                  tagsMatch = True
-                  break
-              if not tagsMatch:
-                return
-            else:
-              raise Exception('buildtags must be a list of strings or a list of lists')
-
-          self.on_build_complete(data['payload'])
-
-      else:
-        raise BadPulseMessageError(key)
+      rk = self.parse_key(key)
+      if rk is not None:
+        self.on_message(rk, data['payload'])
+      succeeded = True
 
     except Exception, inst:
+      # a message we can't parse won't improve by being redelivered
+      succeeded = isinstance(inst, BadPulseMessageError)
+      if succeeded:
+        self.badMessageCount.inc()
+      else:
+        self.errorCount.inc()
       if self.logger:
         self.logger.exception(inst)
         traceback.print_exc()
       else:
         raise
 
+    finally:
+      self.ackContext.pending = None
+      pending.release(succeeded)
+      # we're on the consumer thread, so may ack what has been settled
+      self.acknowledger.drain()
+      self.messageTime.observe(time.time() - started)
@@ -0,0 +1,165 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import gzip
+import itertools
+import random
+import threading
+import time
+try:
+    import json
+except:
+    import simplejson as json
+
+
+class FakeMessage(object):
+    """Stands in for a pulse (kombu) message when messages are replayed.
+    """
+
+    def __init__(self, delivery_tag=None):
+        self.delivery_tag = delivery_tag
+        self.state = 'RECEIVED'
+
+    @property
+    def acknowledged(self):
+        return self.state != 'RECEIVED'
+
+    def ack(self):
+        self.state = 'ACK'
+
+    def reject(self, requeue=False):
+        self.state = 'REQUEUED' if requeue else 'REJECTED'
+
+    def requeue(self):
+        self.reject(requeue=True)
+
+
+class MessageRecorder(object):
+    """Records pulse messages to a gzipped file, one JSON document per line
+       holding the time the message was received and the message itself.
+       record() can be used as a pulseCallback:
+
+         recorder = MessageRecorder('messages.json.gz')
+         monitor = start_pulse_monitor(pulseCallback=recorder.record, ...)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, 'wb')
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def record(self, data):
+        line = json.dumps({'time': time.time(), 'data': data}) + '\n'
+        self.lock.acquire()
+        try:
+            self.file.write(line)
+            self.count += 1
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.file.close()
+        finally:
+            self.lock.release()
+
+
+def read_recording(path):
+    """Yields (time, data) for each message in a recording."""
+    f = gzip.open(path, 'rb')
+    try:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                yield entry['time'], entry['data']
+    finally:
+        f.close()
+
+
+def synthetic_messages(count, trees=('mozilla-central', 'mozilla-inbound',
+                                     'try', 'fx-team'),
+                       platforms=('linux', 'linux64', 'win32', 'macosx64',
+                                  'android'),
+                       buildtypes=('opt', 'debug'), seed=0):
+    """Yields (time, data) for 'count' generated build, unittest and talos
+       messages, for use when no recording is available.  About one in
+       ten messages is a build, and a fifth of the tests are talos.
+    """
+    rand = random.Random(seed)
+    tests = ('mochitest-1', 'mochitest-2', 'reftest', 'crashtest',
+             'xpcshell', 'jsreftest')
+    talos = ('tp5', 'dromaeojs', 'svgr', 'tsvg')
+    oses = {'linux': 'fedora', 'linux64': 'fedora64', 'win32': 'win7',
+            'macosx64': 'snowleopard', 'android': 'tegra'}
+    start = time.time()
+    for i in xrange(count):
+        tree = rand.choice(trees)
+        platform = rand.choice(platforms)
+        buildtype = rand.choice(buildtypes)
+        revision = '%012x' % rand.randrange(16 ** 12)
+        payload = {'tree': tree, 'platform': platform,
+                   'buildtype': buildtype, 'product': 'firefox',
+                   'revision': revision, 'builddate': int(start) + i,
+                   'buildername': '%s %s %s build' % (platform, tree, buildtype),
+                   'timestamp': time.strftime('%Y%m%d%H%M%S'),
+                   'buildurl': 'http://ftp.mozilla.org/%s/%s.tar.bz2' % (tree, revision),
+                   'release': None}
+        kind = rand.random()
+        if kind < 0.1:
+            key = 'build.%s.%s.%s.l10n' % (tree, platform, buildtype)
+            payload['testsurl'] = payload['buildurl'].replace('.tar.bz2', '.tests.zip')
+            payload['tags'] = rand.choice([[], ['nightly'], ['pgo', 'nightly']])
+        else:
+            istalos = kind > 0.82
+            test = rand.choice(talos if istalos else tests)
+            key = '%s.%s.%s.%s.%s.%s.firefox.%d' % (
+                'talos' if istalos else 'unittest', tree, platform,
+                oses[platform], buildtype, test, i)
+            payload.update({'test': test, 'talos': istalos,
+                            'os': oses[platform], 'buildnumber': i,
+                            'logurl': 'http://ftp.mozilla.org/logs/%d.txt.gz' % i})
+        payload['key'] = key
+        yield start + i * 0.01, {'_meta': {'routing_key': key},
+                                 'payload': payload}
+
+
+class ReplayDriver(object):
+    """Feeds recorded messages to a message handler, normally a monitor's
+       pulse_message_received, each with a FakeMessage.
+
+       source   - a recording's path, or an iterable of (time, data)
+       handler  - called as handler(data, message)
+       realtime - if True, messages are delivered with the recorded gaps
+                  between them, divided by 'speed'; otherwise as fast as
+                  possible
+    """
+
+    def __init__(self, source, handler, realtime=False, speed=1.0):
+        if isinstance(source, basestring):
+            source = read_recording(source)
+        self.source = source
+        self.handler = handler
+        self.realtime = realtime
+        self.speed = speed
+
+    def run(self, limit=None):
+        """Replay the messages, and return the number delivered."""
+        tags = itertools.count(1)
+        first = None
+        started = time.time()
+        delivered = 0
+        for recorded, data in itertools.islice(self.source, limit):
+            if self.realtime:
+                if first is None:
+                    first = recorded
+                wait = (recorded - first) / self.speed - (time.time() - started)
+                if wait > 0:
+                    time.sleep(wait)
+            message = FakeMessage(next(tags))
+            self.handler(data, message)
+            delivered += 1
+        return delivered
@@ -0,0 +1,178 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import random
+import threading
+
+from coalesce import event_key
+
+
+class LoadShedder(object):
+    """Bounds the work a FactoryBuildMonitor has in progress, and decides
+       what to give up when its callbacks can't keep up.
+
+       max_pending   - the most callbacks which may be dispatched and not
+                       yet finished.  Beyond this the pulse thread waits
+                       for one to finish, so no more messages are consumed
+                       until there is room.
+       shed_at       - the number of pending callbacks at which we are
+                       overloaded; by default, 80% of max_pending
+       drop          - categories ('build', 'unittest', 'talos') whose
+                       events are dropped while we are overloaded
+       pulse_sample  - if set, the fraction of messages passed to
+                       pulseCallback
+       keep_latest   - payload fields.  If given, an event which has the
+                       same fields as one still waiting for a worker
+                       replaces it, so only the latest is handled.
+       overload_prefetch - if set, the acknowledger's prefetch is reduced
+                       to this while we are overloaded, so the broker holds
+                       on to more of the backlog.  It has no effect in
+                       'immediate' ack mode.
+    """
+
+    def __init__(self, max_pending=1000, shed_at=None, drop=(),
+                 pulse_sample=None, keep_latest=None,
+                 overload_prefetch=None):
+        assert(max_pending > 0)
+        self.max_pending = max_pending
+        self.shed_at = shed_at or max(1, int(max_pending * 0.8))
+        self.drop = frozenset(drop)
+        self.pulse_sample = pulse_sample
+        self.keep_latest = keep_latest and tuple(keep_latest)
+        self.overload_prefetch = overload_prefetch
+        self.pending = 0
+        self.overloaded = False
+        self.waiting = {}
+        self.cond = threading.Condition()
+        self.on_overload = None
+        self.counters = {}
+        self.metrics = None
+
+    def bind(self, metrics, on_overload=None):
+        """Called by the monitor with its MetricsRegistry, and a function
+           to call with True or False when we become overloaded or
+           recover.
+        """
+        self.metrics = metrics
+        self.on_overload = on_overload
+        metrics.gauge('pulsebuildmonitor_overloaded',
+                      'Whether the monitor is shedding load',
+                      function=lambda: int(self.overloaded))
+
+    def shed(self, policy, lane):
+        """Count an event or message shed by 'policy'."""
+        if self.metrics is None:
+            return
+        counter = self.counters.get((policy, lane))
+        if counter is None:
+            counter = self.counters[(policy, lane)] = self.metrics.counter(
+                'pulsebuildmonitor_shed_total',
+                'Events and messages dropped to shed load',
+                policy=policy, lane=lane)
+        counter.inc()
+
+    def set_overloaded(self, overloaded):
+        """Record a change of state; cond must be held."""
+        if overloaded == self.overloaded:
+            return False
+        self.overloaded = overloaded
+        return True
+
+    def acquire(self):
+        """Wait until another callback may be dispatched, and count it as
+           pending.
+        """
+        self.cond.acquire()
+        try:
+            while self.pending >= self.max_pending:
+                self.cond.wait()
+            self.pending += 1
+            changed = self.set_overloaded(self.pending >= self.shed_at)
+        finally:
+            self.cond.release()
+        if changed and self.on_overload:
+            self.on_overload(self.overloaded)
+
+    def release(self):
+        """Called when a pending callback has finished."""
+        self.cond.acquire()
+        try:
+            self.pending -= 1
+            self.cond.notify()
+            # recover only once well below the threshold, so we don't
+            # flap around it
+            changed = self.overloaded and \
+                self.set_overloaded(self.pending >= self.shed_at // 2)
+        finally:
+            self.cond.release()
+        if changed and self.on_overload:
+            self.on_overload(self.overloaded)
+
+    def accept_pulse(self):
+        """Returns False if a message shouldn't be passed to
+           pulseCallback.
+        """
+        if self.pulse_sample is None or random.random() < self.pulse_sample:
+            return True
+        self.shed('sample', 'pulse')
+        return False
+
+    def accept_event(self, lane):
+        """Returns False if an event in 'lane' should be dropped."""
+        if self.overloaded and lane in self.drop:
+            self.shed('drop', lane)
+            return False
+        return True
+
+    def hold_latest(self, callback, builddata, lane, release):
+        """Used when keep_latest is set.  If an event with the same key is
+           waiting for a worker, replace it with this one, releasing the
+           replaced event's message, and return None.  Otherwise return a
+           slot holding this event, to be dispatched with run_latest().
+        """
+        key = (id(callback), event_key(lane, builddata, self.keep_latest))
+        self.cond.acquire()
+        try:
+            slot = self.waiting.get(key)
+            if slot is None:
+                slot = self.waiting[key] = [builddata, release, key]
+                return slot
+            superseded = slot[1]
+            slot[0:2] = [builddata, release]
+        finally:
+            self.cond.release()
+        if superseded:
+            superseded(True)
+        self.shed('latest', lane)
+        return None
+
+    def run_latest(self, callback, slot):
+        """Run by a worker in place of callback(builddata): stops the slot
+           accepting replacements, and calls the callback with its latest
+           event.
+        """
+        self.cond.acquire()
+        try:
+            self.waiting.pop(slot[2], None)
+        finally:
+            self.cond.release()
+        callback(slot[0])
+
+    def slot_done(self, slot):
+        """Returns a function which releases the message of the event
+           which was finally run from 'slot'.  The slot is also forgotten
+           here, in case the dispatcher dropped it without running it.
+        """
+        def done(success):
+            self.cond.acquire()
+            try:
+                if self.waiting.get(slot[2]) is slot:
+                    del self.waiting[slot[2]]
+            finally:
+                self.cond.release()
+            if slot[1]:
+                slot[1](success)
+        return done
+
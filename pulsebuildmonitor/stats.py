@@ -0,0 +1,254 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import math
+import threading
+import time
+
+
+KINDS = ('build', 'unittest', 'talos')
+
+# name -> (seconds per slot, number of slots)
+DEFAULT_WINDOWS = (('1m', 1, 60),
+                   ('1h', 60, 60),
+                   ('1d', 900, 96))
+
+
+class QuantileSketch(object):
+    """Approximate quantiles of positive values, such as lags in seconds.
+       Values are counted in buckets whose bounds grow geometrically, so
+       any quantile is within 'accuracy' of the true value, relative to
+       it, in memory which grows only with the logarithm of the range of
+       values.  Values below 'minimum' are counted as 0.
+    """
+
+    def __init__(self, accuracy=0.01, minimum=1e-3):
+        self.accuracy = accuracy
+        self.minimum = minimum
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.logGamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value):
+        if value < self.minimum:
+            self.zeros += 1
+        else:
+            i = int(math.ceil(math.log(value) / self.logGamma))
+            self.buckets[i] = self.buckets.get(i, 0) + 1
+        self.count += 1
+
+    def merge(self, other):
+        """Add the values counted by 'other', a sketch of the same
+           accuracy.
+        """
+        for i, n in other.buckets.iteritems():
+            self.buckets[i] = self.buckets.get(i, 0) + n
+        self.zeros += other.zeros
+        self.count += other.count
+
+    def quantiles(self, qs):
+        """Returns the approximate value at each quantile in 'qs', which
+           must be sorted, or None for each if no values were added.
+        """
+        if not self.count:
+            return [None] * len(qs)
+        ranks = [q * (self.count - 1) for q in qs]
+        results = []
+        seen = self.zeros
+        buckets = iter(sorted(self.buckets.iteritems()))
+        i = None
+        for rank in ranks:
+            if rank < self.zeros:
+                results.append(0.0)
+                continue
+            while seen <= rank:
+                i, n = next(buckets)
+                seen += n
+            # the middle of the bucket, in relative terms
+            results.append(2 * self.gamma ** i / (self.gamma + 1))
+        return results
+
+
+class WindowSlot(object):
+    """The events counted in one slot of a window: a count, and a sketch
+       of the lags, for each kind.
+    """
+
+    __slots__ = ('epoch', 'counts', 'lags')
+
+    def __init__(self, epoch):
+        self.epoch = epoch
+        self.counts = {}
+        self.lags = {}
+
+
+class Window(object):
+    """Counts over the last 'slots' periods of 'resolution' seconds, kept
+       in a ring, so that adding an event costs the same however many
+       have been added, and old slots are reused rather than expired.
+    """
+
+    def __init__(self, name, resolution, slots, accuracy):
+        self.name = name
+        self.resolution = resolution
+        self.slots = [WindowSlot(None) for i in xrange(slots)]
+        self.accuracy = accuracy
+
+    @property
+    def seconds(self):
+        return self.resolution * len(self.slots)
+
+    def slot(self, now):
+        epoch = int(now // self.resolution)
+        i = epoch % len(self.slots)
+        slot = self.slots[i]
+        if slot.epoch != epoch:
+            slot = self.slots[i] = WindowSlot(epoch)
+        return slot
+
+    def add(self, now, kind, lag):
+        slot = self.slot(now)
+        slot.counts[kind] = slot.counts.get(kind, 0) + 1
+        if lag is not None:
+            sketch = slot.lags.get(kind)
+            if sketch is None:
+                sketch = slot.lags[kind] = QuantileSketch(self.accuracy)
+            sketch.add(lag)
+
+    def current(self, now):
+        """The slots within the window ending 'now'."""
+        epoch = int(now // self.resolution)
+        return [slot for slot in self.slots
+                if slot.epoch is not None and
+                epoch - len(self.slots) < slot.epoch <= epoch]
+
+
+class BuildStats(object):
+    """A sink which keeps statistics about the events it is given over
+       sliding windows: by default the last minute, hour and day.  For
+       each window and kind of event it counts the events and sketches
+       the quantiles of their lag, the time from their builddate until
+       they were received.  For each tree, platform and buildtype it also
+       tracks the gap between successive builds.  Each event is added in
+       constant time; snapshot() returns the statistics.
+
+       windows   - (name, seconds per slot, number of slots) for each
+                   window
+       quantiles - the lag quantiles to report
+       accuracy  - the relative accuracy of the lag quantiles
+    """
+
+    def __init__(self, windows=DEFAULT_WINDOWS,
+                 quantiles=(0.5, 0.9, 0.99), accuracy=0.01):
+        self.windows = [Window(name, resolution, slots, accuracy)
+                        for name, resolution, slots in windows]
+        self.quantiles = tuple(sorted(quantiles))
+        self.accuracy = accuracy
+        # (tree, platform, buildtype) -> [last builddate, last received,
+        #                                  last gap, mean gap, count]
+        self.gaps = {}
+        self.lock = threading.Lock()
+
+    def add(self, kind, event, now=None):
+        if now is None:
+            now = time.time()
+        builddate = event.get('builddate')
+        lag = None
+        if isinstance(builddate, (int, long, float)):
+            lag = max(0, now - builddate)
+
+        self.lock.acquire()
+        try:
+            for window in self.windows:
+                window.add(now, kind, lag)
+            if kind == 'build':
+                self.add_gap(event, builddate, now)
+        finally:
+            self.lock.release()
+
+    def add_gap(self, event, builddate, now):
+        """Update the gap between builds for the event's key; the lock
+           must be held.
+        """
+        key = (event.get('tree'), event.get('platform'),
+               event.get('buildtype'))
+        # builddates give the gap between the builds themselves, however
+        # late their messages were, but we fall back to when they arrived
+        when = builddate if builddate is not None else now
+        entry = self.gaps.get(key)
+        if entry is None:
+            self.gaps[key] = [builddate, now, None, None, 1]
+            return
+        last = entry[0] if entry[0] is not None else entry[1]
+        gap = when - last
+        if gap >= 0:
+            entry[2] = gap
+            # an exponentially weighted mean, so that it follows changes in
+            # the build frequency
+            entry[3] = gap if entry[3] is None else 0.8 * entry[3] + 0.2 * gap
+            entry[0], entry[1] = builddate, now
+        entry[4] += 1
+
+    def snapshot(self, now=None):
+        """Returns the statistics as a dict which can be serialized as
+           JSON:
+
+             windows - {name: {seconds, counts: {kind: n}, per_minute:
+                       {kind: rate}, talos_fraction, lag: {kind: {count,
+                       p50, p90, ...}}}}
+             gaps    - a list of {tree, platform, buildtype, builddate,
+                       received, gap, mean_gap, since_last, count}, one
+                       for each tree, platform and buildtype built
+        """
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            windows = {}
+            for window in self.windows:
+                windows[window.name] = self.window_stats(window, now)
+            gaps = [{'tree': tree, 'platform': platform,
+                     'buildtype': buildtype, 'builddate': entry[0],
+                     'received': entry[1], 'gap': entry[2],
+                     'mean_gap': entry[3], 'since_last': now - entry[1],
+                     'count': entry[4]}
+                    for (tree, platform, buildtype), entry
+                    in sorted(self.gaps.iteritems())]
+        finally:
+            self.lock.release()
+        return {'time': now, 'windows': windows, 'gaps': gaps}
+
+    def window_stats(self, window, now):
+        counts = dict((kind, 0) for kind in KINDS)
+        lags = {}
+        for slot in window.current(now):
+            for kind, n in slot.counts.iteritems():
+                counts[kind] = counts.get(kind, 0) + n
+            for kind, sketch in slot.lags.iteritems():
+                if kind not in lags:
+                    lags[kind] = QuantileSketch(self.accuracy)
+                lags[kind].merge(sketch)
+
+        tests = counts['unittest'] + counts['talos']
+        minutes = window.seconds / 60.0
+        lagStats = {}
+        for kind, sketch in lags.iteritems():
+            stats = {'count': sketch.count}
+            for q, value in zip(self.quantiles,
+                                sketch.quantiles(self.quantiles)):
+                stats['p%g' % (q * 100)] = value
+            lagStats[kind] = stats
+        return {'seconds': window.seconds,
+                'counts': counts,
+                'per_minute': dict((kind, n / minutes)
+                                   for kind, n in counts.iteritems()),
+                'talos_fraction': (float(counts['talos']) / tests
+                                   if tests else None),
+                'lag': lagStats}
+
+    def close(self):
+        pass
@@ -0,0 +1,323 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import asyncore
+from collections import deque
+import errno
+import socket
+import threading
+import time
+import urlparse
+try:
+    import json
+except:
+    import simplejson as json
+
+
+class EventLog(object):
+    """A fixed-size log of published events, each numbered with an
+       increasing sequence number, so that clients can resume from the
+       last event they saw.
+    """
+
+    def __init__(self, size=1000):
+        self.events = deque(maxlen=size)
+        self.seq = 0
+
+    def append(self, event):
+        self.seq += 1
+        entry = (self.seq, event, json.dumps(event))
+        self.events.append(entry)
+        return entry
+
+    def since(self, cursor):
+        """Returns the entries published after 'cursor', oldest first."""
+        if not self.events or cursor >= self.seq:
+            return []
+        first = self.events[0][0]
+        return list(self.events)[max(0, cursor + 1 - first):]
+
+
+def matches(event, filters):
+    for field, value in filters.iteritems():
+        if unicode(event.get(field)) != value:
+            return False
+    return True
+
+
+class _Waker(asyncore.dispatcher):
+    """Wakes the server's loop when another thread publishes an event."""
+
+    def __init__(self, server):
+        self.server = server
+        self.reader, self.writer = socket.socketpair()
+        self.writer.setblocking(False)
+        asyncore.dispatcher.__init__(self, self.reader, map=server.map)
+        self.signalled = False
+        self.lock = threading.Lock()
+
+    def wake(self):
+        self.lock.acquire()
+        try:
+            if self.signalled:
+                return
+            self.signalled = True
+        finally:
+            self.lock.release()
+        try:
+            self.writer.send('x')
+        except socket.error:
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except socket.error:
+            pass
+        self.lock.acquire()
+        self.signalled = False
+        self.lock.release()
+        self.server.deliver_published()
+
+
+class _Client(asyncore.dispatcher):
+
+    MAX_REQUEST = 8192
+
+    def __init__(self, server, sock):
+        asyncore.dispatcher.__init__(self, sock, map=server.map)
+        self.server = server
+        self.inbuf = ''
+        self.outbuf = []
+        self.outsize = 0
+        self.mode = None
+        self.filters = {}
+        self.deadline = None
+        self.lastWrite = time.time()
+        self.closing = False
+
+    def readable(self):
+        return not self.closing
+
+    def writable(self):
+        return bool(self.outbuf)
+
+    def handle_read(self):
+        data = self.recv(4096)
+        if self.mode is not None or not data:
+            return
+        self.inbuf += data
+        if '\r\n\r\n' in self.inbuf:
+            self.handle_request(self.inbuf.split('\r\n\r\n', 1)[0])
+        elif len(self.inbuf) > self.MAX_REQUEST:
+            self.respond('431 Request Header Fields Too Large')
+
+    def handle_request(self, head):
+        lines = head.split('\r\n')
+        try:
+            method, target, version = lines[0].split()
+        except ValueError:
+            return self.respond('400 Bad Request')
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        url = urlparse.urlparse(target)
+        params = dict((k, v[-1].decode('utf-8')) for k, v in
+                      urlparse.parse_qs(url.query).iteritems())
+        try:
+            cursor = int(params.pop('cursor', None) or
+                         headers.get('last-event-id') or -1)
+            timeout = float(params.pop('timeout', None) or
+                            self.server.poll_timeout)
+        except ValueError:
+            return self.respond('400 Bad Request')
+        self.filters = params
+
+        if method != 'GET':
+            self.respond('405 Method Not Allowed')
+        elif url.path.rstrip('/') == '/events':
+            self.start_stream(cursor)
+        elif url.path.rstrip('/') == '/poll':
+            self.start_poll(cursor, min(timeout, self.server.poll_timeout))
+        else:
+            self.respond('404 Not Found')
+
+    def respond(self, status, body='', content_type='text/plain'):
+        self.write('HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n'
+                   'Cache-Control: no-cache\r\nConnection: close\r\n\r\n%s' %
+                   (status, content_type, len(body), body))
+        self.mode = 'done'
+        self.closing = True
+
+    def start_stream(self, cursor):
+        self.mode = 'stream'
+        self.write('HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n'
+                   'Cache-Control: no-cache\r\nConnection: keep-alive\r\n\r\n')
+        if cursor >= 0:
+            for entry in self.server.log.since(cursor):
+                self.send_event(entry)
+        self.server.streams.add(self)
+
+    def start_poll(self, cursor, timeout):
+        self.mode = 'poll'
+        if cursor < 0:
+            # a first request just learns where the log currently ends
+            return self.finish_poll([])
+        entries = [e for e in self.server.log.since(cursor)
+                   if matches(e[1], self.filters)]
+        if entries:
+            return self.finish_poll(entries)
+        self.deadline = time.time() + timeout
+        self.server.pollers.add(self)
+
+    def finish_poll(self, entries):
+        self.server.pollers.discard(self)
+        body = '{"cursor": %d, "events": [%s]}' % (
+            self.server.log.seq, ', '.join(e[2] for e in entries))
+        self.respond('200 OK', body, 'application/json')
+
+    def send_event(self, entry):
+        seq, event, data = entry
+        if not matches(event, self.filters):
+            return
+        self.write('id: %d\nevent: %s\ndata: %s\n\n' %
+                   (seq, event.get('kind', 'message'), data))
+
+    def write(self, data):
+        if not self.connected:
+            return
+        self.outbuf.append(data)
+        self.outsize += len(data)
+        if self.outsize > self.server.max_buffer:
+            # a slow consumer; drop it rather than buffer without limit.
+            # It can reconnect with Last-Event-ID to resume.
+            self.server.slow_clients += 1
+            self.handle_close()
+
+    def handle_write(self):
+        data = ''.join(self.outbuf)
+        try:
+            sent = self.send(data)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        data = data[sent:]
+        self.outbuf = [data] if data else []
+        self.outsize = len(data)
+        self.lastWrite = time.time()
+        if self.closing and not self.outbuf:
+            self.handle_close()
+
+    def handle_close(self):
+        self.server.streams.discard(self)
+        self.server.pollers.discard(self)
+        self.outbuf = []
+        self.close()
+
+    def handle_error(self):
+        self.handle_close()
+
+
+class EventStreamServer(asyncore.dispatcher):
+    """Pushes published events to HTTP clients, either as a Server-Sent
+       Events stream or by long-polling.  One thread runs a poll() loop, so
+       thousands of idle connections cost a socket each, not a thread.
+
+         GET /events?field=value...  a text/event-stream of the events whose
+                                     fields match every parameter.  Missed
+                                     events are replayed from a Last-Event-ID
+                                     header or 'cursor' parameter.
+         GET /poll?cursor=N&timeout=T&field=value...
+                                     waits up to T seconds for matching
+                                     events after sequence number N, and
+                                     returns {"cursor": M, "events": [...]};
+                                     the next request should pass cursor=M.
+
+       history     - the number of events kept for replay
+       max_buffer  - the number of bytes queued for one client before it
+                     is considered too slow and disconnected
+       keepalive   - seconds between comments sent on idle streams
+       poll_timeout - the maximum time a long-poll request is held
+    """
+
+    def __init__(self, host='127.0.0.1', port=8035, history=1000,
+                 max_buffer=256 * 1024, keepalive=15, poll_timeout=60,
+                 backlog=1024):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(backlog)
+        self.log = EventLog(history)
+        self.max_buffer = max_buffer
+        self.keepalive = keepalive
+        self.poll_timeout = poll_timeout
+        self.streams = set()
+        self.pollers = set()
+        self.slow_clients = 0
+        self.published = deque()
+        self.waker = _Waker(self)
+        self.thread = None
+        self.stopped = False
+
+    def handle_accept(self):
+        try:
+            accepted = self.accept()
+        except socket.error:
+            return
+        if accepted:
+            _Client(self, accepted[0])
+
+    def publish(self, event):
+        """Publish an event (a JSON-serializable dict); may be called from
+           any thread.  Its 'kind' field, if any, is used as the SSE event
+           type.
+        """
+        self.published.append(event)
+        self.waker.wake()
+
+    def deliver_published(self):
+        while self.published:
+            entry = self.log.append(self.published.popleft())
+            for client in list(self.streams):
+                client.send_event(entry)
+            for client in list(self.pollers):
+                if matches(entry[1], client.filters):
+                    client.finish_poll([entry])
+
+    def check_timers(self):
+        now = time.time()
+        for client in list(self.pollers):
+            if client.deadline <= now:
+                client.finish_poll([])
+        for client in list(self.streams):
+            if not client.outbuf and now - client.lastWrite >= self.keepalive:
+                client.write(':\n\n')
+
+    def serve_forever(self):
+        while not self.stopped:
+            asyncore.loop(timeout=1.0, use_poll=True, map=self.map, count=1)
+            self.check_timers()
+        asyncore.close_all(map=self.map)
+
+    def start(self):
+        """Run the server on a daemon thread."""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the server's thread, and close every connection."""
+        self.stopped = True
+        self.waker.wake()
+        if self.thread:
+            self.thread.join()
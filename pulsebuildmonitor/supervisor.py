@@ -0,0 +1,194 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import bisect
+import hashlib
+import multiprocessing
+import signal
+import socket
+import time
+
+
+def default_label():
+    """A pulse consumer label which is the same every time a program is
+       run on this host, so that its workers share, or reuse, queues.
+    """
+    return 'pulsebuildmonitor_%s' % socket.gethostname()
+
+
+class HashRing(object):
+    """Consistent hashing of values onto nodes: each node is placed at
+       'replicas' points on a ring, and a value belongs to the node at the
+       first point after the value's hash.  Adding or removing a node only
+       moves the values adjacent to its points.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        points = []
+        for node in nodes:
+            for i in xrange(replicas):
+                points.append((self.hash('%s:%d' % (node, i)), node))
+        points.sort()
+        self.hashes = [point[0] for point in points]
+        self.nodes = [point[1] for point in points]
+
+    def hash(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return int(hashlib.md5(str(value)).hexdigest()[:8], 16)
+
+    def node_for(self, value):
+        i = bisect.bisect(self.hashes, self.hash(value))
+        return self.nodes[i % len(self.nodes)]
+
+
+class Shard(object):
+    """One of 'count' shards of the events, divided by the value of the
+       payload field 'key', so that all events with the same value (for
+       example, the same tree or revision) belong to the same shard.
+    """
+
+    def __init__(self, index, count, key, replicas=100):
+        assert(0 <= index < count)
+        self.index = index
+        self.count = count
+        self.key = key
+        self.ring = HashRing(range(count), replicas)
+
+    def owns(self, payload):
+        return self.ring.node_for(payload.get(self.key)) == self.index
+
+    def __repr__(self):
+        return 'Shard(%d, %d, %r)' % (self.index, self.count, self.key)
+
+
+def _run_worker(target, label, shard):
+    # workers are forked with the supervisor's signal handlers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    target(label, shard)
+
+
+class MonitorSupervisor(object):
+    """Runs a monitor in each of several worker processes, so that message
+       handling isn't limited to the one core a process can use, and
+       restarts workers which exit.
+
+       target      - called in each worker as target(label, shard); it
+                     should create a monitor with the given label and shard
+                     (both are PulseBuildMonitor arguments) and not return
+                     while it runs, e.g. by calling monitor.join()
+       workers     - the number of worker processes; by default, one per
+                     core
+       label       - the pulse consumer label.  It must be the same every
+                     time, so that workers and their replacements consume
+                     from the same queues; the default is based on the
+                     hostname.
+       shard_key   - a payload field, such as 'tree' or 'revision'.  If
+                     None, the workers share one queue, and pulse gives
+                     each message to one of them.  Otherwise each worker
+                     has its own queue, and handles only the events in its
+                     Shard, so that related events go to the same worker.
+       shard_count - the total number of shards, if the shards are split
+                     between several hosts; defaults to 'workers'
+       first_shard - the first shard run by this supervisor's workers
+       restart_delay - seconds to wait before restarting a worker which
+                     exited, doubled each time it exits again within a
+                     minute, up to a minute
+    """
+
+    def __init__(self, target, workers=None, label=None, shard_key=None,
+                 shard_count=None, first_shard=0, restart_delay=1.0,
+                 logger=None):
+        self.target = target
+        self.workers = workers or multiprocessing.cpu_count()
+        self.label = label or default_label()
+        self.shard_key = shard_key
+        self.shard_count = shard_count or self.workers
+        self.first_shard = first_shard
+        self.restart_delay = restart_delay
+        self.logger = logger
+        self.processes = {}
+        self.restarts = {}
+        self.running = False
+        if shard_key:
+            assert(first_shard + self.workers <= self.shard_count)
+
+    def worker_args(self, i):
+        """Returns the (label, shard) for worker 'i'."""
+        if not self.shard_key:
+            return self.label, None
+        index = self.first_shard + i
+        return ('%s_shard%d' % (self.label, index),
+                Shard(index, self.shard_count, self.shard_key))
+
+    def log(self, message):
+        if self.logger:
+            self.logger.info(message)
+
+    def start_worker(self, i):
+        process = multiprocessing.Process(target=_run_worker,
+                                          args=(self.target,) +
+                                               self.worker_args(i),
+                                          name='%s-%d' % (self.label, i))
+        process.start()
+        self.processes[i] = process
+        self.log('started worker %d, pid %d' % (i, process.pid))
+
+    def start(self):
+        self.running = True
+        for i in xrange(self.workers):
+            self.start_worker(i)
+
+    def check_workers(self):
+        """Restart any workers which have exited and whose restart delay
+           has passed.
+        """
+        now = time.time()
+        for i, process in self.processes.items():
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                process.join()
+                self.processes[i] = None
+                delay, lastExit = self.restarts.get(i, (0, 0))
+                if now - lastExit < 60:
+                    delay = min(max(delay * 2, self.restart_delay), 60)
+                else:
+                    delay = self.restart_delay
+                self.restarts[i] = (delay, now)
+                self.log('worker %d exited with status %s; restarting in '
+                         '%g seconds' % (i, process.exitcode, delay))
+            delay, lastExit = self.restarts[i]
+            if now >= lastExit + delay:
+                self.start_worker(i)
+
+    def stop(self):
+        """Terminate the workers and wait for them to exit."""
+        self.running = False
+        for process in self.processes.values():
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes.values():
+            if process is not None:
+                process.join()
+        self.processes = {}
+
+    def handle_signal(self, signum, frame):
+        self.running = False
+
+    def run(self, interval=1.0):
+        """Start the workers and supervise them until SIGTERM or SIGINT is
+           received, then stop them.  May be called after createDaemon().
+        """
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+        self.start()
+        try:
+            while self.running:
+                time.sleep(interval)
+                self.check_workers()
+        finally:
+            self.stop()
@@ -0,0 +1,397 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import abc
+import errno
+import itertools
+import os
+import Queue
+import re
+import select
+import socket
+import time
+
+from lazy import LazyPulseData, decode_line
+from replay import FakeMessage
+
+
+def topic_pattern(topics):
+    """Compile a list of AMQP topic patterns, in which '*' matches one
+       word and '#' any number of words, into one regular expression.  It
+       must be matched against the routing key with a '.' prepended, so
+       that every word, including the first, follows a dot.
+    """
+    alternatives = []
+    for topic in topics:
+        words = []
+        for word in topic.split('.'):
+            if word == '#':
+                words.append(r'(?:\.[^.]+)*')
+            elif word == '*':
+                words.append(r'\.[^.]+')
+            else:
+                words.append(r'\.' + re.escape(word))
+        alternatives.append(''.join(words))
+    return re.compile('^(?:%s)$' % '|'.join(alternatives))
+
+
+class Transport(object):
+    """Delivers pulse messages to a monitor.  A transport is configured
+       with the topics and callback, and listen() then calls
+       callback(data, message) for each message whose routing key matches
+       one of the topics.  'data' is a dict with the routing key in
+       data['_meta']['routing_key'] and the payload in data['payload'];
+       'message' has ack(), reject() and requeue() methods.  If an 'idle'
+       function is configured, listen() also calls it at least every
+       'idle_interval' seconds while it waits for messages, on the same
+       thread, so that the monitor can acknowledge messages whose
+       callbacks have finished.  set_prefetch() limits the number of
+       unacknowledged messages a broker may deliver.
+
+       Transports which receive messages as JSON text deliver them as
+       LazyPulseData if 'lazy' is True, so that messages rejected on their
+       routing key are never decoded.
+
+       Subclasses must implement listen(); a monitor uses PulseTransport
+       if it isn't given one.
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    lazy = False
+    idle = None
+    idle_interval = 1.0
+    prefetch = None
+
+    def configure(self, topic, callback, durable=False, idle=None):
+        self.topics = topic
+        self.matcher = topic_pattern(topic)
+        self.callback = callback
+        self.durable = durable
+        self.idle = idle
+
+    def on_idle(self):
+        if self.idle:
+            self.idle()
+
+    def set_prefetch(self, prefetch):
+        """Limit the number of unacknowledged messages delivered to
+           'prefetch', or remove the limit if it is None.  Called before
+           listen(), or by the listening thread.  Local transports deliver
+           messages whether or not earlier ones have been acknowledged.
+        """
+        self.prefetch = prefetch
+
+    def matches(self, data):
+        return self.matcher.match('.' + data['_meta']['routing_key']) \
+            is not None
+
+    def parse(self, line):
+        """Returns the message in a line of JSON, decoded unless we are
+           lazy.  Raises ValueError if it isn't a message.
+        """
+        if self.lazy:
+            return LazyPulseData(line)
+        return decode_line(line)
+
+    def deliver_line(self, line):
+        """Deliver a message read from a stream; lines which aren't JSON
+           are skipped.
+        """
+        try:
+            data = self.parse(line)
+        except (ValueError, KeyError, TypeError):
+            return
+        if self.matches(data):
+            self.callback(data, FakeMessage(next(self.tags)))
+
+    @abc.abstractmethod
+    def listen(self):
+        """Deliver messages until the transport is closed."""
+
+    def purge_existing_messages(self):
+        """Discard any messages waiting to be delivered."""
+        pass
+
+    def close(self):
+        """Make listen() return."""
+        pass
+
+
+class PulseTransport(Transport):
+    """Consumes from pulse, using mozillapulse's NormalizedBuildConsumer.
+       mozillapulse, and the AMQP libraries it depends on, are only
+       imported when one is created.  If 'lazy' is True, JSON messages
+       are taken from kombu undecoded and delivered as LazyPulseData.
+    """
+
+    def __init__(self, label, lazy=False):
+        if not label:
+            raise Exception('label not defined')
+        from mozillapulse import consumers
+        self.consumer = consumers.NormalizedBuildConsumer(applabel=label)
+        self.lazy = lazy
+        # the kombu consumer mozillapulse is consuming with
+        self.kombuConsumer = None
+
+    def configure(self, topic, callback, durable=False, idle=None):
+        self.callback = callback
+        self.idle = idle
+        self.consumer.configure(topic=topic, callback=callback,
+                                durable=durable)
+
+    def listen(self):
+        # mozillapulse only connects if it has no connection, so it will
+        # consume from this one
+        self.consumer.connect()
+        connection = self.consumer.connection
+        self.prepare_consumers(connection)
+        if self.idle:
+            self.wake_when_idle(connection)
+        self.consumer.listen()
+
+    def prepare_consumers(self, connection):
+        """Have each kombu consumer created by mozillapulse on
+           'connection' set our prefetch limit before it starts consuming,
+           and, if we are lazy, pass each message to on_raw_message rather
+           than decoding it and passing it to the callback.
+        """
+        if 'Consumer' in vars(connection):
+            return
+        create = connection.Consumer
+        def Consumer(*args, **kwargs):
+            consumer = create(*args, **kwargs)
+            if self.lazy:
+                # kombu passes each message to on_message, if it is set,
+                # instead of decoding it and calling the callbacks
+                consumer.on_message = self.on_raw_message
+            if self.prefetch:
+                # mozillapulse calls consume() once we return; the broker
+                # only applies a limit to consumers started after it
+                consumer.qos(prefetch_count=self.prefetch)
+            self.kombuConsumer = consumer
+            return consumer
+        connection.Consumer = Consumer
+
+    def set_prefetch(self, prefetch):
+        """Change the prefetch limit.  Once we are consuming, the consumer
+           is restarted so that the broker applies the new limit to it.
+           Must be called on the listening thread.
+        """
+        if prefetch == self.prefetch:
+            return
+        self.prefetch = prefetch
+        consumer = self.kombuConsumer
+        if consumer is None:
+            return
+        # 0 means no limit
+        consumer.qos(prefetch_count=prefetch or 0)
+        consumer.cancel()
+        consumer.consume()
+
+    def wake_when_idle(self, connection):
+        """Have mozillapulse's calls to connection.drain_events(), which
+           wait for the next message, call on_idle() every idle_interval
+           seconds while they wait.  A timeout given by mozillapulse is
+           still honoured.
+        """
+        if 'drain_events' in vars(connection):
+            return
+        drain = connection.drain_events
+        def drain_events(timeout=None, **kwargs):
+            deadline = timeout and time.time() + timeout
+            while True:
+                wait = self.idle_interval
+                if deadline:
+                    wait = min(wait, deadline - time.time())
+                    if wait <= 0:
+                        raise socket.timeout()
+                try:
+                    return drain(timeout=wait, **kwargs)
+                except socket.timeout:
+                    self.on_idle()
+        connection.drain_events = drain_events
+
+    def on_raw_message(self, message):
+        """Called by kombu with each message, before it is decoded."""
+        if message.content_type != 'application/json' or \
+                message.headers.get('compression'):
+            data = message.decode()
+        else:
+            data = LazyPulseData(message.body)
+        self.callback(data, message)
+
+    def purge_existing_messages(self):
+        self.consumer.purge_existing_messages()
+
+
+class QueueTransport(Transport):
+    """An in-process broker: messages published from any thread are
+       delivered by listen(), with FakeMessages in place of pulse messages.
+       Useful for tests and for feeding a monitor from other code in the
+       same process.  Messages may be put as dicts, or as JSON text.
+    """
+
+    # placed on the queue by close()
+    _STOP = object()
+
+    def __init__(self, maxsize=0, lazy=False):
+        self.queue = Queue.Queue(maxsize)
+        self.lazy = lazy
+        self.tags = itertools.count(1)
+
+    def publish(self, routing_key, payload):
+        self.put({'_meta': {'routing_key': routing_key}, 'payload': payload})
+
+    def put(self, data):
+        """Queue a message in the form delivered by pulse, or its JSON."""
+        self.queue.put(data)
+
+    def listen(self):
+        while True:
+            try:
+                data = self.queue.get(True,
+                                      self.idle_interval if self.idle else None)
+            except Queue.Empty:
+                self.on_idle()
+                continue
+            if data is self._STOP:
+                return
+            if isinstance(data, basestring):
+                self.deliver_line(data)
+            elif self.matches(data):
+                self.callback(data, FakeMessage(next(self.tags)))
+
+    def purge_existing_messages(self):
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+    def close(self):
+        self.queue.put(self._STOP)
+
+
+class SocketTransport(Transport):
+    """Accepts connections on a local socket, from which it reads messages
+       as JSON documents, one per line, in the form delivered by pulse or
+       written by MessageRecorder.  'address' is a path for a Unix socket,
+       or a (host, port) tuple.
+    """
+
+    def __init__(self, address, backlog=16, lazy=False):
+        self.address = address
+        self.lazy = lazy
+        if isinstance(address, basestring):
+            if os.path.exists(address):
+                os.remove(address)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(address)
+        self.sock.listen(backlog)
+        self.tags = itertools.count(1)
+        self.clients = {}
+        self.closed = False
+
+    def listen(self):
+        while not self.closed:
+            readable, _, _ = select.select([self.sock] + self.clients.keys(),
+                                           [], [], self.idle_interval)
+            if not readable:
+                self.on_idle()
+            for sock in readable:
+                if sock is self.sock:
+                    client, addr = self.sock.accept()
+                    self.clients[client] = ''
+                else:
+                    self.read(sock)
+        for sock in self.clients.keys() + [self.sock]:
+            sock.close()
+        if isinstance(self.address, basestring):
+            os.remove(self.address)
+
+    def read(self, sock):
+        try:
+            data = sock.recv(65536)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            sock.close()
+            del self.clients[sock]
+            return
+        lines = (self.clients[sock] + data).split('\n')
+        self.clients[sock] = lines.pop()
+        for line in lines:
+            if line.strip():
+                self.deliver_line(line)
+
+    def close(self):
+        self.closed = True
+
+
+class FileTailTransport(Transport):
+    """Follows a file of messages, one JSON document per line as for
+       SocketTransport, as other processes append to it.  The file is
+       reopened if it is replaced, e.g. by log rotation.  If 'from_start'
+       is False, only messages appended after listen() is called are
+       delivered.
+    """
+
+    def __init__(self, path, from_start=True, poll_interval=0.5, lazy=False):
+        self.path = path
+        self.lazy = lazy
+        self.from_start = from_start
+        self.poll_interval = poll_interval
+        self.tags = itertools.count(1)
+        self.closed = False
+
+    def open(self, seek_end):
+        while not self.closed:
+            try:
+                f = open(self.path, 'rb')
+            except IOError:
+                time.sleep(self.poll_interval)
+                continue
+            if seek_end:
+                f.seek(0, os.SEEK_END)
+            return f
+
+    def replaced(self, f):
+        try:
+            return os.stat(self.path).st_ino != os.fstat(f.fileno()).st_ino
+        except OSError:
+            return False
+
+    def listen(self):
+        f = self.open(not self.from_start)
+        partial = ''
+        while not self.closed:
+            line = f.readline()
+            if line.endswith('\n'):
+                line, partial = partial + line, ''
+                if line.strip():
+                    self.deliver_line(line)
+            elif line:
+                partial += line
+            elif self.replaced(f):
+                f.close()
+                f = self.open(False)
+                partial = ''
+            else:
+                self.on_idle()
+                time.sleep(self.poll_interval)
+        if f:
+            f.close()
+
+    def purge_existing_messages(self):
+        self.from_start = False
+
+    def close(self):
+        self.closed = True
@@ -32,6 +32,7 @@ setup(name='pulsebuildmonitor',
       packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
       include_package_data=True,
       zip_safe=False,
-      install_requires=deps
+      install_requires=deps,
+      extras_require={'async': ['trollius']}
       )
 
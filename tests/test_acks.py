@@ -0,0 +1,232 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+from cStringIO import StringIO
+import sys
+import threading
+import time
+import unittest
+
+from pulsebuildmonitor import (CallbackDispatcher, FactoryBuildMonitor,
+                               FakeMessage, MessageAcknowledger,
+                               QueueTransport, synthetic_messages)
+
+from tests.test_monitor import run_monitor
+
+
+class RecordingChannel(object):
+    """Records the acks sent on it, and the threads which sent them."""
+
+    def __init__(self):
+        self.acked = []
+        self.threads = set()
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.threads.add(threading.current_thread())
+        self.acked.append((delivery_tag, multiple))
+
+
+class ChannelMessage(FakeMessage):
+
+    def __init__(self, channel, delivery_tag):
+        FakeMessage.__init__(self, delivery_tag)
+        self.channel = channel
+
+    def ack(self):
+        self.channel.threads.add(threading.current_thread())
+        FakeMessage.ack(self)
+
+    def reject(self, requeue=False):
+        self.channel.threads.add(threading.current_thread())
+        FakeMessage.reject(self, requeue)
+
+
+class ChannelTransport(QueueTransport):
+    """A QueueTransport whose messages belong to a RecordingChannel."""
+
+    def __init__(self, channel):
+        QueueTransport.__init__(self)
+        self.channel = channel
+
+    def configure(self, topic, callback, durable=False, idle=None):
+        def deliver(data, message):
+            callback(data, ChannelMessage(self.channel,
+                                          message.delivery_tag))
+        QueueTransport.configure(self, topic, deliver, durable, idle)
+
+
+class MessageTransport(QueueTransport):
+    """A QueueTransport which keeps the FakeMessage of each message it
+       delivers.
+    """
+
+    def __init__(self):
+        QueueTransport.__init__(self)
+        self.messages = []
+
+    def configure(self, topic, callback, durable=False, idle=None):
+        def deliver(data, message):
+            self.messages.append(message)
+            callback(data, message)
+        QueueTransport.configure(self, topic, deliver, durable, idle)
+
+
+class AcknowledgerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.channel = RecordingChannel()
+        self.messages = [ChannelMessage(self.channel, tag)
+                         for tag in xrange(1, 11)]
+
+    def settle_on_thread(self, pendings, failed=()):
+        def settle():
+            for i, pending in enumerate(pendings):
+                pending.release(i not in failed)
+        thread = threading.Thread(target=settle)
+        thread.start()
+        thread.join()
+
+    def test_settled_on_other_threads(self):
+        acknowledger = MessageAcknowledger(mode='after-callback',
+                                           batch_size=5, batch_interval=60)
+        pendings = [acknowledger.received(m) for m in self.messages]
+        self.settle_on_thread(pendings, failed=(3,))
+        # nothing is sent until the consumer thread drains the queue
+        self.assertEqual(self.channel.acked, [])
+        self.assertEqual(self.channel.threads, set())
+
+        acknowledger.drain()
+        self.assertEqual(self.channel.acked, [(10, True)])
+        self.assertEqual(self.messages[3].state, 'REQUEUED')
+        self.assertEqual(self.channel.threads,
+                         set([threading.current_thread()]))
+
+    def test_batch(self):
+        acknowledger = MessageAcknowledger(mode='batch', batch_size=4,
+                                           batch_interval=60)
+        for message in self.messages:
+            acknowledger.received(message)
+        self.assertEqual(self.channel.acked, [(4, True), (8, True)])
+
+    def test_prefetch_changed_on_consumer_thread(self):
+        applied = []
+        def set_prefetch(prefetch):
+            applied.append((prefetch, threading.current_thread()))
+        acknowledger = MessageAcknowledger(mode='batch', prefetch=10,
+                                           batch_size=100)
+        acknowledger.bind(set_prefetch)
+        self.assertEqual(acknowledger.batch_size, 10)
+        acknowledger.received(self.messages[0])
+        thread = threading.Thread(target=acknowledger.set_prefetch,
+                                  args=(2,))
+        thread.start()
+        thread.join()
+        self.assertEqual([prefetch for prefetch, t in applied], [10])
+        acknowledger.drain()
+        self.assertEqual(applied[1:], [(2, threading.current_thread())])
+        self.assertEqual(acknowledger.batch_size, 2)
+
+    def test_prefetch_changed_in_immediate_mode(self):
+        applied = []
+        acknowledger = MessageAcknowledger()
+        acknowledger.bind(applied.append)
+        self.assertEqual(applied, [])
+        acknowledger.set_prefetch(5)
+        acknowledger.received(self.messages[0])
+        self.assertEqual(applied, [5])
+        self.assertEqual(self.messages[0].state, 'ACK')
+
+
+class AckModeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = list(synthetic_messages(200))
+        self.transport = MessageTransport()
+        # the dispatcher prints the tracebacks of failed callbacks
+        self.stderr = sys.stderr
+        sys.stderr = StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+
+    def run_acked(self, acknowledger, callback=lambda builddata: None):
+        return run_monitor(self.messages, buildCallback=callback,
+                           testCallback=callback, talos=True,
+                           transport=self.transport,
+                           acknowledger=acknowledger)
+
+    def states(self):
+        return [m.state for m in self.transport.messages]
+
+    def test_immediate(self):
+        # messages are acked before their callbacks run, so failures don't
+        # matter
+        def fail(builddata):
+            raise Exception('failed')
+        self.run_acked(MessageAcknowledger(mode='immediate'), fail)
+        self.assertEqual(len(self.transport.messages), len(self.messages))
+        self.assertEqual(set(self.states()), set(['ACK']))
+
+    def test_batch(self):
+        acknowledger = MessageAcknowledger(mode='batch', batch_size=30,
+                                           batch_interval=60)
+        self.run_acked(acknowledger)
+        # the last, partial, batch is waiting for the interval to pass
+        self.assertEqual(self.states().count('ACK'),
+                         len(self.messages) // 30 * 30)
+        self.assertEqual(self.states()[-1], 'RECEIVED')
+        acknowledger.flush()
+        self.assertEqual(set(self.states()), set(['ACK']))
+
+    def test_after_callback(self):
+        def fail_try(builddata):
+            if builddata['tree'] == 'try':
+                raise Exception('failed')
+        acknowledger = MessageAcknowledger(mode='after-callback',
+                                           batch_size=1000,
+                                           batch_interval=60)
+        self.run_acked(acknowledger, fail_try)
+        # nothing is acked while the callbacks of earlier messages may be
+        # running, and the listener has exited, so settle them here
+        acknowledger.drain()
+        acknowledger.flush()
+        expected = ['REQUEUED' if data['payload']['tree'] == 'try' else 'ACK'
+                    for t, data in self.messages]
+        self.assertEqual(self.states(), expected)
+
+
+class IdleAckTest(unittest.TestCase):
+
+    def test_acked_while_idle(self):
+        # the callbacks finish after the last message has been received,
+        # so their acks are sent by the listener thread while it waits
+        channel = RecordingChannel()
+        transport = ChannelTransport(channel)
+        transport.idle_interval = 0.05
+        acknowledger = MessageAcknowledger(mode='after-callback',
+                                           batch_size=1000,
+                                           batch_interval=0.1)
+        monitor = FactoryBuildMonitor(
+            buildCallback=lambda builddata: time.sleep(0.01),
+            testCallback=lambda builddata: time.sleep(0.01), talos=True,
+            transport=transport, acknowledger=acknowledger,
+            dispatcher=CallbackDispatcher(workers=2))
+        monitor.start()
+        for t, data in synthetic_messages(50):
+            transport.put(data)
+
+        deadline = time.time() + 5
+        while time.time() < deadline and \
+                (not channel.acked or channel.acked[-1][0] != 50):
+            time.sleep(0.05)
+        transport.close()
+        monitor.join()
+        monitor.stop()
+        self.assertEqual(channel.acked[-1], (50, True))
+        self.assertEqual(channel.threads, set([monitor.monitorThread]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import unittest
+
+from pulsebuildmonitor import RevisionAggregator
+import pulsebuildmonitor.aggregate
+
+
+class Clock(object):
+    """Stands in for the time module."""
+
+    def __init__(self):
+        self.now = 1300000000.0
+
+    def time(self):
+        return self.now
+
+
+def build(revision, platform='linux', buildtype='opt',
+          tree='mozilla-central'):
+    return {'tree': tree, 'revision': revision, 'platform': platform,
+            'buildtype': buildtype}
+
+
+def test(revision, name, platform='linux', buildtype='opt',
+         tree='mozilla-central'):
+    event = build(revision, platform, buildtype, tree)
+    event['test'] = name
+    return event
+
+
+class RevisionAggregatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.time = pulsebuildmonitor.aggregate.time
+        pulsebuildmonitor.aggregate.time = self.clock
+        self.deltas = []
+
+    def tearDown(self):
+        pulsebuildmonitor.aggregate.time = self.time
+
+    def aggregator(self, **kwargs):
+        return RevisionAggregator(self.deltas.append, **kwargs)
+
+    def test_deltas(self):
+        aggregator = self.aggregator()
+        aggregator.add('build', build('abc'))
+        aggregator.add('build', build('abc', 'win32'))
+        aggregator.add('unittest', test('abc', 'reftest'))
+        aggregator.add('build', build('abc'))
+        aggregator.add('talos', test('abc', 'tp5'))
+        # an event without a revision isn't aggregated
+        aggregator.add('build', build(None))
+
+        # each delta carries the counts the event changed, not the summary
+        self.assertEqual(self.deltas[0], {
+            'tree': 'mozilla-central', 'revision': 'abc', 'kind': 'build',
+            'platform': 'linux', 'buildtype': 'opt', 'test': None,
+            'count': 1, 'new': True, 'builds': 1, 'tests': 0,
+            'unittests': 0, 'talos': 0})
+        self.assertEqual([(d['kind'], d['platform'], d['test'], d['count'],
+                           d['new'], d['builds'], d['tests'],
+                           d['unittests'], d['talos'])
+                          for d in self.deltas],
+                         [('build', 'linux', None, 1, True, 1, 0, 0, 0),
+                          ('build', 'win32', None, 1, True, 2, 0, 0, 0),
+                          ('unittest', 'linux', 'reftest', 1, True,
+                           2, 1, 1, 0),
+                          ('build', 'linux', None, 2, False, 2, 1, 1, 0),
+                          ('talos', 'linux', 'tp5', 1, True, 2, 2, 1, 1)])
+
+        summary = aggregator.summary('mozilla-central', 'abc')
+        self.assertEqual(summary['builds'],
+                         [{'platform': 'linux', 'buildtype': 'opt',
+                           'count': 2},
+                          {'platform': 'win32', 'buildtype': 'opt',
+                           'count': 1}])
+        self.assertEqual([t['test'] for t in summary['tests']],
+                         ['reftest', 'tp5'])
+        self.assertEqual((summary['unittests'], summary['talos']), (1, 1))
+
+    def test_trees(self):
+        aggregator = self.aggregator()
+        aggregator.add('build', build('abc'))
+        aggregator.add('build', build('abc', tree='try'))
+        self.assertEqual([d['new'] for d in self.deltas], [True, True])
+        self.assertEqual([s['tree'] for s in aggregator.summaries()],
+                         ['try', 'mozilla-central'])
+        self.assertEqual([s['tree'] for s in aggregator.summaries('try')],
+                         ['try'])
+
+    def test_lru(self):
+        aggregator = self.aggregator(maxsize=2)
+        aggregator.add('build', build('a'))
+        aggregator.add('build', build('b'))
+        # updating 'a' makes 'b' the least recently updated
+        aggregator.add('build', build('a', 'win32'))
+        aggregator.add('build', build('c'))
+        self.assertEqual([s['revision'] for s in aggregator.summaries()],
+                         ['c', 'a'])
+        self.assertEqual(aggregator.summary('mozilla-central', 'b'), None)
+        # a forgotten revision starts again
+        aggregator.add('build', build('b'))
+        self.assertEqual(self.deltas[-1]['new'], True)
+        self.assertEqual([s['revision'] for s in aggregator.summaries()],
+                         ['b', 'c'])
+
+    def test_max_age(self):
+        aggregator = self.aggregator(max_age=60)
+        aggregator.add('build', build('a'))
+        self.clock.now += 30
+        aggregator.add('build', build('b'))
+        self.clock.now += 40
+        # 'a' is 70 seconds old when the next event arrives
+        aggregator.add('build', build('c'))
+        self.assertEqual([s['revision'] for s in aggregator.summaries()],
+                         ['c', 'b'])
+        summary = aggregator.summary('mozilla-central', 'b')
+        self.assertEqual((summary['first_seen'], summary['last_seen']),
+                         (1300000030.0, 1300000030.0))
+
+        # an update keeps a revision
+        self.clock.now += 10
+        aggregator.add('build', build('b', 'win32'))
+        self.clock.now += 55
+        aggregator.add('build', build('d'))
+        self.assertEqual([s['revision'] for s in aggregator.summaries()],
+                         ['d', 'b'])
+
+    def test_dispatcher(self):
+        class Dispatcher(object):
+            def __init__(self):
+                self.submitted = []
+
+            def submit(self, callback, *args):
+                self.submitted.append((callback, args))
+        dispatcher = Dispatcher()
+        aggregator = self.aggregator(dispatcher=dispatcher)
+        aggregator.add('build', build('abc'))
+        self.assertEqual(self.deltas, [])
+        callback, args = dispatcher.submitted[0]
+        callback(*args)
+        self.assertEqual(self.deltas[0]['revision'], 'abc')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+from pulsebuildmonitor import EventArchive
+from pulsebuildmonitor.archive import ActiveSegment, SealedSegment
+
+
+def event(n):
+    return {'n': n, 'tree': ('mozilla-central', 'try')[n % 2],
+            'platform': 'linux', 'buildtype': 'opt',
+            'revision': 'rev%d' % (n // 10), 'builddate': 1300000000 + n}
+
+
+class EventArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archives = []
+
+    def tearDown(self):
+        for archive in self.archives:
+            if not archive.closed:
+                archive.close()
+        shutil.rmtree(self.directory)
+
+    def archive(self, **kwargs):
+        kwargs.setdefault('segment_size', 10)
+        kwargs.setdefault('block_size', 3)
+        kwargs.setdefault('flush_interval', 60)
+        archive = EventArchive(self.directory, **kwargs)
+        self.archives.append(archive)
+        return archive
+
+    def filled(self, count, **kwargs):
+        """An archive holding events 0 to count - 1, reopened."""
+        archive = self.archive(**kwargs)
+        for n in xrange(count):
+            archive.add('build', event(n))
+        archive.close()
+        return self.archive(**kwargs)
+
+    def numbers(self, results):
+        return [payload['n'] for kind, payload in results]
+
+    def files(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_rollover(self):
+        archive = self.filled(25)
+        # full segments are sealed, and their indexes written
+        self.assertEqual(self.files(),
+                         ['events.0.dat', 'events.0.idx', 'events.1.dat',
+                          'events.1.idx', 'events.2.dat'])
+        self.assertEqual([s.__class__ for s in archive.sealed],
+                         [SealedSegment, SealedSegment])
+        self.assertEqual([s.count for s in archive.sealed], [10, 10])
+        self.assertEqual(archive.active.count, 5)
+        self.assertEqual(archive.total(), 25)
+
+        # more events fill the open segment and start another
+        for n in xrange(25, 32):
+            archive.add('build', event(n))
+        archive.flush()
+        self.assertEqual(archive.total(), 32)
+        self.assertEqual(archive.active.number, 3)
+        self.assertEqual(self.numbers(archive.query()), range(32))
+
+    def test_range_query(self):
+        archive = self.filled(25)
+        # from the first sealed segment into the open one
+        results = archive.query(since=1300000005, until=1300000022)
+        self.assertEqual(self.numbers(results), range(5, 22))
+        results = archive.query(since=1300000005, until=1300000022,
+                                tree='try')
+        self.assertEqual(self.numbers(results), range(5, 22, 2))
+        self.assertEqual(self.numbers(archive.query(since=1300000023)),
+                         [23, 24])
+        self.assertEqual(self.numbers(archive.query(until=1300000002)),
+                         [0, 1])
+        self.assertEqual(archive.query(since=1300000100), [])
+        self.assertEqual(self.numbers(archive.query(since=1300000005,
+                                                    limit=8)),
+                         range(5, 13))
+
+        # events without a builddate aren't in any range
+        archive.add('talos', {'n': 25, 'tree': 'try'})
+        archive.flush()
+        self.assertEqual(self.numbers(archive.query(since=1300000020)),
+                         range(20, 25))
+        self.assertEqual(self.numbers(archive.query(kind='talos')), [25])
+
+    def test_field_query(self):
+        archive = self.filled(25)
+        self.assertEqual(self.numbers(archive.query(revision='rev1')),
+                         range(10, 20))
+        self.assertEqual(self.numbers(archive.query(revision='rev2',
+                                                    tree='mozilla-central')),
+                         [20, 22, 24])
+        self.assertEqual(archive.query(revision='rev1', platform='win32'),
+                         [])
+
+    def test_torn_write(self):
+        self.filled(25).close()
+        # a crash while a block was being written to the open segment
+        data = zlib.compress('["build",{"n":25}]\n["build",{"n":26}]')
+        f = open(os.path.join(self.directory, 'events.2.dat'), 'ab')
+        f.write(struct.pack('<II', len(data), 2) + data[:len(data) // 2])
+        f.close()
+
+        archive = self.archive()
+        self.assertEqual(archive.total(), 25)
+        self.assertEqual(self.numbers(archive.query(since=1300000020)),
+                         range(20, 25))
+        # the torn block is cut off, and new blocks follow the last whole
+        # one
+        archive.add('build', event(25))
+        archive.close()
+        archive = self.archive()
+        self.assertEqual(self.numbers(archive.query()), range(26))
+
+    def test_unsealed_segment(self):
+        self.filled(20).close()
+        # a crash after a segment filled, but before its index was written
+        os.remove(os.path.join(self.directory, 'events.1.idx'))
+        archive = self.archive()
+        self.assertEqual([s.count for s in archive.sealed], [10, 10])
+        self.assertTrue(os.path.exists(os.path.join(self.directory,
+                                                    'events.1.idx')))
+        self.assertEqual(self.numbers(archive.query(revision='rev1')),
+                         range(10, 20))
+
+    def test_max_segments(self):
+        archive = self.filled(35, max_segments=2)
+        self.assertEqual(self.files(),
+                         ['events.2.dat', 'events.2.idx', 'events.3.dat'])
+        self.assertEqual(self.numbers(archive.query()), range(20, 35))
+
+
+class ActiveSegmentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sealed_lookups_match(self):
+        path = os.path.join(self.directory, 'events.0')
+        segment = ActiveSegment(0, path)
+        events = [event(n) for n in range(20)]
+        for i in range(0, 20, 6):
+            block = events[i:i + 6]
+            segment.append(['["build",{"n":%d}]' % e['n'] for e in block],
+                           [ActiveSegment.entry(e) for e in block])
+        active = [list(segment.lookup('tree', 'try')),
+                  list(segment.lookup_dates(1300000003, 1300000015))]
+        sealed = segment.seal()
+        try:
+            self.assertEqual([list(sealed.lookup('tree', 'try')),
+                              list(sealed.lookup_dates(1300000003,
+                                                       1300000015))],
+                             active)
+            self.assertEqual(active[1], range(3, 15))
+            self.assertEqual([payload['n'] for kind, payload in
+                              sealed.read([0, 7, 19])], [0, 7, 19])
+        finally:
+            sealed.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
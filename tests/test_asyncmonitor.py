@@ -0,0 +1,206 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import os
+import subprocess
+import sys
+import threading
+import unittest
+
+from pulsebuildmonitor import (AsyncPulseBuildMonitor, QueueTransport,
+                               synthetic_messages)
+from pulsebuildmonitor.asyncmonitor import EventStream, MonitorEvent
+
+try:
+    import trollius as asyncio
+    From = asyncio.From
+except ImportError:
+    asyncio = None
+
+
+def count_kinds(messages):
+    builds = sum(1 for t, data in messages
+                 if data['_meta']['routing_key'].startswith('build'))
+    return builds, len(messages) - builds
+
+
+class StubMonitor(object):
+    """The parts of an AsyncPulseBuildMonitor an EventStream uses, before
+       the monitor has a loop.
+    """
+
+    loop = None
+
+    def __init__(self):
+        self.removed = []
+
+    def remove_stream(self, stream):
+        self.removed.append(stream)
+
+
+class EventStreamTest(unittest.TestCase):
+    """The thread side of EventStream, which doesn't need trollius."""
+
+    def setUp(self):
+        self.monitor = StubMonitor()
+        self.stream = EventStream(self.monitor, ('build',))
+        self.released = []
+
+    def put(self, n):
+        self.stream.put(MonitorEvent('build', n),
+                        lambda success: self.released.append((n, success)))
+
+    def test_iterate(self):
+        for n in xrange(3):
+            self.put(n)
+        events = []
+        for event in self.stream:
+            events.append(event.data)
+            if len(events) == 3:
+                self.stream.close()
+        self.assertEqual(events, [0, 1, 2])
+        # each event is released as it is taken
+        self.assertEqual(self.released, [(0, True), (1, True), (2, True)])
+        self.assertEqual(self.monitor.removed, [self.stream])
+
+    def test_close_releases_queued_events(self):
+        self.put(0)
+        self.put(1)
+        self.stream.close()
+        self.assertEqual(self.released, [(0, True), (1, True)])
+        self.assertEqual(list(self.stream), [])
+        # every reader sees the end of the stream
+        self.assertEqual(list(self.stream), [])
+
+    def test_close_from_another_thread(self):
+        events = []
+
+        def consume():
+            for event in self.stream:
+                events.append(event.data)
+        thread = threading.Thread(target=consume)
+        thread.start()
+        self.put(0)
+        self.stream.close()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(events in ([0], []))
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_trollius_not_imported_with_package(self):
+        code = ('import sys, pulsebuildmonitor; '
+                'sys.exit("trollius" in sys.modules)')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        self.assertEqual(subprocess.call([sys.executable, '-c', code],
+                                         env=env), 0)
+
+    @unittest.skipIf(asyncio is not None, 'trollius is installed')
+    def test_requires_trollius(self):
+        self.assertRaises(ImportError, AsyncPulseBuildMonitor,
+                          buildCallback=lambda builddata: None,
+                          transport=QueueTransport())
+
+
+@unittest.skipIf(asyncio is None, 'needs trollius')
+class AsyncMonitorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.transport = QueueTransport()
+        self.messages = list(synthetic_messages(100))
+        self.builds, self.tests = count_kinds(self.messages)
+
+    def tearDown(self):
+        self.transport.close()
+        self.loop.close()
+
+    def publish(self):
+        for t, data in self.messages:
+            self.transport.put(data)
+
+    def test_coroutine_callbacks(self):
+        received = []
+        loop = self.loop
+
+        @asyncio.coroutine
+        def onBuild(builddata):
+            yield From(asyncio.sleep(0.001, loop=loop))
+            received.append(builddata)
+
+        monitor = AsyncPulseBuildMonitor(buildCallback=onBuild, trees=None,
+                                         loop=loop, concurrency=5,
+                                         transport=self.transport)
+        monitor.start()
+        self.publish()
+
+        @asyncio.coroutine
+        def wait():
+            while len(received) < self.builds:
+                yield From(asyncio.sleep(0.01, loop=loop))
+
+        loop.run_until_complete(asyncio.wait_for(wait(), 5, loop=loop))
+        self.assertEqual(len(received), self.builds)
+
+    def test_stream_get(self):
+        monitor = AsyncPulseBuildMonitor(builds=True, unittests=True,
+                                         talos=True, trees=None,
+                                         loop=self.loop,
+                                         transport=self.transport)
+        stream = monitor.events()
+        monitor.start()
+        self.publish()
+
+        events = []
+
+        @asyncio.coroutine
+        def consume():
+            while len(events) < len(self.messages):
+                event = yield From(stream.get())
+                events.append(event)
+            stream.close()
+            # a closed stream returns None
+            event = yield From(stream.get())
+            events.append(event)
+
+        self.loop.run_until_complete(
+            asyncio.wait_for(consume(), 5, loop=self.loop))
+        kinds = [e.kind for e in events[:-1]]
+        self.assertEqual(kinds.count('build'), self.builds)
+        self.assertEqual(kinds.count('test'), self.tests)
+        self.assertEqual(events[-1], None)
+
+    def test_stream_on_thread(self):
+        monitor = AsyncPulseBuildMonitor(builds=True, trees=None,
+                                         loop=self.loop,
+                                         transport=self.transport)
+        stream = monitor.events()
+        events = []
+
+        def consume():
+            for event in stream:
+                events.append(event)
+                if len(events) == self.builds:
+                    stream.close()
+
+        thread = threading.Thread(target=consume)
+        thread.start()
+        monitor.start()
+        self.publish()
+
+        @asyncio.coroutine
+        def wait():
+            while thread.is_alive():
+                yield From(asyncio.sleep(0.01, loop=self.loop))
+
+        self.loop.run_until_complete(
+            asyncio.wait_for(wait(), 5, loop=self.loop))
+        self.assertEqual(len(events), self.builds)
+        self.assertEqual(set(e.kind for e in events), set(['build']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import pickle
+import unittest
+
+from pulsebuildmonitor import BuildEvent, TestEvent, synthetic_messages
+from pulsebuildmonitor import events
+
+
+def payloads(kind):
+    return [data['payload'] for t, data in synthetic_messages(200)
+            if data['_meta']['routing_key'].startswith(kind)]
+
+
+class EventTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for payload in payloads('build'):
+            event = BuildEvent.from_payload(payload)
+            self.assertEqual(event.as_dict(), payload)
+            self.assertEqual(event['tree'], payload['tree'])
+            self.assertEqual(event.get('missing', 1), 1)
+        for payload in payloads('unittest'):
+            event = TestEvent.from_payload(payload)
+            self.assertEqual(event.as_dict(), payload)
+            self.assertEqual(pickle.loads(pickle.dumps(event)), event)
+
+    def test_shared_values(self):
+        a = BuildEvent(tree=u''.join([u'mozilla-', u'central']),
+                       buildername=u''.join([u'linux ', u'build']))
+        b = BuildEvent(tree=u''.join([u'mozilla-', u'central']),
+                       buildername=u''.join([u'linux ', u'build']))
+        self.assertTrue(a.tree is b.tree)
+        # builder names have too many values to keep
+        self.assertFalse(a.buildername is b.buildername)
+
+    def test_table_bounded(self):
+        size = events.INTERN_TABLE_SIZE
+        events.INTERN_TABLE_SIZE = 10
+        try:
+            for i in xrange(25):
+                events.intern_value(u'tree-%d' % i)
+                self.assertTrue(len(events._interned) <= 10)
+        finally:
+            events.INTERN_TABLE_SIZE = size
+
+
+if __name__ == '__main__':
+    unittest.main()
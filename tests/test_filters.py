@@ -0,0 +1,179 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import unittest
+
+from pulsebuildmonitor import synthetic_messages
+from pulsebuildmonitor.filters import (MessageFilter, TagMatcher,
+                                       parse_routing_key)
+
+from tests.test_monitor import Recorder, keys, run_monitor
+
+
+class RoutingKeyTest(unittest.TestCase):
+
+    def test_build_key(self):
+        rk = parse_routing_key('build.mozilla-central.linux64.opt.l10n')
+        self.assertEqual((rk.kind, rk.tree, rk.platform, rk.buildtype),
+                         ('build', 'mozilla-central', 'linux64', 'opt'))
+        self.assertEqual(rk.test, None)
+
+    def test_test_keys(self):
+        rk = parse_routing_key('talos.try.win32.win7.opt.tp5.firefox.12')
+        self.assertEqual((rk.kind, rk.tree, rk.platform, rk.os, rk.buildtype,
+                          rk.test, rk.product),
+                         ('talos', 'try', 'win32', 'win7', 'opt', 'tp5',
+                          'firefox'))
+        rk = parse_routing_key('unittest.try.linux.fedora.debug.reftest.'
+                               'firefox.3')
+        self.assertEqual(rk.kind, 'unittest')
+
+    def test_unparseable(self):
+        self.assertEqual(parse_routing_key('build.mozilla-central'), None)
+
+    def test_memoized(self):
+        key = 'build.fx-team.android.debug.l10n'
+        self.assertTrue(parse_routing_key(key) is parse_routing_key(key))
+
+
+class TagMatcherTest(unittest.TestCase):
+
+    def test_all_of(self):
+        matcher = TagMatcher(['pgo', 'nightly'])
+        self.assertTrue(matcher.match(['nightly', 'pgo', 'l10n']))
+        self.assertFalse(matcher.match(['nightly']))
+        self.assertFalse(matcher.match(None))
+
+    def test_any_list(self):
+        matcher = TagMatcher([['pgo'], ['nightly', 'l10n']])
+        self.assertTrue(matcher.match(['pgo']))
+        self.assertTrue(matcher.match(['l10n', 'nightly']))
+        self.assertFalse(matcher.match(['nightly']))
+
+
+class MessageFilterTest(unittest.TestCase):
+
+    def test_categories(self):
+        filter = MessageFilter(builds=True)
+        self.assertTrue(filter.wants_category('build'))
+        self.assertFalse(filter.wants_category('test'))
+        filter = MessageFilter(talos=True)
+        self.assertTrue(filter.wants_category('test'))
+        rk = parse_routing_key('unittest.try.linux.fedora.debug.reftest.'
+                               'firefox.3')
+        self.assertFalse(filter.accepts_key(rk))
+
+    def test_single_string(self):
+        filter = MessageFilter(trees='try', builds=True)
+        rk = parse_routing_key('build.try.linux.opt.l10n')
+        self.assertTrue(filter.accepts_key(rk))
+        rk = parse_routing_key('build.tryx.linux.opt.l10n')
+        self.assertFalse(filter.accepts_key(rk))
+
+
+class FilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = list(synthetic_messages(500))
+        self.recorder = Recorder()
+
+    def run_filtered(self, **kwargs):
+        run_monitor(self.messages, buildCallback=self.recorder.build,
+                    testCallback=self.recorder.test, talos=True, **kwargs)
+
+    def assertReceived(self, accept):
+        builds = [(t, data) for t, data in self.messages
+                  if data['_meta']['routing_key'].startswith('build')]
+        tests = [(t, data) for t, data in self.messages
+                 if not data['_meta']['routing_key'].startswith('build')]
+        self.assertEqual(keys(self.recorder.builds),
+                         sorted(data['payload']['key'] for t, data in builds
+                                if accept(data['payload'])))
+        self.assertEqual(keys(self.recorder.tests),
+                         sorted(data['payload']['key'] for t, data in tests
+                                if accept(data['payload'])))
+        self.assertTrue(self.recorder.builds)
+        self.assertTrue(self.recorder.tests)
+
+    def test_no_filters(self):
+        self.run_filtered()
+        self.assertReceived(lambda payload: True)
+
+    def test_trees(self):
+        self.run_filtered(trees=['try', 'fx-team'])
+        self.assertReceived(
+            lambda payload: payload['tree'] in ('try', 'fx-team'))
+
+    def test_platforms_and_buildtypes(self):
+        self.run_filtered(platforms=['linux', 'win32'], buildtypes='debug')
+        self.assertReceived(
+            lambda payload: payload['platform'] in ('linux', 'win32') and
+                            payload['buildtype'] == 'debug')
+
+    def test_tests(self):
+        self.run_filtered(tests=['reftest', 'tp5'])
+        # builds have no test, and aren't filtered by it
+        self.assertReceived(
+            lambda payload: payload.get('test', 'reftest') in
+                            ('reftest', 'tp5'))
+
+    def test_products(self):
+        self.run_filtered(products=['firefox'])
+        self.assertReceived(lambda payload: True)
+
+        self.recorder = Recorder()
+        self.run_filtered(products=['thunderbird'])
+        self.assertEqual(self.recorder.builds, [])
+        self.assertEqual(self.recorder.tests, [])
+
+    def test_buildtags(self):
+        def tagged(*tags):
+            return sorted(data['payload']['key'] for t, data in self.messages
+                          if set(tags) <= set(data['payload'].get('tags', ())))
+        run_monitor(self.messages, buildCallback=self.recorder.build,
+                    buildtags=['pgo', 'nightly'])
+        self.assertEqual(keys(self.recorder.builds), tagged('pgo', 'nightly'))
+        self.assertTrue(self.recorder.builds)
+
+        # any one of several lists of tags
+        self.recorder = Recorder()
+        run_monitor(self.messages, buildCallback=self.recorder.build,
+                    buildtags=[['pgo'], ['nightly']])
+        self.assertEqual(keys(self.recorder.builds), tagged('nightly'))
+        self.assertTrue(len(tagged('nightly')) > len(tagged('pgo')))
+
+    def test_filtered_counts(self):
+        def counts(monitor):
+            return dict((reason, counter.value) for reason, counter
+                        in monitor.filteredCount.items() if counter.value)
+
+        monitor = run_monitor(self.messages, buildCallback=self.recorder.build,
+                              trees=['try'], buildtags=['pgo'])
+        builds = [data['payload'] for t, data in self.messages
+                  if data['_meta']['routing_key'].startswith('build')]
+        try_builds = [p for p in builds if p['tree'] == 'try']
+        self.assertEqual(counts(monitor), {
+            'tree': len(builds) - len(try_builds),
+            'buildtag': len([p for p in try_builds
+                             if 'pgo' not in p.get('tags', ())])})
+
+        monitor = run_monitor(self.messages, testCallback=self.recorder.test,
+                              tests=['reftest'])
+        self.assertEqual(counts(monitor), {
+            'test': len([data for t, data in self.messages
+                         if data['_meta']['routing_key'].startswith('unit')
+                         and data['payload']['test'] != 'reftest'])})
+
+        # on an unfiltered feed, kinds which aren't wanted at all are
+        # counted before their keys are parsed
+        monitor = run_monitor([], buildCallback=self.recorder.build)
+        for key in ('unittest.try.linux.opt.x.reftest.firefox.builder',
+                    'talos.try.linux.opt.x.tp5.firefox.builder'):
+            self.assertEqual(monitor.parse_key(key), None)
+        self.assertEqual(counts(monitor), {'unittest': 1, 'talos': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+from pulsebuildmonitor import Destination, WebhookForwarder
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubService(object):
+    """A webhook service on an ephemeral port which answers the first
+       'failures' requests with a 500, and records the events of each
+       request it accepts.
+    """
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.requests = 0
+        self.events = []
+        self.lock = threading.Lock()
+        self.server = make_server('127.0.0.1', 0, self.app,
+                                  handler_class=QuietHandler)
+        self.url = 'http://127.0.0.1:%d/hook' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def app(self, environ, start_response):
+        body = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            if self.failures:
+                self.failures -= 1
+                start_response('500 Internal Server Error',
+                               [('Content-Type', 'text/plain')])
+                return ['failed']
+            events = json.loads(body)
+            if isinstance(events, dict):
+                events = [events]
+            self.events.extend(event['payload']['n'] for event in events)
+        finally:
+            self.lock.release()
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['ok']
+
+    def wait_for(self, count, timeout=10):
+        deadline = time.time() + timeout
+        while len(self.events) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ForwarderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.service = StubService()
+
+    def tearDown(self):
+        self.service.close()
+        shutil.rmtree(self.spool_dir)
+
+    def forwarder(self, **kwargs):
+        kwargs.setdefault('name', 'stub')
+        kwargs.setdefault('backoff', 0.01)
+        kwargs.setdefault('max_backoff', 0.05)
+        return WebhookForwarder([Destination(self.service.url, **kwargs)],
+                                spool_dir=self.spool_dir)
+
+    def add(self, forwarder, numbers):
+        for n in numbers:
+            forwarder.add('build', {'tree': 'mozilla-central', 'n': n})
+
+    def counter(self, forwarder, name):
+        return getattr(forwarder.senders[0], name).value
+
+    def wait_for_counter(self, forwarder, name, value, timeout=10):
+        deadline = time.time() + timeout
+        while self.counter(forwarder, name) < value and \
+                time.time() < deadline:
+            time.sleep(0.01)
+
+    def spooled(self):
+        events = []
+        for name in ('stub.spool.replay', 'stub.spool'):
+            path = os.path.join(self.spool_dir, name)
+            if os.path.exists(path):
+                f = open(path)
+                try:
+                    events.extend(json.loads(line)['payload']['n']
+                                  for line in f)
+                finally:
+                    f.close()
+        return events
+
+    def test_retried(self):
+        self.service.failures = 2
+        forwarder = self.forwarder(retries=3)
+        self.add(forwarder, range(5))
+        self.service.wait_for(5)
+        forwarder.close()
+        self.assertEqual(self.service.events, range(5))
+        self.assertEqual(self.counter(forwarder, 'retryCount'), 2)
+        self.assertEqual(self.counter(forwarder, 'spoolCount'), 0)
+        self.assertEqual(self.spooled(), [])
+
+    def test_spooled_across_restart(self):
+        # the service fails for longer than the forwarder retries, so the
+        # events are spooled, and still there once it has been closed
+        self.service.failures = 1000
+        forwarder = self.forwarder(retries=2)
+        self.add(forwarder, range(10))
+        self.wait_for_counter(forwarder, 'spoolCount', 10)
+        forwarder.close()
+        self.assertEqual(self.service.events, [])
+        self.assertTrue(self.counter(forwarder, 'retryCount') >= 2)
+        self.assertEqual(self.spooled(), range(10))
+
+        # a new forwarder sends them, ahead of new events, once the
+        # service recovers
+        self.service.failures = 3
+        forwarder = self.forwarder(retries=0)
+        self.add(forwarder, range(10, 20))
+        self.service.wait_for(20)
+        forwarder.close()
+        self.assertEqual(self.service.events, range(20))
+        self.assertEqual(self.spooled(), [])
+        self.assertFalse(forwarder.senders[0].spool.pending())
+
+    def test_in_order_after_recovery(self):
+        # events added while earlier ones are spooled are spooled behind
+        # them rather than overtaking them
+        self.service.failures = 5
+        forwarder = self.forwarder(retries=1, batch_size=3,
+                                   batch_interval=0.01)
+        for i in xrange(10):
+            self.add(forwarder, range(i * 5, i * 5 + 5))
+            time.sleep(0.01)
+        self.service.wait_for(50)
+        forwarder.close()
+        self.assertEqual(self.service.events, range(50))
+        self.assertTrue(self.counter(forwarder, 'spoolCount') > 0)
+        self.assertEqual(self.counter(forwarder, 'sentCount'), 50)
+        self.assertEqual(self.spooled(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pulsebuildmonitor import StateJournal
+
+
+class StateJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def journal(self, **kwargs):
+        journal = StateJournal(self.directory, sync_interval=0, **kwargs)
+        self.loaded = journal.load()
+        return journal
+
+    def journals(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.startswith('journal.'))
+
+    def test_reload(self):
+        journal = self.journal()
+        self.assertEqual(self.loaded, (None, []))
+        for n in range(5):
+            journal.append({'n': n})
+        journal.close()
+
+        journal = self.journal()
+        self.assertEqual(self.loaded, (None, [{'n': n} for n in range(5)]))
+        journal.append({'n': 5})
+        journal.close()
+        self.journal()
+        self.assertEqual(self.loaded[1], [{'n': n} for n in range(6)])
+
+    def test_torn_record(self):
+        journal = self.journal()
+        for n in range(3):
+            journal.append({'n': n})
+        journal.close()
+        # a crash while the last record was being written
+        path = os.path.join(self.directory, 'journal.0.log')
+        f = open(path, 'ab')
+        f.write('{"n": 3, "tr')
+        f.close()
+        size = os.path.getsize(path)
+
+        journal = self.journal()
+        self.assertEqual(self.loaded[1], [{'n': n} for n in range(3)])
+        # the torn record is cut off, so the next one starts a line
+        self.assertEqual(os.path.getsize(path), size - len('{"n": 3, "tr'))
+        journal.append({'n': 4})
+        journal.close()
+        self.journal()
+        self.assertEqual(self.loaded[1],
+                         [{'n': n} for n in range(3)] + [{'n': 4}])
+
+    def test_compaction(self):
+        journal = self.journal(compact_every=3)
+        state = []
+        for n in range(5):
+            journal.append({'n': n})
+            state.append(n)
+            if journal.needs_compaction:
+                journal.compact(state)
+        journal.close()
+        # records 0-2 were compacted into the snapshot, and its journal
+        # holds the rest
+        self.assertEqual(self.journals(), ['journal.1.log'])
+
+        journal = self.journal(compact_every=3)
+        self.assertEqual(self.loaded, ([0, 1, 2], [{'n': 3}, {'n': 4}]))
+        self.assertEqual(journal.generation, 1)
+        self.assertEqual(journal.records, 2)
+        journal.append({'n': 5})
+        self.assertTrue(journal.needs_compaction)
+        journal.compact(range(6))
+        journal.close()
+
+        self.journal()
+        self.assertEqual(self.loaded, (range(6), []))
+        self.assertEqual(self.journals(), ['journal.2.log'])
+
+    def test_stale_journal_removed(self):
+        # a crash after a snapshot was written, but before the journal it
+        # replaced was removed
+        journal = self.journal()
+        journal.append({'n': 0})
+        journal.compact([0])
+        journal.close()
+        open(os.path.join(self.directory, 'journal.0.log'), 'w').close()
+
+        self.journal()
+        self.assertEqual(self.loaded, ([0], []))
+        self.assertEqual(self.journals(), ['journal.1.log'])
+
+
+if __name__ == '__main__':
+    unittest.main()
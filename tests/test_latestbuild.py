@@ -0,0 +1,115 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import unittest
+
+from webob import Request
+
+from latestbuild import CachedResponse, LatestBuildMonitor
+
+
+def build(tree, platform, buildtype, buildurl):
+    return {'tree': tree, 'platform': platform, 'buildtype': buildtype,
+            'buildurl': buildurl, 'revision': 'abcdef123456',
+            'builddate': 1300000000, 'testsurl': None}
+
+
+class QueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = LatestBuildMonitor(debounce=0)
+        self.app.buildCallback(build('mozilla-central', 'linux', 'opt',
+                                     'http://example.com/linux-opt.tar.bz2'))
+        self.app.buildCallback(build('mozilla-central', 'win32', 'debug',
+                                     'http://example.com/win32-debug.zip'))
+
+    def get(self, path):
+        return Request.blank(path).get_response(self.app)
+
+    def test_known_build(self):
+        resp = self.get('/mozilla-central/linux/opt')
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.json['buildurl'],
+                         'http://example.com/linux-opt.tar.bz2')
+
+    def test_tree(self):
+        resp = self.get('/mozilla-central')
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(sorted(resp.json), ['linux', 'win32'])
+
+    def test_unknown_tree(self):
+        self.assertEqual(self.get('/try').status_int, 404)
+
+    def test_unknown_platform(self):
+        self.assertEqual(self.get('/mozilla-central/macosx64').status_int, 404)
+
+    def test_unknown_buildtype(self):
+        self.assertEqual(self.get('/mozilla-central/linux/debug').status_int,
+                         404)
+
+    def test_unknown_platform_parameter(self):
+        resp = self.get('/?tree=mozilla-central&platform=macosx64')
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.json, {})
+
+    def test_build_during_query(self):
+        app = self.app
+        lock = app.lock
+
+        class Lock(object):
+            # a build arrives as soon as the query has released the lock,
+            # before its result is cached
+            def acquire(self):
+                lock.acquire()
+
+            def release(self):
+                lock.release()
+                app.lock = lock
+                app.buildCallback(build('mozilla-central', 'linux', 'opt',
+                                        'http://example.com/newer.tar.bz2'))
+        app.lock = Lock()
+        resp = self.get('/mozilla-central/linux/opt')
+        self.assertEqual(resp.json['buildurl'],
+                         'http://example.com/linux-opt.tar.bz2')
+        resp = self.get('/mozilla-central/linux/opt')
+        self.assertEqual(resp.json['buildurl'],
+                         'http://example.com/newer.tar.bz2')
+
+
+class CachedResponseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.body = '{"builds": [%s]}' % ', '.join(['"build"'] * 1000)
+        self.cached = CachedResponse(self.body)
+
+    def get(self, **headers):
+        return self.cached.response(Request.blank('/', headers=headers))
+
+    def test_no_accept_encoding(self):
+        resp = self.get()
+        self.assertEqual(resp.content_encoding, None)
+        self.assertEqual(resp.body, self.body)
+        self.assertEqual(tuple(resp.vary), ('Accept-Encoding',))
+
+    def test_accepts_gzip(self):
+        resp = self.get(**{'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(resp.content_encoding, 'gzip')
+        self.assertEqual(resp.body, self.cached.gzipped)
+        self.assertEqual(tuple(resp.vary), ('Accept-Encoding',))
+
+    def test_refuses_gzip(self):
+        for value in ('identity', 'gzip;q=0, identity', 'deflate'):
+            resp = self.get(**{'Accept-Encoding': value})
+            self.assertEqual(resp.content_encoding, None, value)
+            self.assertEqual(resp.body, self.body)
+
+    def test_not_modified(self):
+        resp = self.get(**{'If-None-Match': '"%s"' % self.cached.etag})
+        self.assertEqual(resp.status_int, 304)
+        self.assertEqual(tuple(resp.vary), ('Accept-Encoding',))
+
+
+if __name__ == '__main__':
+    unittest.main()
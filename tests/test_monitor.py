@@ -0,0 +1,171 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import threading
+import unittest
+
+from pulsebuildmonitor import (CallbackDispatcher, EventCoalescer,
+                               EventDeduplicator, FactoryBuildMonitor,
+                               PulseHub, QueueTransport, synthetic_messages)
+
+
+class RecordingDispatcher(CallbackDispatcher):
+    """A CallbackDispatcher which remembers the lane of each callback."""
+
+    def __init__(self, *args, **kwargs):
+        CallbackDispatcher.__init__(self, *args, **kwargs)
+        self.lanes = []
+
+    def submit(self, callback, *args, **kwargs):
+        self.lanes.append(kwargs.get('lane'))
+        return CallbackDispatcher.submit(self, callback, *args, **kwargs)
+
+
+class Recorder(object):
+    """Build and test callbacks which keep what they are passed."""
+
+    def __init__(self):
+        self.builds = []
+        self.tests = []
+        self.lock = threading.Lock()
+
+    def build(self, builddata):
+        self.lock.acquire()
+        try:
+            self.builds.append(builddata)
+        finally:
+            self.lock.release()
+
+    def test(self, builddata):
+        self.lock.acquire()
+        try:
+            self.tests.append(builddata)
+        finally:
+            self.lock.release()
+
+
+class RecordingSink(object):
+
+    def __init__(self):
+        self.events = []
+        self.closed = False
+
+    def add(self, kind, builddata):
+        self.events.append((kind, builddata))
+
+    def close(self):
+        self.closed = True
+
+
+def run_monitor(messages, **kwargs):
+    """Run a FactoryBuildMonitor over 'messages', (time, data) pairs, on a
+       QueueTransport, and return it once every callback has run.
+    """
+    transport = kwargs.setdefault('transport', QueueTransport())
+    kwargs.setdefault('dispatcher', CallbackDispatcher(workers=2))
+    monitor = FactoryBuildMonitor(**kwargs)
+    monitor.start()
+    for t, data in messages:
+        transport.put(data)
+    transport.close()
+    monitor.join()
+    monitor.stop()
+    return monitor
+
+
+def kinds(messages):
+    return [data['_meta']['routing_key'].split('.')[0]
+            for t, data in messages]
+
+
+def keys(events):
+    return sorted(builddata['key'] for builddata in events)
+
+
+class LaneTest(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = list(synthetic_messages(200))
+        self.recorder = Recorder()
+
+    def test_lanes(self):
+        dispatcher = RecordingDispatcher()
+        run_monitor(self.messages, buildCallback=self.recorder.build,
+                    testCallback=self.recorder.test, talos=True,
+                    dispatcher=dispatcher)
+        self.assertEqual(sorted(dispatcher.lanes),
+                         sorted(kinds(self.messages)))
+
+    def test_lanes_with_fields(self):
+        # the lane comes from the routing key, not the 'talos' field
+        dispatcher = RecordingDispatcher()
+        run_monitor(self.messages, buildCallback=self.recorder.build,
+                    testCallback=self.recorder.test, talos=True,
+                    dispatcher=dispatcher, fields=('tree', 'revision'))
+        self.assertEqual(sorted(dispatcher.lanes),
+                         sorted(kinds(self.messages)))
+        builds = kinds(self.messages).count('build')
+        self.assertEqual(len(self.recorder.tests), len(self.messages) - builds)
+
+
+class HubTest(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = list(synthetic_messages(200))
+        self.central = Recorder()
+        self.tests = Recorder()
+        self.sink = RecordingSink()
+
+    def run_hub(self, messages, **kwargs):
+        transport = QueueTransport()
+        hub = PulseHub(transport=transport, sinks=[self.sink],
+                       dispatcher=CallbackDispatcher(workers=2), **kwargs)
+        hub.subscribe(buildCallback=self.central.build,
+                      trees=['mozilla-central'])
+        hub.subscribe(testCallback=self.tests.test, talos=True)
+        hub.start()
+        for t, data in messages:
+            transport.put(data)
+        transport.close()
+        hub.join()
+        hub.stop()
+
+    def payloads(self, kind=None, tree=None):
+        return [data['payload'] for t, data in self.messages
+                if (kind is None or
+                    data['_meta']['routing_key'].startswith(kind)) and
+                   (tree is None or data['payload']['tree'] == tree)]
+
+    def test_subscriptions(self):
+        self.run_hub(self.messages)
+        self.assertEqual(len(self.central.builds),
+                         len(self.payloads('build', 'mozilla-central')))
+        self.assertEqual(len(self.tests.tests),
+                         len(self.payloads()) - len(self.payloads('build')))
+        self.assertEqual(len(self.sink.events), len(self.messages))
+        self.assertTrue(self.sink.closed)
+
+    def test_deduplication(self):
+        # every message twice
+        messages = [m for m in self.messages for i in (0, 1)]
+        self.run_hub(messages,
+                     deduplicator=EventDeduplicator(fields=('key', 'revision')))
+        self.assertEqual(len(self.central.builds),
+                         len(self.payloads('build', 'mozilla-central')))
+        self.assertEqual(len(self.sink.events), len(self.messages))
+
+    def test_coalescing(self):
+        # only the latest build for each tree is delivered
+        coalescer = EventCoalescer(fields=('tree',), window=60)
+        self.run_hub(self.messages, coalescer=coalescer, unittests=False,
+                     talos=False)
+        latest = self.payloads('build', 'mozilla-central')[-1]
+        self.assertEqual(self.central.builds, [latest])
+        self.assertEqual(len(self.sink.events), 4)
+        self.assertEqual(self.tests.tests, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import threading
+import time
+import unittest
+
+from pulsebuildmonitor import (CallbackDispatcher, FactoryBuildMonitor,
+                               LoadShedder, MessageAcknowledger,
+                               MetricsRegistry, QueueTransport,
+                               synthetic_messages)
+
+
+class LoadShedderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = MetricsRegistry()
+        self.changes = []
+
+    def shedder(self, **kwargs):
+        shedder = LoadShedder(**kwargs)
+        shedder.bind(self.metrics, self.changes.append)
+        return shedder
+
+    def shed(self, policy, lane):
+        return self.metrics.counter('pulsebuildmonitor_shed_total',
+                                    policy=policy, lane=lane).value
+
+    def test_overload(self):
+        shedder = self.shedder(max_pending=10, shed_at=4)
+        for i in range(4):
+            shedder.acquire()
+        self.assertTrue(shedder.overloaded)
+        # still overloaded until we are down to half of shed_at
+        shedder.release()
+        shedder.release()
+        self.assertTrue(shedder.overloaded)
+        shedder.release()
+        self.assertFalse(shedder.overloaded)
+        shedder.acquire()
+        shedder.acquire()
+        shedder.acquire()
+        self.assertEqual(self.changes, [True, False, True])
+
+    def test_max_pending(self):
+        shedder = self.shedder(max_pending=2)
+        shedder.acquire()
+        shedder.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            shedder.acquire()
+            acquired.set()
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        # the third waits until one of the others is released
+        self.assertFalse(acquired.wait(0.1))
+        shedder.release()
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+        self.assertEqual(shedder.pending, 2)
+
+    def test_drop(self):
+        shedder = self.shedder(max_pending=10, shed_at=2, drop=('talos',))
+        self.assertTrue(shedder.accept_event('talos'))
+        shedder.acquire()
+        shedder.acquire()
+        self.assertFalse(shedder.accept_event('talos'))
+        self.assertFalse(shedder.accept_event('talos'))
+        self.assertTrue(shedder.accept_event('build'))
+        self.assertEqual(self.shed('drop', 'talos'), 2)
+        self.assertEqual(self.shed('drop', 'build'), 0)
+        shedder.release()
+        shedder.release()
+        self.assertTrue(shedder.accept_event('talos'))
+
+    def test_keep_latest(self):
+        shedder = self.shedder(keep_latest=('tree', 'platform'))
+        released = []
+        run = []
+
+        def event(tree, n):
+            return {'tree': tree, 'platform': 'linux', 'n': n}
+
+        def release(n):
+            return lambda success: released.append((n, success))
+        slot = shedder.hold_latest(run.append, event('try', 0), 'build',
+                                   release(0))
+        other = shedder.hold_latest(run.append, event('fx-team', 1), 'build',
+                                    release(1))
+        self.assertTrue(slot is not None and other is not None)
+        # a later event with the same fields replaces the one waiting, and
+        # the replaced event's message is released
+        self.assertEqual(shedder.hold_latest(run.append, event('try', 2),
+                                             'build', release(2)), None)
+        self.assertEqual(released, [(0, True)])
+        self.assertEqual(self.shed('latest', 'build'), 1)
+
+        shedder.run_latest(run.append, slot)
+        shedder.slot_done(slot)(True)
+        self.assertEqual(run, [event('try', 2)])
+        self.assertEqual(released, [(0, True), (2, True)])
+        # once it has started running, a new event waits in a new slot
+        self.assertTrue(shedder.hold_latest(run.append, event('try', 3),
+                                            'build', release(3)) is not None)
+        self.assertEqual(len(shedder.waiting), 2)
+
+
+class RecordingTransport(QueueTransport):
+
+    def __init__(self):
+        QueueTransport.__init__(self)
+        self.prefetches = []
+
+    def set_prefetch(self, prefetch):
+        QueueTransport.set_prefetch(self, prefetch)
+        self.prefetches.append(prefetch)
+
+
+class OverloadPrefetchTest(unittest.TestCase):
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_prefetch_lowered_while_overloaded(self):
+        builds = [data for t, data in synthetic_messages(200)
+                  if data['_meta']['routing_key'].startswith('build')]
+        unblocked = threading.Event()
+        transport = RecordingTransport()
+        shedder = LoadShedder(max_pending=4, shed_at=2, overload_prefetch=10)
+        monitor = FactoryBuildMonitor(
+            buildCallback=lambda builddata: unblocked.wait(),
+            transport=transport,
+            dispatcher=CallbackDispatcher(workers=4),
+            acknowledger=MessageAcknowledger(mode='after-callback',
+                                             prefetch=100),
+            shedder=shedder)
+        monitor.start()
+        try:
+            # the limit is set before consuming, and the transport is given
+            # the lower one with the next message once we're overloaded
+            transport.put(builds[0])
+            transport.put(builds[1])
+            self.wait_for(lambda: shedder.overloaded)
+            transport.put(builds[2])
+            self.wait_for(lambda: transport.prefetch == 10)
+
+            # and the normal one once the callbacks have caught up
+            unblocked.set()
+            self.wait_for(lambda: not shedder.overloaded)
+            transport.put(builds[3])
+            self.wait_for(lambda: transport.prefetch == 100)
+        finally:
+            unblocked.set()
+            transport.close()
+            monitor.join()
+            monitor.stop()
+        self.assertEqual(transport.prefetches, [100, 10, 100])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import random
+import unittest
+
+from pulsebuildmonitor import BuildStats
+from pulsebuildmonitor.stats import QuantileSketch, Window
+
+
+QUANTILES = (0.0, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99, 1.0)
+
+
+class QuantileSketchTest(unittest.TestCase):
+
+    def assertAccurate(self, sketch, values):
+        values = sorted(values)
+        for q, estimate in zip(QUANTILES, sketch.quantiles(QUANTILES)):
+            true = values[int(q * (len(values) - 1))]
+            self.assertTrue(abs(estimate - true) <= sketch.accuracy * true,
+                            'p%g: %r, not %r' % (q * 100, estimate, true))
+
+    def test_accuracy(self):
+        rand = random.Random(0)
+        for accuracy in (0.01, 0.05):
+            # lags from under a second to several hours
+            values = [rand.lognormvariate(3, 2) + 0.01 for i in xrange(10000)]
+            sketch = QuantileSketch(accuracy)
+            for value in values:
+                sketch.add(value)
+            self.assertAccurate(sketch, values)
+            self.assertEqual(sketch.count, len(values))
+            # far fewer buckets than values
+            self.assertTrue(len(sketch.buckets) < 2000)
+
+    def test_uniform(self):
+        sketch = QuantileSketch()
+        for value in xrange(1, 1001):
+            sketch.add(value)
+        self.assertAccurate(sketch, range(1, 1001))
+        median = sketch.quantiles([0.5])[0]
+        self.assertTrue(495 <= median <= 505)
+
+    def test_zeros(self):
+        sketch = QuantileSketch(minimum=1e-3)
+        for value in [0, 0, 0, 1e-4, 5, 10]:
+            sketch.add(value)
+        self.assertEqual(sketch.zeros, 4)
+        self.assertEqual(sketch.quantiles([0.5])[0], 0.0)
+        estimate = sketch.quantiles([1.0])[0]
+        self.assertTrue(abs(estimate - 10) <= 0.1)
+
+    def test_empty(self):
+        self.assertEqual(QuantileSketch().quantiles([0.5, 0.9]), [None, None])
+
+    def test_merge(self):
+        rand = random.Random(1)
+        values = [rand.expovariate(0.01) + 1 for i in xrange(2000)]
+        merged = QuantileSketch()
+        for part in (values[:500], values[500:]):
+            sketch = QuantileSketch()
+            for value in part:
+                sketch.add(value)
+            merged.merge(sketch)
+        self.assertEqual(merged.count, 2000)
+        self.assertAccurate(merged, values)
+
+
+class WindowTest(unittest.TestCase):
+
+    def counts(self, window, now, kind='build'):
+        return sum(slot.counts.get(kind, 0) for slot in window.current(now))
+
+    def test_expiry(self):
+        window = Window('1m', 1, 60, 0.01)
+        window.add(1000.5, 'build', None)
+        window.add(1030, 'build', 5)
+        window.add(1059.9, 'build', None)
+        self.assertEqual(self.counts(window, 1059.9), 3)
+        # the first slot leaves the window once 60 seconds have passed
+        self.assertEqual(self.counts(window, 1060), 2)
+        self.assertEqual(self.counts(window, 1089.9), 2)
+        self.assertEqual(self.counts(window, 1090), 1)
+        self.assertEqual(self.counts(window, 1120), 0)
+
+    def test_slot_reused(self):
+        window = Window('1m', 1, 60, 0.01)
+        window.add(1000, 'build', 5)
+        window.add(1000, 'talos', 10)
+        # a minute later the same slot in the ring is started afresh
+        window.add(1060, 'build', 20)
+        slot = window.slot(1060)
+        self.assertEqual(slot.counts, {'build': 1})
+        self.assertEqual(slot.lags['build'].count, 1)
+        self.assertEqual(len([s for s in window.slots
+                              if s.epoch is not None]), 1)
+
+
+class BuildStatsTest(unittest.TestCase):
+
+    def test_windows(self):
+        stats = BuildStats(windows=(('1m', 1, 60), ('1h', 60, 60)))
+        now = 1300000000
+        for i in xrange(10):
+            stats.add('build', {'builddate': now - 100}, now=now)
+            stats.add('talos', {'builddate': now - 10}, now=now + 40)
+        stats.add('unittest', {}, now=now + 90)
+
+        snapshot = stats.snapshot(now=now + 90)
+        minute = snapshot['windows']['1m']
+        hour = snapshot['windows']['1h']
+        self.assertEqual(minute['counts'],
+                         {'build': 0, 'unittest': 1, 'talos': 10})
+        self.assertEqual(hour['counts'],
+                         {'build': 10, 'unittest': 1, 'talos': 10})
+        self.assertEqual(hour['talos_fraction'], 10 / 11.0)
+        self.assertEqual(hour['lag']['build']['count'], 10)
+        self.assertTrue(abs(hour['lag']['build']['p50'] - 100) <= 1)
+        self.assertTrue(abs(hour['lag']['talos']['p99'] - 50) <= 0.5)
+        # events without a builddate are counted but have no lag
+        self.assertFalse('unittest' in hour['lag'])
+
+        snapshot = stats.snapshot(now=now + 3600 + 60)
+        self.assertEqual(snapshot['windows']['1h']['counts'],
+                         {'build': 0, 'unittest': 1, 'talos': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import json
+import socket
+import time
+import unittest
+
+from pulsebuildmonitor import EventLog, EventStreamServer
+
+
+class EventLogTest(unittest.TestCase):
+
+    def test_since(self):
+        log = EventLog(size=3)
+        for n in range(5):
+            log.append({'n': n})
+        # only the last three are kept
+        self.assertEqual([e[0] for e in log.since(0)], [3, 4, 5])
+        self.assertEqual([e[1]['n'] for e in log.since(3)], [3, 4])
+        self.assertEqual(log.since(5), [])
+
+
+class Client(object):
+    """A raw HTTP client of an EventStreamServer."""
+
+    def __init__(self, port, target, headers=()):
+        self.sock = socket.create_connection(('127.0.0.1', port), 5)
+        self.sock.sendall('GET %s HTTP/1.1\r\nHost: localhost\r\n%s\r\n' %
+                          (target, ''.join('%s: %s\r\n' % h
+                                           for h in headers)))
+        self.data = ''
+
+    def read_until(self, text, timeout=5):
+        deadline = time.time() + timeout
+        while text not in self.data and time.time() < deadline:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                break
+            self.data += chunk
+        return text in self.data
+
+    def read_all(self):
+        while True:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                return self.data
+            self.data += chunk
+
+    def events(self):
+        """The (id, event type, data) of the SSE events read so far."""
+        body = self.data.split('\r\n\r\n', 1)[1]
+        events = []
+        for block in body.split('\n\n'):
+            fields = dict(line.split(': ', 1) for line in block.split('\n')
+                          if ': ' in line)
+            if 'id' in fields:
+                events.append((int(fields['id']), fields['event'],
+                               json.loads(fields['data'])))
+        return events
+
+    def json(self):
+        return json.loads(self.read_all().split('\r\n\r\n', 1)[1])
+
+    def close(self):
+        self.sock.close()
+
+
+class EventStreamServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = EventStreamServer(port=0, history=10, poll_timeout=5,
+                                        max_buffer=4096)
+        self.port = self.server.socket.getsockname()[1]
+        self.server.start()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.stop()
+
+    def connect(self, target, headers=()):
+        client = Client(self.port, target, headers)
+        self.clients.append(client)
+        return client
+
+    def wait_for_streams(self, count):
+        deadline = time.time() + 5
+        while len(self.server.streams) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def wait_for_pollers(self, count):
+        deadline = time.time() + 5
+        while len(self.server.pollers) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def publish(self, *numbers, **fields):
+        for n in numbers:
+            event = {'kind': 'build', 'n': n}
+            event.update(fields)
+            self.server.publish(event)
+
+    def test_stream(self):
+        everything = self.connect('/events')
+        central = self.connect('/events?tree=mozilla-central')
+        self.wait_for_streams(2)
+        self.publish(0, 1, tree='try')
+        self.publish(2, tree='mozilla-central')
+        self.assertTrue(everything.read_until('id: 3\n'))
+        self.assertTrue(central.read_until('id: 3\n'))
+        self.assertEqual([(seq, kind, event['n'])
+                          for seq, kind, event in everything.events()],
+                         [(1, 'build', 0), (2, 'build', 1), (3, 'build', 2)])
+        self.assertEqual([(seq, event['n'])
+                          for seq, kind, event in central.events()],
+                         [(3, 2)])
+
+    def test_replay(self):
+        self.publish(*range(15))
+        self.wait_for_seq(15)
+        # events after the Last-Event-ID are replayed from the log, as far
+        # back as it goes
+        client = self.connect('/events', [('Last-Event-ID', '12')])
+        self.assertTrue(client.read_until('id: 15\n'))
+        self.assertEqual([seq for seq, kind, event in client.events()],
+                         [13, 14, 15])
+        client = self.connect('/events?cursor=0')
+        self.assertTrue(client.read_until('id: 15\n'))
+        self.assertEqual([seq for seq, kind, event in client.events()],
+                         range(6, 16))
+
+        # and then new events follow
+        self.wait_for_streams(2)
+        self.publish(15)
+        self.assertTrue(client.read_until('id: 16\n'))
+
+    def wait_for_seq(self, seq):
+        deadline = time.time() + 5
+        while self.server.log.seq < seq and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_poll(self):
+        # a first request learns the cursor
+        result = self.connect('/poll').json()
+        self.assertEqual(result, {'cursor': 0, 'events': []})
+
+        # the next waits for a matching event
+        client = self.connect('/poll?cursor=0&tree=mozilla-central')
+        self.wait_for_pollers(1)
+        self.publish(0, tree='try')
+        self.publish(1, tree='mozilla-central')
+        result = client.json()
+        self.assertEqual(result['cursor'], 2)
+        self.assertEqual([e['n'] for e in result['events']], [1])
+
+        # events already in the log are returned at once
+        result = self.connect('/poll?cursor=0').json()
+        self.assertEqual([e['n'] for e in result['events']], [0, 1])
+
+    def test_poll_timeout(self):
+        result = self.connect('/poll?cursor=0&timeout=0.1').json()
+        self.assertEqual(result, {'cursor': 0, 'events': []})
+
+    def test_slow_client(self):
+        slow = self.connect('/events')
+        fast = self.connect('/events?tree=mozilla-central')
+        self.wait_for_streams(2)
+        # more than max_buffer queued for a client which hasn't read it
+        # gets it disconnected; the others carry on
+        self.publish(0, tree='try', log='x' * 8192)
+        self.publish(1, tree='mozilla-central')
+        self.assertTrue(fast.read_until('id: 2\n'))
+        self.assertEqual(self.server.slow_clients, 1)
+        self.assertEqual(len(self.server.streams), 1)
+        data = slow.read_all()
+        self.assertFalse('id: 1\n' in data)
+
+
+if __name__ == '__main__':
+    unittest.main()
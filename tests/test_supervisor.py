@@ -0,0 +1,186 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import os
+import time
+import unittest
+
+from pulsebuildmonitor import MonitorSupervisor, synthetic_messages
+from pulsebuildmonitor.supervisor import HashRing
+
+from tests.test_monitor import Recorder, keys, run_monitor
+
+
+def exit_at_once(label, shard):
+    os._exit(3)
+
+
+def run_forever(label, shard):
+    while True:
+        time.sleep(1)
+
+
+class DeadProcess(object):
+    """Stands in for a worker process which has exited."""
+
+    exitcode = 1
+    pid = 0
+
+    def is_alive(self):
+        return False
+
+    def join(self):
+        pass
+
+
+class RestartTest(unittest.TestCase):
+
+    def supervisor(self, restart_delay):
+        supervisor = MonitorSupervisor(None, workers=1, label='test',
+                                       restart_delay=restart_delay)
+        supervisor.started = []
+
+        def start_worker(i):
+            supervisor.started.append(i)
+            supervisor.processes[i] = DeadProcess()
+        supervisor.start_worker = start_worker
+        return supervisor
+
+    def wait_for_restart(self, supervisor, count, timeout=5):
+        deadline = time.time() + timeout
+        while len(supervisor.started) < count and time.time() < deadline:
+            supervisor.check_workers()
+            time.sleep(0.005)
+
+    def test_backoff(self):
+        # a worker which keeps exiting waits twice as long each time
+        supervisor = self.supervisor(0.01)
+        supervisor.start()
+        delays = []
+        for restarts in xrange(2, 6):
+            self.wait_for_restart(supervisor, restarts)
+            self.assertEqual(len(supervisor.started), restarts)
+            delays.append(supervisor.restarts[0][0])
+        self.assertEqual(delays, [0.01, 0.02, 0.04, 0.08])
+
+    def test_not_restarted_early(self):
+        supervisor = self.supervisor(60)
+        supervisor.start()
+        supervisor.check_workers()
+        supervisor.check_workers()
+        self.assertEqual(supervisor.started, [0])
+        self.assertEqual(supervisor.processes[0], None)
+
+    def test_backoff_limit(self):
+        supervisor = self.supervisor(1)
+        supervisor.start()
+        supervisor.restarts[0] = (40, time.time())
+        supervisor.check_workers()
+        self.assertEqual(supervisor.restarts[0][0], 60)
+
+    def test_backoff_reset(self):
+        # a worker which ran for over a minute starts from restart_delay
+        supervisor = self.supervisor(1)
+        supervisor.start()
+        supervisor.restarts[0] = (40, time.time() - 120)
+        supervisor.check_workers()
+        self.assertEqual(supervisor.restarts[0][0], 1)
+
+    def test_worker_processes(self):
+        supervisor = MonitorSupervisor(exit_at_once, workers=2, label='test',
+                                       restart_delay=0.01)
+        supervisor.start()
+        first = [p.pid for i, p in sorted(supervisor.processes.items())]
+        deadline = time.time() + 10
+        pids = first
+        while time.time() < deadline and \
+                [pid for pid in pids if pid in first]:
+            supervisor.check_workers()
+            pids = [p.pid for i, p in sorted(supervisor.processes.items())
+                    if p is not None]
+            time.sleep(0.01)
+        supervisor.stop()
+        self.assertEqual([pid for pid in pids if pid in first], [])
+        self.assertEqual(sorted(supervisor.restarts), [0, 1])
+
+    def test_stop(self):
+        supervisor = MonitorSupervisor(run_forever, workers=2, label='test')
+        supervisor.start()
+        processes = supervisor.processes.values()
+        supervisor.stop()
+        self.assertEqual(supervisor.processes, {})
+        for process in processes:
+            self.assertFalse(process.is_alive())
+
+
+class HashRingTest(unittest.TestCase):
+
+    def test_adding_a_node_moves_few_values(self):
+        values = ['%012x' % (i * 7919) for i in xrange(1000)]
+        before = HashRing(range(4))
+        after = HashRing(range(5))
+        moved = [v for v in values
+                 if before.node_for(v) != after.node_for(v)]
+        # only values taken by the new node move
+        for value in moved:
+            self.assertEqual(after.node_for(value), 4)
+        self.assertTrue(len(moved) < 400)
+
+
+class ShardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = list(synthetic_messages(500))
+
+    def run_shards(self, shards):
+        """Run a monitor for each shard, and return the keys of the events
+           each received.
+        """
+        received = []
+        for shard in shards:
+            recorder = Recorder()
+            run_monitor(self.messages, buildCallback=recorder.build,
+                        testCallback=recorder.test, talos=True, shard=shard)
+            received.append(keys(recorder.builds + recorder.tests))
+        return received
+
+    def assertPartitioned(self, received):
+        every = sorted(data['payload']['key'] for t, data in self.messages)
+        self.assertEqual(sorted(sum(received, [])), every)
+        for shardKeys in received:
+            self.assertTrue(shardKeys)
+
+    def test_workers(self):
+        supervisor = MonitorSupervisor(None, workers=4, label='test',
+                                       shard_key='revision')
+        args = [supervisor.worker_args(i) for i in xrange(4)]
+        self.assertEqual(len(set(label for label, shard in args)), 4)
+        self.assertEqual([shard.index for label, shard in args], range(4))
+        self.assertPartitioned(self.run_shards(shard for label, shard in args))
+
+    def test_split_between_hosts(self):
+        shards = []
+        for first in (0, 3):
+            supervisor = MonitorSupervisor(None, workers=3, label='test',
+                                           shard_key='tree', shard_count=6,
+                                           first_shard=first)
+            shards += [supervisor.worker_args(i)[1] for i in xrange(3)]
+        received = self.run_shards(shards)
+        every = sorted(data['payload']['key'] for t, data in self.messages)
+        self.assertEqual(sorted(sum(received, [])), every)
+        # every event of a tree belongs to the same shard
+        owners = {}
+        for i, shardKeys in enumerate(received):
+            for key in shardKeys:
+                self.assertEqual(owners.setdefault(key.split('.')[1], i), i)
+        self.assertEqual(len(owners), 4)
+
+    def test_unsharded(self):
+        supervisor = MonitorSupervisor(None, workers=4, label='test')
+        self.assertEqual(supervisor.worker_args(2), ('test', None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import sys
+import threading
+import types
+import unittest
+
+from pulsebuildmonitor import (FactoryBuildMonitor, FakeMessage,
+                               MessageAcknowledger, PulseTransport,
+                               synthetic_messages)
+
+
+class KombuConsumer(object):
+    """Records the AMQP methods a kombu Consumer would send."""
+
+    def __init__(self, log):
+        self.log = log
+
+    def qos(self, prefetch_size=0, prefetch_count=0, apply_global=False):
+        self.log.append(('basic_qos', prefetch_count))
+
+    def consume(self):
+        self.log.append(('basic_consume',))
+
+    def cancel(self):
+        self.log.append(('basic_cancel',))
+
+    def __enter__(self):
+        self.consume()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cancel()
+
+
+class Connection(object):
+    """A kombu connection whose drain_events() delivers 'messages' to
+       the consumer's callback, calling 'between' after each.
+    """
+
+    def __init__(self, messages, between):
+        self.log = []
+        self.messages = messages
+        self.between = between
+        self.callback = None
+
+    def Consumer(self, queues, callbacks=None, **kwargs):
+        self.callback = callbacks[0]
+        return KombuConsumer(self.log)
+
+    def drain_events(self, timeout=None):
+        for i, (t, data) in enumerate(self.messages):
+            self.callback(data, FakeMessage(i + 1))
+            self.between(i)
+
+
+class NormalizedBuildConsumer(object):
+    """Behaves like mozillapulse's consumer: it creates a kombu
+       Consumer, and consumes with it while it drains events.
+    """
+
+    connection = None
+    messages = []
+    between = staticmethod(lambda i: None)
+
+    def __init__(self, applabel):
+        self.applabel = applabel
+
+    def configure(self, topic, callback, durable=False):
+        self.callback = callback
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = Connection(self.messages, self.between)
+
+    def listen(self):
+        self.connect()
+        consumer = self.connection.Consumer('queue',
+                                            callbacks=[self.callback])
+        with consumer:
+            self.connection.drain_events()
+
+
+class PrefetchTest(unittest.TestCase):
+
+    def setUp(self):
+        # stands in for mozillapulse, which may not be installed
+        self.modules = dict((name, sys.modules.get(name))
+                            for name in ('mozillapulse',
+                                         'mozillapulse.consumers'))
+        package = types.ModuleType('mozillapulse')
+        consumers = types.ModuleType('mozillapulse.consumers')
+        consumers.NormalizedBuildConsumer = NormalizedBuildConsumer
+        package.consumers = consumers
+        sys.modules['mozillapulse'] = package
+        sys.modules['mozillapulse.consumers'] = consumers
+        NormalizedBuildConsumer.messages = list(synthetic_messages(10))
+
+    def tearDown(self):
+        for name, module in self.modules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+        NormalizedBuildConsumer.between = staticmethod(lambda i: None)
+
+    def run_monitor(self, acknowledger):
+        transport = PulseTransport('test')
+        monitor = FactoryBuildMonitor(buildCallback=lambda builddata: None,
+                                      testCallback=lambda builddata: None,
+                                      talos=True, transport=transport,
+                                      acknowledger=acknowledger)
+        monitor.listen()
+        return transport.consumer.connection.log
+
+    def test_qos_before_consume(self):
+        log = self.run_monitor(MessageAcknowledger(mode='after-callback',
+                                                   prefetch=5))
+        self.assertEqual(log[:2], [('basic_qos', 5), ('basic_consume',)])
+
+    def test_no_limit(self):
+        log = self.run_monitor(MessageAcknowledger(mode='batch'))
+        self.assertEqual(log, [('basic_consume',), ('basic_cancel',)])
+
+    def test_reconsume_when_changed(self):
+        acknowledger = MessageAcknowledger(mode='after-callback', prefetch=5)
+
+        def between(i):
+            if i == 3:
+                # as a shedder would, from a callback thread
+                thread = threading.Thread(target=acknowledger.set_prefetch,
+                                          args=(1,))
+                thread.start()
+                thread.join()
+        NormalizedBuildConsumer.between = staticmethod(between)
+        log = self.run_monitor(acknowledger)
+        # the new limit is set on the next message, and then the
+        # consumer is restarted so that the broker applies it
+        self.assertEqual(log, [('basic_qos', 5), ('basic_consume',),
+                               ('basic_qos', 1), ('basic_cancel',),
+                               ('basic_consume',), ('basic_cancel',)])
+
+
+if __name__ == '__main__':
+    unittest.main()